@@ -0,0 +1,202 @@
+'''
+Persistent cache of the LLM augmentation of receipt abbreviations
+
+The same abbreviations ("KASTEN LEER", "BANANE") come up on every receipt, the cache stores
+productName, categoryMain and categorySub per normalized abbreviation, prompt version and model
+in a SQLite file, so only new abbreviations are sent to Mistral. Answers with the fallback
+subcategory 'Kategorie nicht erkannt' are not stored, these items are requested again.
+The prompt version is a hash of the prompt and the category taxonomy, changing either of them
+makes the old entries unreachable, invalidate() deletes them. The least recently used entries
+are evicted above ABBR_CACHE_MAX_ENTRIES.
+
+Run as script to seed the cache from the receipts table or to show its size:
+    python abbr_cache.py seed
+    python abbr_cache.py stats
+'''
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import abbr_canonical
+
+load_dotenv()
+
+ABBR_CACHE_PATH = os.getenv('ABBR_CACHE_PATH', os.path.join('.cache', 'abbreviations.sqlite'))
+ABBR_CACHE_MAX_ENTRIES = int(os.getenv('ABBR_CACHE_MAX_ENTRIES', 100000))
+
+# Fields of the augmentation that are stored
+FIELDS = ['productName', 'categoryMain', 'categorySub']
+# Fallback subcategory of the model for items it cannot categorize, such answers are not cached
+# so that the item is requested again on the next receipt
+UNRECOGNIZED_CATEGORY = 'Kategorie nicht erkannt'
+
+
+def normalize_abbr(item):
+    '''Returns the cache key of an abbreviation, its canonical form (see abbr_canonical.py).'''
+    return abbr_canonical.canonical_abbr(item)
+
+def prompt_version(*prompt_parts):
+    '''Returns a short hash of the prompt texts the answers depend on.'''
+    digest = hashlib.sha256()
+    for part in prompt_parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:16]
+
+
+class AbbreviationCache:
+    '''SQLite store of augmentations by (normalized abbreviation, prompt version, model) with LRU eviction.'''
+
+    def __init__(self, path=ABBR_CACHE_PATH, max_entries=ABBR_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # one connection shared by the worker threads, the lock serializes the access
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS augmentations (
+                abbr text,
+                prompt_version text,
+                model text,
+                product_name text,
+                category_main text,
+                category_sub text,
+                source text,
+                used_at real,
+                PRIMARY KEY (abbr, prompt_version, model)
+            )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS augmentations_used_at ON augmentations (used_at)')
+        self._conn.commit()
+
+    def get_many(self, items, version, model):
+        '''Returns the cached augmentations of items as {item: item json}, items without entry are left out.'''
+        keys = {normalize_abbr(item) for item in items}
+        if not keys:
+            return {}
+        found = {}
+        with self._lock:
+            for abbr, product_name, category_main, category_sub in self._conn.execute(
+                    f'''SELECT abbr, product_name, category_main, category_sub FROM augmentations
+                        WHERE prompt_version = ? AND model = ? AND abbr IN ({",".join("?" * len(keys))})''',
+                    (version, model, *keys)):
+                found[abbr] = dict(zip(FIELDS, [product_name, category_main, category_sub]))
+            self._conn.executemany(
+                'UPDATE augmentations SET used_at = ? WHERE abbr = ? AND prompt_version = ? AND model = ?',
+                [(time.time(), abbr, version, model) for abbr in found])
+            self._conn.commit()
+        return {item: dict(found[normalize_abbr(item)], product_abbr=item)
+                for item in items if normalize_abbr(item) in found}
+
+    def put_many(self, item_jsons, version, model, source='llm'):
+        '''Stores the item jsons that contain all FIELDS and are categorized, returns the number of stored entries.'''
+        rows = [(normalize_abbr(item_json['product_abbr']), version, model,
+                 *[str(item_json[field]) for field in FIELDS], source, time.time())
+                for item_json in item_jsons
+                if all(item_json.get(field) for field in FIELDS)
+                and item_json['categorySub'] != UNRECOGNIZED_CATEGORY]
+        if rows:
+            with self._lock:
+                self._conn.executemany('INSERT OR REPLACE INTO augmentations VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self._conn.commit()
+            self._evict()
+        return len(rows)
+
+    def _evict(self):
+        with self._lock:
+            (n_entries,) = self._conn.execute('SELECT count(*) FROM augmentations').fetchone()
+            if n_entries > self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM augmentations WHERE rowid IN '
+                    '(SELECT rowid FROM augmentations ORDER BY used_at LIMIT ?)', (n_entries - self.max_entries,))
+                self._conn.commit()
+
+    def invalidate(self, current_version=None):
+        '''Deletes the entries of other prompt versions than current_version, all entries if it is None.'''
+        with self._lock:
+            if current_version is None:
+                cursor = self._conn.execute('DELETE FROM augmentations')
+            else:
+                cursor = self._conn.execute('DELETE FROM augmentations WHERE prompt_version != ?', (current_version,))
+            self._conn.commit()
+        return cursor.rowcount
+
+    def abbreviations(self, version, model):
+        '''Returns the abbreviations with an entry for the prompt version and model.'''
+        with self._lock:
+            return [abbr for (abbr,) in self._conn.execute(
+                'SELECT abbr FROM augmentations WHERE prompt_version = ? AND model = ?', (version, model))]
+
+    def stats(self):
+        '''Returns the number of entries per prompt version, model and source.'''
+        with self._lock:
+            return self._conn.execute(
+                'SELECT prompt_version, model, source, count(*) FROM augmentations '
+                'GROUP BY prompt_version, model, source').fetchall()
+
+    def seed(self, df, version, model):
+        '''Stores the most frequent augmentation per abbreviation of a receipts table (see database.data()).
+
+        Entries already in the cache are kept.
+        '''
+        df = df.dropna(subset=['product_abbr', 'product_name', 'category_main', 'category_sub'])
+        df = df[df.category_sub != UNRECOGNIZED_CATEGORY]
+        df = df.assign(abbr=df.product_abbr.map(normalize_abbr))
+        most_frequent = (df.groupby(['abbr', 'product_name', 'category_main', 'category_sub'])
+                         .size().reset_index(name='n')
+                         .sort_values('n', ascending=False)
+                         .drop_duplicates('abbr'))
+        rows = [(row.abbr, version, model, row.product_name, row.category_main, row.category_sub, 'receipts', 0.0)
+                for row in most_frequent.itertuples()]
+        with self._lock:
+            cursor = self._conn.executemany('INSERT OR IGNORE INTO augmentations VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+        self._evict()
+        return cursor.rowcount
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def default_cache():
+    '''Returns the process-wide abbreviation cache, or None if it is disabled (ABBR_CACHE_MAX_ENTRIES=0).'''
+    global _default_cache
+    if ABBR_CACHE_MAX_ENTRIES <= 0:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = AbbreviationCache()
+    return _default_cache
+
+
+def main():
+    import database as db
+    import process_llm as llm
+
+    parser = argparse.ArgumentParser(description='Manage the cache of the LLM augmentation of abbreviations')
+    parser.add_argument('command', choices=['seed', 'stats', 'invalidate', 'clear'],
+                        help='seed from the receipts table, show the entries, delete entries of old prompts, delete all')
+    args = parser.parse_args()
+
+    cache = AbbreviationCache()
+    version = llm.current_prompt_version(llm.get_rewe_categories())
+    if args.command == 'seed':
+        print(f'Seeded {cache.seed(db.data(with_embeddings=False), version, llm.LLM_MODEL)} abbreviations from the receipts table')
+    elif args.command == 'invalidate':
+        print(f'Deleted {cache.invalidate(version)} entries of other prompt versions')
+    elif args.command == 'clear':
+        print(f'Deleted {cache.invalidate()} entries')
+    print(f'Current prompt version {version}')
+    for entry_version, model, source, n in cache.stats():
+        print(f'{entry_version}  {model:<25} {source:<10} {n:>7} entries')
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,151 @@
+'''
+Canonical form and near-duplicate grouping of receipt abbreviations
+
+The OCR gives the same product in slightly different spellings: extra spaces, 0 for O and 1 for I
+inside words, a quantity like "2 x" in front of the name. canonical_abbr() removes these
+differences, AbbreviationIndex maps the remaining near-duplicates ("BANANE" and "BANANEN") to the
+abbreviation that was seen first. The index finds the candidates by shared character trigrams and
+accepts them by edit distance, names with different numbers ("MILCH 1,5%", "MILCH 3,5%") are
+never grouped. Every group is sent to the LLM once, the answer is used for all its items.
+
+Settings in the .env-file:
+    ABBR_FUZZY_MAX_EDITS - maximum edit distance of near-duplicates, 0 disables the grouping (default 1)
+    ABBR_FUZZY_MIN_LENGTH - minimum length of abbreviations that are grouped (default 6)
+    ABBR_FUZZY_MIN_SIMILARITY - minimum trigram similarity of the candidates (default 0.7)
+'''
+
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ABBR_FUZZY_MAX_EDITS = int(os.getenv('ABBR_FUZZY_MAX_EDITS', 1))
+ABBR_FUZZY_MIN_LENGTH = int(os.getenv('ABBR_FUZZY_MIN_LENGTH', 6))
+ABBR_FUZZY_MIN_SIMILARITY = float(os.getenv('ABBR_FUZZY_MIN_SIMILARITY', 0.7))
+
+# "2 x", "2x", "2 *" in front of the name, "x 2" or "2 x" behind it
+QUANTITY = re.compile(r'^\d+\s*[X*]\s+|\s+(?:\d+\s*[X*]|[X*]\s*\d+)$')
+# O and I between digits are 0 and 1, 0 and 1 between letters are O and I
+DIGIT_IN_WORD = re.compile(r'(?<=[A-ZÄÖÜ])[01]+(?=[A-ZÄÖÜ])')
+LETTER_IN_NUMBER = re.compile(r'(?<=\d)[OI]+(?=\d)')
+NUMBERS = re.compile(r'\d+')
+
+
+def canonical_abbr(item):
+    '''Returns the canonical form of an abbreviation: upper case, single spaces, no quantity, OCR digit/letter fixes.'''
+    abbr = re.sub(r'\s+', ' ', str(item)).strip().upper()
+    abbr = QUANTITY.sub('', abbr).strip() or abbr
+    abbr = LETTER_IN_NUMBER.sub(lambda m: m.group().replace('O', '0').replace('I', '1'), abbr)
+    abbr = DIGIT_IN_WORD.sub(lambda m: m.group().replace('0', 'O').replace('1', 'I'), abbr)
+    return abbr
+
+def trigrams(abbr):
+    padded = f' {abbr} '
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b, maximum):
+    '''Levenshtein distance of a and b, maximum + 1 if it is larger than maximum.'''
+    if abs(len(a) - len(b)) > maximum:
+        return maximum + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > maximum:
+            return maximum + 1
+        previous = current
+    return previous[-1]
+
+
+class AbbreviationIndex:
+    '''Trigram index of canonical abbreviations that maps near-duplicates to the abbreviation added first.
+
+    Thread-safe, abbreviations that have no near-duplicate in the index are added to it.
+    '''
+
+    def __init__(self, abbreviations=(), max_edits=ABBR_FUZZY_MAX_EDITS, min_length=ABBR_FUZZY_MIN_LENGTH,
+                 min_similarity=ABBR_FUZZY_MIN_SIMILARITY):
+        self.max_edits = max_edits
+        self.min_length = min_length
+        self.min_similarity = min_similarity
+        self._lock = threading.Lock()
+        self._known = set()
+        self._postings = defaultdict(set)
+        for abbr in abbreviations:
+            self._add(abbr)
+
+    def __len__(self):
+        return len(self._known)
+
+    def _add(self, abbr):
+        self._known.add(abbr)
+        if len(abbr) >= self.min_length:
+            for gram in trigrams(abbr):
+                self._postings[gram].add(abbr)
+
+    def _nearest(self, abbr):
+        '''Returns the closest near-duplicate of abbr in the index, None if there is none.'''
+        grams = trigrams(abbr)
+        shared = Counter(candidate for gram in grams for candidate in self._postings.get(gram, ()))
+        numbers = NUMBERS.findall(abbr)
+        best, best_distance = None, self.max_edits + 1
+        for candidate, n_shared in shared.most_common():
+            # Dice coefficient of the trigram sets, the candidates are sorted by shared trigrams
+            # and no later candidate can reach the similarity once this upper bound is too low
+            if 2 * n_shared / (len(grams) + n_shared) < self.min_similarity:
+                break
+            if 2 * n_shared / (len(grams) + len(trigrams(candidate))) < self.min_similarity:
+                continue
+            if NUMBERS.findall(candidate) != numbers:
+                continue
+            distance = edit_distance(abbr, candidate, self.max_edits)
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+        return best
+
+    def representative(self, abbr):
+        '''Returns the abbreviation of the index abbr is grouped with, abbr itself if it is new.'''
+        with self._lock:
+            if abbr in self._known:
+                return abbr
+            if self.max_edits > 0 and len(abbr) >= self.min_length:
+                nearest = self._nearest(abbr)
+                if nearest is not None:
+                    return nearest
+            self._add(abbr)
+            return abbr
+
+def group_items(items, index=None):
+    '''Groups the items by canonical form and near-duplicates.
+
+    Returns:
+        dict: {representative: [items in the order of items]}, in the order of the first occurrence
+    '''
+    index = index if index is not None else AbbreviationIndex()
+    groups = {}
+    for item in items:
+        groups.setdefault(index.representative(canonical_abbr(item)), []).append(item)
+    return groups
+
+
+_default_indexes = {}
+_default_indexes_lock = threading.Lock()
+
+def default_index(version, model):
+    '''Returns the process-wide index for a prompt version and model, built from the abbreviation cache.
+
+    New abbreviations are grouped with the ones the cache has answers for, the index is built on the first call.
+    '''
+    import abbr_cache
+
+    with _default_indexes_lock:
+        if (version, model) not in _default_indexes:
+            cache = abbr_cache.default_cache()
+            known = cache.abbreviations(version, model) if cache is not None else []
+            _default_indexes[(version, model)] = AbbreviationIndex(known)
+    return _default_indexes[(version, model)]
@@ -0,0 +1,193 @@
+'''
+Process-wide registry of the API clients
+
+Creating a MistralClient or a vision.ImageAnnotatorClient for every request means a new
+TLS handshake (Mistral) or gRPC channel (Vision) per call. The registry creates every client
+once per process and hands out the same instance to all threads and Streamlit reruns:
+    - the Mistral client gets an HTTP connection pool with keep-alive connections
+    - the Vision client gets one gRPC channel with keep-alive pings
+Every client records its requests, errors, latency and the connections it opened,
+see client_metrics().
+
+Settings in the .env-file:
+    API_MAX_CONNECTIONS - maximum number of open HTTP connections to Mistral (default 20)
+    API_KEEPALIVE_SECONDS - idle time after which a pooled connection is closed (default 120)
+    MISTRAL_ENDPOINT - other Mistral API endpoint, e.g. the local stand-in (mistral_standin.py)
+'''
+
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+API_MAX_CONNECTIONS = int(os.getenv('API_MAX_CONNECTIONS', 20))
+API_KEEPALIVE_SECONDS = float(os.getenv('API_KEEPALIVE_SECONDS', 120))
+MISTRAL_ENDPOINT = os.getenv('MISTRAL_ENDPOINT', 'https://api.mistral.ai')
+# Retries of failed connection attempts to Mistral
+API_CONNECT_RETRIES = 5
+
+# Created clients by (name, api key) and their metrics by name
+_clients = {}
+_metrics = {}
+# reentrant, the client factories register their metrics while the registry is locked
+_lock = threading.RLock()
+
+
+class ClientMetrics:
+    '''Thread-safe counters of the requests of one client.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.connections_opened = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms, error=False):
+        with self._lock:
+            self.requests += 1
+            self.errors += error
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections_opened += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'connections_opened': self.connections_opened,
+                'mean_ms': self.total_ms / self.requests if self.requests else 0.0,
+                'max_ms': self.max_ms,
+                'age_s': time.time() - self.created,
+            }
+
+def metrics_for(name):
+    '''Returns the metrics of the client name, creates them on first use.'''
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = ClientMetrics()
+        return _metrics[name]
+
+def client_metrics():
+    '''Returns the metrics of all clients: {name: {requests, errors, connections_opened, mean_ms, max_ms, age_s}}.'''
+    with _lock:
+        metrics = dict(_metrics)
+    return {name: m.as_dict() for name, m in metrics.items()}
+
+def register_client(name, client, key=None):
+    '''Registers client under (name, key), e.g. a stub client for benchmarks.'''
+    with _lock:
+        _clients[(name, key)] = client
+
+def get_client(name, factory, key=None):
+    '''Returns the client registered under (name, key), creates it with factory() on first use.'''
+    with _lock:
+        if (name, key) not in _clients:
+            _clients[(name, key)] = factory()
+        return _clients[(name, key)]
+
+
+# Mistral
+def metered_transport(metrics, **kwargs):
+    '''Returns a httpx transport that records every request and new connection in metrics.'''
+    import httpx
+
+    class MeteredTransport(httpx.HTTPTransport):
+        def handle_request(self, request):
+            # the "trace" request extension of httpx reports every new TCP connection of the pool
+            trace = request.extensions.get('trace')
+
+            def count_connections(event_name, info):
+                if event_name == 'connection.connect_tcp.complete':
+                    metrics.connection_opened()
+                if trace is not None:
+                    trace(event_name, info)
+
+            request.extensions['trace'] = count_connections
+            start = time.perf_counter()
+            try:
+                response = super().handle_request(request)
+            except Exception:
+                metrics.record((time.perf_counter() - start) * 1000, error=True)
+                raise
+            metrics.record((time.perf_counter() - start) * 1000, error=response.status_code >= 400)
+            return response
+
+    return MeteredTransport(**kwargs)
+
+def create_mistral_client(api_key, endpoint=MISTRAL_ENDPOINT):
+    import httpx
+    from mistralai.client import MistralClient
+
+    # 429 and 5xx answers are retried by rate_limit.py, which adapts the request rate,
+    # instead of the fixed backoff of the client library
+    client = MistralClient(api_key, endpoint=endpoint, max_retries=1)
+    # MistralClient has no argument for the httpx client, it is replaced on the instance.
+    # This relies on the internals of the versions pinned in requirements.txt
+    if not isinstance(getattr(client, '_client', None), httpx.Client) or not hasattr(client, '_timeout'):
+        raise RuntimeError('Unsupported version of mistralai: MistralClient has no httpx client to replace, '
+                           'install the versions of mistralai and httpx pinned in requirements.txt')
+    # replace the default httpx client by one with a bounded keep-alive pool
+    client._client.close()
+    limits = httpx.Limits(max_connections=API_MAX_CONNECTIONS,
+                          max_keepalive_connections=API_MAX_CONNECTIONS,
+                          keepalive_expiry=API_KEEPALIVE_SECONDS)
+    client._client = httpx.Client(
+        follow_redirects=True,
+        timeout=client._timeout,
+        transport=metered_transport(metrics_for('mistral'), retries=API_CONNECT_RETRIES, limits=limits))
+    return client
+
+def mistral_client(api_key):
+    '''Returns the shared MistralClient for api_key.'''
+    return get_client('mistral', lambda: create_mistral_client(api_key), key=api_key)
+
+
+# Google Vision
+class MeteredVisionClient:
+    '''Passes text_detection requests to the Vision client and records them in the metrics.'''
+
+    def __init__(self, client, metrics):
+        self.client = client
+        self.metrics = metrics
+
+    def text_detection(self, image, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.client.text_detection(image=image, **kwargs)
+        except Exception:
+            self.metrics.record((time.perf_counter() - start) * 1000, error=True)
+            raise
+        self.metrics.record((time.perf_counter() - start) * 1000, error=bool(response.error.message))
+        return response
+
+def create_vision_client():
+    from google.cloud import vision
+    from google.cloud.vision_v1.services.image_annotator.transports.grpc import ImageAnnotatorGrpcTransport
+
+    # one channel for all requests, with keep-alive pings so that idle periods
+    # between the uploads do not drop the connection
+    channel = ImageAnnotatorGrpcTransport.create_channel(options=[
+        ('grpc.max_send_message_length', -1),
+        ('grpc.max_receive_message_length', -1),
+        ('grpc.keepalive_time_ms', 30000),
+        ('grpc.keepalive_timeout_ms', 10000),
+        ('grpc.keepalive_permit_without_calls', 1),
+    ])
+    metrics = metrics_for('vision')
+    metrics.connection_opened()
+    client = vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
+    return MeteredVisionClient(client, metrics)
+
+def vision_client():
+    '''Returns the shared Vision client.'''
+    return get_client('vision', create_vision_client)
@@ -0,0 +1,787 @@
+'''
+Micro-benchmarks for the offline parts of the receipt processing
+
+Run as script, e.g.:
+    python benchmark.py parse --lines 40 --repeat 200
+    python benchmark.py lines --receipts 50 --recorded data/vision_responses
+    python benchmark.py grammar --recorded data/vision_responses
+    python benchmark.py stages --fixtures data/vision_responses
+    python benchmark.py imports
+    python benchmark.py clients --calls 20
+    python benchmark.py augment --items 100 --latency 0.5 --server-rps 10
+    python benchmark.py prompts --items 30
+    python benchmark.py embeddings --texts 2000
+    python benchmark.py quantized --storage halfvec --k 10 --add-column
+    python benchmark.py load --receipts 40 --concurrency 1 4 16 --rate-limit 20 --error-rate 0.02
+'''
+
+import argparse
+import ast
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import api_clients
+import line_clustering
+import mistral_standin
+import preprocess_image
+import rate_limit
+import read_receipt
+import vision_replay
+
+
+# Synthetic Vision responses
+def make_annotation(description, x, y, width, height, skew=0.0, curl=0.0, center=400):
+    '''Builds an object that looks like one entry of response.text_annotations.
+
+    skew - vertical offset in px per px in x direction, to imitate tilted photos
+    curl - vertical offset in px at the left and right border, to imitate curled paper
+    '''
+    corners = [(x, y), (x + width, y), (x + width, y + height), (x, y + height)]
+    vertices = [SimpleNamespace(x=int(cx), y=int(cy + skew * cx + curl * ((cx - center) / center) ** 2))
+                for cx, cy in corners]
+    return SimpleNamespace(description=description,
+                           bounding_poly=SimpleNamespace(vertices=vertices))
+
+def make_synthetic_receipt(n_lines=30, skew=0.0, curl=0.0, seed=42):
+    '''Builds text_annotations of a REWE-like receipt with n_lines product lines.
+
+    Returns the text_annotations and the list of product names printed on the receipt.
+    '''
+    rng = random.Random(seed)
+    words = ['BANANE', 'BIO', 'MILCH', 'VOLLM', 'KASTEN', 'LEER', 'GURKE', 'HAUCHSCHN',
+             'CURRY', 'GRANATAPEL', 'JOGHURT', 'NATUR', 'BROT', 'KAESE', 'GOUDA']
+    line_height, line_spacing = 28, 40
+
+    lines = [['REWE', 'Markt', 'GmbH'], ['EUR']]
+    products = []
+    for _ in range(n_lines):
+        name = rng.sample(words, rng.randint(1, 3))
+        price = f'{rng.randint(0, 19)},{rng.randint(0, 99):02d}'
+        tax = ['B'] if rng.random() < 0.7 else ['A', '*']
+        lines.append(name + [price] + tax)
+        products.append(' '.join(name))
+    lines.append(['SUMME', 'EUR', '99,99'])
+    lines.append(['Datum:', '16.10.2026', 'Uhrzeit:', '12:00'])
+
+    annotations = []
+    for row, line in enumerate(lines):
+        x, y = 40, 100 + row * line_spacing + rng.randint(-3, 3)
+        for word in line:
+            width = 18 * len(word)
+            annotations.append(make_annotation(word, x, y, width, line_height, skew, curl))
+            x += width + 20
+    full_text = '\n'.join(' '.join(line) for line in lines)
+
+    texts = [SimpleNamespace(description=full_text, bounding_poly=None)] + annotations
+    return texts, products
+
+def time_call(func, repeat):
+    '''Returns per call timings in ms.'''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.array(timings)
+
+def report(name, timings):
+    print(f'{name:<30} mean {timings.mean():8.3f} ms   '
+          f'p50 {np.percentile(timings, 50):8.3f} ms   p95 {np.percentile(timings, 95):8.3f} ms')
+
+
+# Benchmarks
+def bench_parse(n_lines, repeat):
+    '''Per receipt parse time of read_receipt.parse_text_annotations on a synthetic receipt.'''
+    texts, _ = make_synthetic_receipt(n_lines)
+    print(f'Synthetic receipt: {n_lines} product lines, {len(texts) - 1} tokens')
+
+    report('build_token_table', time_call(lambda: read_receipt.build_token_table(texts[1:]), repeat))
+    report('parse_text_annotations', time_call(lambda: read_receipt.parse_text_annotations(texts), repeat))
+
+
+def parse_with_engine(texts, engine):
+    '''Returns the parsed product names, or None if the receipt could not be parsed.'''
+    try:
+        df = read_receipt.parse_text_annotations(texts, line_engine=engine)
+    except Exception:
+        return None
+    return [name.strip() for name in df.product_abbr]
+
+def bench_lines(n_receipts, n_lines, recorded_dir=None):
+    '''Compares the line engines on tilted and curled synthetic receipts and on recorded responses.'''
+    engines = list(line_clustering.LINE_ENGINES)
+    distortions = [('straight', 0.0, 0.0), ('skew 2%', 0.02, 0.0), ('skew 5%', 0.05, 0.0),
+                   ('curl 15px', 0.0, 15.0), ('skew 3% + curl 10px', 0.03, 10.0)]
+
+    print(f'{n_receipts} synthetic receipts with {n_lines} product lines each: '
+          f'share of receipts parsed exactly, mean parse time')
+    for label, skew, curl in distortions:
+        results = {engine: [0, []] for engine in engines}
+        for seed in range(n_receipts):
+            texts, products = make_synthetic_receipt(n_lines, skew=skew, curl=curl, seed=seed)
+            for engine in engines:
+                start = time.perf_counter()
+                parsed = parse_with_engine(texts, engine)
+                results[engine][1].append((time.perf_counter() - start) * 1000)
+                results[engine][0] += parsed == products
+        print(f'{label:<22}' + ''.join(
+            f'{engine:>12} {correct / n_receipts:7.1%} {np.mean(timings):7.3f} ms'
+            for engine, (correct, timings) in results.items()))
+
+    if recorded_dir:
+        fixtures = vision_replay.load_fixtures(recorded_dir)
+        print(f'\n{len(fixtures)} recorded responses: number of parsed products per engine')
+        failed = {engine: 0 for engine in engines}
+        for filename, response, _ in fixtures:
+            parsed = {engine: parse_with_engine(response.text_annotations, engine) for engine in engines}
+            for engine in engines:
+                failed[engine] += parsed[engine] is None
+            print(f'{filename:<40}' + ''.join(
+                f'{engine:>12} {"failed" if parsed[engine] is None else len(parsed[engine]):>6}'
+                for engine in engines))
+        print('Failed parses: ' + ', '.join(f'{engine} {n}' for engine, n in failed.items()))
+
+
+def legacy_parse_product_lines(line_strings):
+    '''The chain of pandas passes that read_receipt used before the line grammar, for comparison.'''
+    df_sorted = pd.DataFrame({'String': line_strings})
+    df_sorted = df_sorted[df_sorted['String'].str.contains(' B',case=True)|df_sorted['String'].str.contains(' A *',case=True)].reset_index(drop=True)
+    df_sorted['String'] = df_sorted['String'].str.replace(r' B$','',regex=True)
+    df_sorted['String'] = df_sorted['String'].str.replace(r' A \*$','',regex=True)
+    df_sorted['String'] = df_sorted['String'].str.replace(r' A$','',regex=True)
+
+    def extract_price(input_str):
+        match = re.search(r' [A-Za-z%]', input_str[::-1])
+        return input_str[-match.start():] if match else input_str
+
+    df_sorted['price'] = df_sorted['String'].apply(extract_price)
+    for prefix in ['14 ', '2.0 ', 'W. ', '102 ']:
+        df_sorted['price'] = df_sorted['price'].apply(lambda x: re.sub(f'^{re.escape(prefix)}', '', x))
+    df_sorted['String'] = df_sorted.apply(lambda row: row['String'].replace(row['price'],''), axis=1)
+    df_sorted['price'] = df_sorted['price'].str.lstrip('.B')
+    df_sorted['price'] = df_sorted['price'].str.replace(',','.')
+    df_sorted['price'] = df_sorted['price'].str.replace(' ','')
+    df_sorted['price'] = df_sorted['price'].astype('float')
+    return df_sorted.rename(columns={'String':'product_abbr'})
+
+# Lines where the misread amounts in front of the price are the price itself
+GRAMMAR_EDGE_LINES = ['PFAND 14 B', 'BANANE 2.0 B', 'PFAND 14 0,25 B', 'TOMATE 2.0 0,99 B',
+                      'SALAT 14 1,99 A *', 'KAESE 102 2,49 A', 'W. 3,49 B', 'MILCH 1,19 A']
+
+def bench_grammar(n_receipts, n_lines, repeat, recorded_dir=None):
+    '''Compares the line grammar with the former chain of pandas passes on the lines of the receipts.'''
+    receipts = [make_synthetic_receipt(n_lines, seed=seed)[0] for seed in range(n_receipts)]
+    if recorded_dir:
+        receipts += [response.text_annotations for _, response, _ in vision_replay.load_fixtures(recorded_dir)]
+    receipt_strings = [read_receipt.group_product_lines(read_receipt.build_token_table(texts[1:]))
+                       for texts in receipts]
+    receipt_strings.append(GRAMMAR_EDGE_LINES)
+    print(f'{len(receipt_strings)} receipts, {sum(map(len, receipt_strings))} lines')
+
+    mismatches = 0
+    for line_strings in receipt_strings:
+        legacy = legacy_parse_product_lines(line_strings)
+        parsed = read_receipt.parse_product_lines(line_strings)
+        mismatches += not legacy[['product_abbr', 'price']].equals(parsed[['product_abbr', 'price']])
+    print(f'Receipts with different results: {mismatches}')
+
+    def parse_all(parse):
+        return lambda: [parse(line_strings) for line_strings in receipt_strings]
+    report('legacy pandas chain', time_call(parse_all(legacy_parse_product_lines), repeat) / len(receipt_strings))
+    report('parse_product_lines', time_call(parse_all(read_receipt.parse_product_lines), repeat) / len(receipt_strings))
+
+
+def bench_stages(fixture_dir, repeat, n_synthetic=20):
+    '''Per stage timings of the OCR parsing path across the recorded fixtures.
+
+    Without fixtures the parsing stages run on synthetic receipts. The preprocessing always also runs on
+    a synthetic photo larger than OCR_MAX_LONG_EDGE, so that the downscaling is covered.
+    '''
+    if fixture_dir and os.path.exists(fixture_dir):
+        fixtures = vision_replay.load_fixtures(fixture_dir)
+    else:
+        print(f'No fixtures found, using {n_synthetic} synthetic receipts (record fixtures with vision_replay.py)')
+        fixtures = [(f'synthetic_{seed}', SimpleNamespace(text_annotations=make_synthetic_receipt(seed=seed)[0]), None)
+                    for seed in range(n_synthetic)]
+    print(f'{len(fixtures)} receipts, {repeat} repetitions each\n')
+
+    # phone photo sized image, above the long edge limit of the upload
+    long_edge = preprocess_image.OCR_MAX_LONG_EDGE * 4 // 3
+    photo = Image.new('RGB', (long_edge * 3 // 4, long_edge), 'white')
+
+    stages = ['decode', 'preprocess', 'preprocess large photo', 'token table', 'line clustering', 'price parsing', 'box drawing']
+    timings = {stage: [] for stage in stages}
+
+    def timed(stage, func):
+        start = time.perf_counter()
+        result = func()
+        timings[stage].append((time.perf_counter() - start) * 1000)
+        return result
+
+    for _ in range(repeat):
+        timed('preprocess large photo', lambda: preprocess_image.prepare_upload(photo))
+        for name, response, image_path in fixtures:
+            texts = response.text_annotations
+            if image_path is not None:
+                def decode():
+                    image = preprocess_image.fix_orientation(Image.open(image_path))
+                    image.load()
+                    return image
+                image = timed('decode', decode)
+                timed('preprocess', lambda: preprocess_image.prepare_upload(image))
+            tokens = timed('token table', lambda: read_receipt.build_token_table(texts[1:]))
+            line_strings = timed('line clustering', lambda: read_receipt.group_product_lines(tokens))
+            timed('price parsing', lambda: read_receipt.parse_product_lines(line_strings))
+            if image_path is not None:
+                polygons = read_receipt.box_polygons(texts[1:])
+                timed('box drawing', lambda: read_receipt.render_preview(image_path, polygons))
+
+    for stage in stages:
+        if timings[stage]:
+            report(stage, np.array(timings[stage]))
+        else:
+            print(f'{stage:<30} skipped (no receipt images)')
+
+
+# Import time of the Streamlit pages
+PAGES = ['home.py', 'pages/data.py', 'pages/search.py', 'pages/upload.py', 'pages/visualization.py']
+# Budget in ms for the imports of each page, on top of importing streamlit itself
+IMPORT_BUDGET_MS = {
+    'home.py': 300,
+    'pages/data.py': 50,
+    'pages/search.py': 50,
+    'pages/upload.py': 100,
+    'pages/visualization.py': 300,
+}
+# Heavy dependencies that must only be imported when they are first needed
+LAZY_MODULES = ['scipy', 'PIL', 'mistralai', 'google.cloud.vision', 'psycopg2', 'pgvector']
+
+def page_import_statements(page):
+    '''Returns the source of the top-level import statements of a page.'''
+    with open(page) as f:
+        source = f.read()
+    return [ast.get_source_segment(source, node) for node in ast.parse(source).body
+            if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+def measure_page_imports(page):
+    '''Imports the modules of a page in a fresh interpreter.
+
+    Returns the import time in ms (without streamlit) and the heavy modules that the modules of
+    this repository imported by the page load. These are checked in a second interpreter without
+    streamlit, streamlit and plotly import some of them (e.g. PIL) and would hide an eager import.
+    '''
+    statements = page_import_statements(page)
+    root = os.path.dirname(os.path.abspath(__file__))
+
+    def is_local(statement):
+        node = ast.parse(statement).body[0]
+        names = [alias.name for alias in node.names] if isinstance(node, ast.Import) else [node.module]
+        return any(os.path.exists(os.path.join(root, name.split('.')[0] + '.py')) for name in names)
+
+    timing_script = '\n'.join([
+        'import json, time',
+        'import streamlit',
+        'start = time.perf_counter()',
+        *statements,
+        'elapsed = (time.perf_counter() - start) * 1000',
+        'print(json.dumps(elapsed))',
+    ])
+    eager_script = '\n'.join([
+        'import json, sys',
+        *(statement for statement in statements if not is_local(statement) and 'streamlit' not in statement),
+        'preloaded = set(sys.modules)',
+        *(statement for statement in statements if is_local(statement)),
+        f'print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules and m not in preloaded]))',
+    ])
+
+    def run(script):
+        result = subprocess.run([sys.executable, '-c', script], cwd=root, capture_output=True, text=True, check=True)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    return {'ms': run(timing_script), 'loaded': run(eager_script)}
+
+def check_import_budget(repeat):
+    '''Measures the import time of every page and checks it against IMPORT_BUDGET_MS.
+
+    Returns True if all pages are within their budget and import no heavy dependency eagerly.
+    '''
+    within_budget = True
+    for page in PAGES:
+        measurements = [measure_page_imports(page) for _ in range(repeat)]
+        import_ms = np.median([m['ms'] for m in measurements])
+        loaded = measurements[0]['loaded']
+        ok = import_ms <= IMPORT_BUDGET_MS[page] and not loaded
+        within_budget &= ok
+        print(f'{page:<25} {import_ms:8.1f} ms  (budget {IMPORT_BUDGET_MS[page]} ms)  '
+              f'{"ok" if ok else "FAILED"}' + (f'  eager imports: {", ".join(loaded)}' if loaded else ''))
+    return within_budget
+
+
+def bench_clients(calls, endpoint=None):
+    '''Per request latency of a new MistralClient per request against the shared client of api_clients.py.
+
+    Uses the models endpoint, which does not count towards the token quota.
+    '''
+    from mistralai.client import MistralClient
+    import process_llm
+
+    def fresh_client():
+        client = MistralClient(process_llm.MISTRAL_API_KEY)
+        if endpoint:
+            client._endpoint = endpoint
+        client.list_models()
+
+    shared = api_clients.mistral_client(process_llm.MISTRAL_API_KEY)
+    if endpoint:
+        shared._endpoint = endpoint
+    # open the pooled connection before the timing
+    shared.list_models()
+
+    report('new client per request', time_call(fresh_client, calls))
+    report('shared client', time_call(shared.list_models, calls))
+    for name, metrics in api_clients.client_metrics().items():
+        print(f'{name}: ' + ', '.join(f'{key} {value:.1f}' if isinstance(value, float) else f'{key} {value}'
+                                      for key, value in metrics.items()))
+
+
+class StubMistralClient:
+    '''Answers chat and embedding requests like the Mistral API after a random latency, without network calls.
+
+    In-process version of mistral_standin.py with the same answers.
+
+    Requests above server_rps within one second are answered with 429 like the real API.
+    '''
+
+    def __init__(self, latency=0.5, server_rps=10, seed=42, max_batch_tokens=16384, dimension=1024):
+        self.latency = latency
+        self.max_batch_tokens = max_batch_tokens
+        self.dimension = dimension
+        self.server_rps = server_rps
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent = []
+        self.calls = 0
+
+    def chat(self, model, messages, **kwargs):
+        from mistralai.exceptions import MistralAPIStatusException
+
+        with self._lock:
+            now = time.monotonic()
+            self._recent = [t for t in self._recent if now - t < 1.0]
+            if len(self._recent) >= self.server_rps:
+                raise MistralAPIStatusException('Requests rate limit exceeded', http_status=429,
+                                                headers={'Retry-After': '1'})
+            self._recent.append(now)
+            self.calls += 1
+            latency = self.latency * self.rng.uniform(0.5, 1.5)
+        time.sleep(latency)
+
+        prompt = messages[-1].content
+        content = mistral_standin.chat_answer(prompt)
+        usage = SimpleNamespace(prompt_tokens=rate_limit.estimate_tokens(prompt),
+                                completion_tokens=rate_limit.estimate_tokens(content))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    def embeddings(self, model, input):
+        from mistralai.exceptions import MistralAPIStatusException
+
+        tokens = sum(rate_limit.estimate_tokens(text) for text in input)
+        if tokens > self.max_batch_tokens:
+            raise MistralAPIStatusException(f'Too many tokens in batch: {tokens}', http_status=400)
+        with self._lock:
+            now = time.monotonic()
+            self._recent = [t for t in self._recent if now - t < 1.0]
+            if len(self._recent) >= self.server_rps:
+                raise MistralAPIStatusException('Requests rate limit exceeded', http_status=429,
+                                                headers={'Retry-After': '1'})
+            self._recent.append(now)
+            self.calls += 1
+            latency = self.latency * self.rng.uniform(0.5, 1.5)
+        time.sleep(latency)
+        # deterministic vector per text
+        data = [SimpleNamespace(index=i, embedding=mistral_standin.embedding_vector(text, self.dimension))
+                for i, text in enumerate(input)]
+        return SimpleNamespace(data=data, usage=SimpleNamespace(prompt_tokens=tokens))
+
+def bench_augment(n_items, latency, server_rps, client_rps, batch_sizes, concurrencies):
+    '''Throughput of process_llm.process_abbr_items_list against a stub of the Mistral API, without cache.'''
+    import process_llm
+
+    texts, _ = make_synthetic_receipt(n_items)
+    items = read_receipt.parse_text_annotations(texts).product_abbr.to_list()
+    try:
+        categories = process_llm.get_rewe_categories()
+    except FileNotFoundError:
+        # the stub does not read the categories, they only count towards the estimated tokens
+        categories = '# Hauptkategorie\nSonstige Positionen\n## Unterkategorien\nKategorie nicht erkannt\n'
+    print(f'{len(items)} items, stub latency {latency * 1000:.0f} ms, stub limit {server_rps} requests/s, '
+          f'client limit {client_rps} requests/s')
+    print(f'Former sequential loop with 5 s pause: about {1 / (latency + 5):.2f} items/s')
+
+    for batch_size in batch_sizes:
+        for concurrency in concurrencies:
+            stub = StubMistralClient(latency, server_rps)
+            api_clients.register_client('mistral', stub, key=process_llm.MISTRAL_API_KEY)
+            limiter = rate_limit.configure_default_limiter(requests_per_second=client_rps)
+            start = time.perf_counter()
+            results = process_llm.process_abbr_items_list(items, categories, batch_size=batch_size,
+                                                          max_concurrency=concurrency, use_cache=False,
+                                                          use_knn=False)
+            elapsed = time.perf_counter() - start
+            assert [result['product_abbr'] for result in results] == items
+            print(f'batch size {batch_size:>3}  concurrency {concurrency:>3}  {len(items) / elapsed:8.2f} items/s  '
+                  f'{elapsed:6.1f} s  requests {stub.calls:>4}  429 answers {limiter.stats["rate_limited"]:>3}')
+
+
+def bench_prompts(n_items, batch_size):
+    '''Prompt and completion tokens per item of the prompting modes, against the stub of the Mistral API.
+
+    The token counts are estimated from the prompt and answer lengths (about 4 characters per token).
+    '''
+    import process_llm
+
+    texts, _ = make_synthetic_receipt(n_items)
+    items = read_receipt.parse_text_annotations(texts).product_abbr.to_list()
+    categories = process_llm.get_rewe_categories()
+    print(f'{len(items)} items, taxonomy with {len(process_llm.load_rewe_categories())} main categories, '
+          f'{rate_limit.estimate_tokens(categories)} tokens')
+
+    modes = [('one request per item', dict(batch_size=1)),
+             (f'batches of {batch_size}', dict(batch_size=batch_size)),
+             ('two-stage per item', dict(batch_size=1, two_stage=True)),
+             (f'two-stage batches of {batch_size}', dict(batch_size=batch_size, two_stage=True))]
+    for label, options in modes:
+        api_clients.register_client('mistral', StubMistralClient(latency=0, server_rps=10**6),
+                                    key=process_llm.MISTRAL_API_KEY)
+        rate_limit.configure_default_limiter(requests_per_second=10**6, tokens_per_minute=10**9)
+        usage = dict.fromkeys(process_llm.token_usage, 0)
+        process_llm.process_abbr_items_list(items, categories, use_cache=False, use_knn=False, usage=usage,
+                                            **options)
+        print(f'{label:<28} {usage["prompt_tokens"] / len(items):8.0f} prompt tokens/item '
+              f'{usage["completion_tokens"] / len(items):6.0f} completion tokens/item {usage["requests"]:5} requests')
+
+def bench_embeddings(n_texts, latency, server_rps, chunk_sizes, concurrencies):
+    '''Throughput of process_llm.get_embeddings_by_chunks against the stub of the Mistral API, without cache.'''
+    import process_llm
+
+    rng = random.Random(42)
+    # catalog-like product strings of varying length
+    words = ['Bio', 'Vollmilch', 'Joghurt', 'Erdbeer', 'Hähnchen', 'Brustfilet', 'Spaghetti', 'Tomaten',
+             'passiert', 'Käse', 'Gouda', 'jung', 'Scheiben', 'Mineralwasser', 'Classic', 'Schokolade']
+    texts = [' '.join(rng.choices(words, k=rng.randint(3, 40))) + f' {i}' for i in range(n_texts)]
+    print(f'{len(texts)} texts, {sum(map(rate_limit.estimate_tokens, texts))} estimated tokens, '
+          f'stub latency {latency * 1000:.0f} ms, stub limit {server_rps} requests/s')
+
+    runs = [('fixed chunks of 50, sequential', dict(chunk_size=50, max_tokens=10**9, max_concurrency=1))]
+    runs += [(f'chunks <= {chunk_size} texts, concurrency {concurrency}',
+              dict(chunk_size=chunk_size, max_concurrency=concurrency))
+             for chunk_size in chunk_sizes for concurrency in concurrencies]
+    for label, options in runs:
+        stub = StubMistralClient(latency, server_rps)
+        api_clients.register_client('mistral', stub, key=process_llm.MISTRAL_API_KEY)
+        rate_limit.configure_default_limiter(requests_per_second=server_rps, tokens_per_minute=10**9)
+        start = time.perf_counter()
+        try:
+            vectors = process_llm.get_embeddings_by_chunks(texts, options.pop('chunk_size'), use_cache=False, **options)
+        except Exception as e:
+            print(f'{label:<38} failed: {e}')
+            continue
+        elapsed = time.perf_counter() - start
+        assert len(vectors) == len(texts)
+        print(f'{label:<38} {len(texts) / elapsed:9.1f} texts/s {elapsed:6.1f} s  requests {stub.calls:>4}')
+
+def bench_load(n_receipts, n_lines, concurrencies, endpoint=None, client_rps=50, **standin_config):
+    '''Items/s, latency percentiles and error rate of process_llm.process_receipt against the local stand-in.
+
+    Starts mistral_standin.py in a thread unless endpoint is given, the caches are not used.
+    '''
+    import process_llm
+
+    server = None
+    if endpoint is None:
+        server, endpoint = mistral_standin.start_in_thread(**standin_config)
+        print(f'Stand-in on {endpoint}: ' + ', '.join(f'{key} {value}' for key, value in standin_config.items()))
+    categories_file = process_llm.read_rewe_categories_file
+    try:
+        process_llm.get_rewe_categories()
+    except FileNotFoundError:
+        # the stand-in does not read the categories, they only count towards the estimated tokens
+        process_llm.read_rewe_categories_file = lambda: {'Sonstige Positionen': ['Kategorie nicht erkannt']}
+    receipts = []
+    for i in range(n_receipts):
+        texts, _ = make_synthetic_receipt(n_lines, seed=i)
+        receipts.append(read_receipt.parse_text_annotations(texts).assign(receipt_id=f'receipt_{i}'))
+    n_items = sum(len(receipt) for receipt in receipts)
+    print(f'{n_receipts} receipts with {n_items} items, client limit {client_rps} requests/s')
+    print(f'{"concurrency":>11} {"items/s":>8} {"p50 s":>7} {"p95 s":>7} {"p99 s":>7} '
+          f'{"receipt errors":>14} {"item errors":>11} {"429":>5} {"5xx":>5}')
+
+    def timed_receipt(receipt):
+        start = time.perf_counter()
+        try:
+            df = process_llm.process_receipt(receipt, use_cache=False)
+            failed_items = int(df['productName'].isna().sum()) if 'productName' in df else len(df)
+            error = False
+        except Exception as e:
+            print(f'{receipt.receipt_id.iloc[0]} failed: {e}')
+            failed_items, error = len(receipt), True
+        return time.perf_counter() - start, error, failed_items
+
+    try:
+        for concurrency in concurrencies:
+            api_clients.register_client('mistral',
+                                        api_clients.create_mistral_client(process_llm.MISTRAL_API_KEY, endpoint),
+                                        key=process_llm.MISTRAL_API_KEY)
+            rate_limit.configure_default_limiter(requests_per_second=client_rps, tokens_per_minute=10**9)
+            before = dict(server.RequestHandlerClass.config.stats) if server else None
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(timed_receipt, receipts))
+            elapsed = time.perf_counter() - start
+            latencies = np.array([latency for latency, _, _ in results])
+            receipt_errors = sum(error for _, error, _ in results) / len(results)
+            item_errors = sum(failed for _, _, failed in results) / n_items
+            if server:
+                stats = server.RequestHandlerClass.config.stats
+                served = f'{stats["rate_limited"] - before["rate_limited"]:5} {stats["errors"] - before["errors"]:5}'
+            else:
+                served = f'{"-":>5} {"-":>5}'
+            print(f'{concurrency:11} {n_items / elapsed:8.1f} {np.percentile(latencies, 50):7.2f} '
+                  f'{np.percentile(latencies, 95):7.2f} {np.percentile(latencies, 99):7.2f} '
+                  f'{receipt_errors:14.1%} {item_errors:11.1%} {served}')
+    finally:
+        process_llm.read_rewe_categories_file = categories_file
+        if server:
+            server.shutdown()
+
+def report_sizes(label, sizes):
+    print(f'  {label:<28} table {sizes["table_bytes"] / 2**20:8.1f} MiB   index {sizes["index_bytes"] / 2**20:8.1f} MiB   '
+          f'total {(sizes["table_bytes"] + sizes["index_bytes"]) / 2**20:8.1f} MiB')
+
+def bench_quantized(tables, storage, n_queries, k, build_index=False):
+    '''Recall@k and latency of the search on compact embeddings with re-ranking against the exact search.
+
+    The queries are embeddings of random rows of the table, needs the database. With build_index the
+    vector index is built on the full and then on the compact embeddings and the sizes of both are reported.
+    '''
+    import database as db
+
+    if storage == 'full':
+        raise SystemExit('Choose a compact storage to compare with the exact search: ' + ', '.join(db.COMPACT_STORAGE))
+    for table in tables:
+        print(f'{table}:')
+        if build_index:
+            db.create_vector_index(table, storage='full')
+            report_sizes('index on the full vectors', db.embedding_sizes(table))
+            db.create_vector_index(table, storage=storage)
+        report_sizes(f'index on {storage}' if build_index else 'current index', db.embedding_sizes(table))
+        with db.session() as cur:
+            cur.execute(f'SELECT embedding FROM {table} ORDER BY random() LIMIT %s', (n_queries,))
+            queries = [np.array(embedding) for (embedding,) in cur.fetchall()]
+
+        def run(cur, query_storage):
+            query = db.nearest_query(table, ['id'], query_storage)
+            ids, timings = [], []
+            for embedding in queries:
+                start = time.perf_counter()
+                cur.execute(query, db.nearest_params(embedding, k, query_storage))
+                ids.append({row_id for (row_id,) in cur.fetchall()})
+                timings.append((time.perf_counter() - start) * 1000)
+            return ids, np.array(timings)
+
+        with db.session() as cur:
+            # the baseline must not use the vector index
+            db.exact_search(cur)
+            exact_ids, exact_timings = run(cur, 'full')
+        with db.session() as cur:
+            # the index has to deliver all candidates of the re-ranking
+            db.tune_search(cur, k * db.RERANK_FACTOR)
+            compact_ids, compact_timings = run(cur, storage)
+        recall = np.mean([len(exact & compact) / max(1, len(exact)) for exact, compact in zip(exact_ids, compact_ids)])
+        print(f'  {len(queries)} queries, k={k}, {db.RERANK_FACTOR * k} candidates re-ranked, recall@{k} {recall:.3f}')
+        report('  exact search', exact_timings)
+        report(f'  {storage} + re-ranking', compact_timings)
+
+def clustered_embeddings(n, rng, n_clusters=50, dimension=1024, spread=0.5):
+    '''Normalized random vectors around n_clusters centers, closer to real embeddings than uniform noise.'''
+    centers = np.random.default_rng(0).standard_normal((n_clusters, dimension))
+    vectors = centers[rng.integers(0, n_clusters, n)] + spread * rng.standard_normal((n, dimension))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def bench_ann(sizes, methods, ef_searches, probes, n_queries, k, table='ann_bench'):
+    '''Latency and recall@k of the HNSW and IVFFlat index against the exact search as the table grows.
+
+    Fills a scratch table with clustered synthetic embeddings up to every size, builds the index
+    and searches with every ef_search (HNSW) or probes (IVFFlat) value. Needs the database.
+    '''
+    import database as db
+    from psycopg2 import sql
+    from psycopg2.extras import execute_values
+
+    rng = np.random.default_rng(42)
+    queries = clustered_embeddings(n_queries, rng)
+    query = db.nearest_query(table, ['id'], 'full')
+    with db.session() as cur:
+        cur.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(table)))
+        cur.execute(sql.SQL('CREATE TABLE {} (id bigserial primary key, embedding vector(1024))').format(sql.Identifier(table)))
+
+    def run(tune):
+        ids, timings = [], []
+        with db.session() as cur:
+            tune(cur)
+            for embedding in queries:
+                start = time.perf_counter()
+                cur.execute(query, db.nearest_params(embedding, k, 'full'))
+                ids.append({row_id for (row_id,) in cur.fetchall()})
+                timings.append((time.perf_counter() - start) * 1000)
+        return ids, np.array(timings)
+
+    n_rows = 0
+    try:
+        for size in sorted(sizes):
+            db.create_vector_index(table, 'none', 'full')
+            with db.session() as cur:
+                for start in range(n_rows, size, 1000):
+                    rows = clustered_embeddings(min(1000, size - start), rng)
+                    execute_values(cur, sql.SQL('INSERT INTO {} (embedding) VALUES %s').format(sql.Identifier(table)),
+                                   [(row,) for row in rows])
+                cur.execute(sql.SQL('ANALYZE {}').format(sql.Identifier(table)))
+            n_rows = size
+
+            print(f'{size} rows, {n_queries} queries, k={k}')
+            exact_ids, exact_timings = run(db.exact_search)
+            report('  exact search', exact_timings)
+            for method in methods:
+                db.create_vector_index(table, method, 'full')
+                for value in (ef_searches if method == 'hnsw' else probes):
+                    if method == 'hnsw':
+                        ids, timings = run(lambda cur: db.tune_search(cur, k, ef_search=value))
+                    else:
+                        ids, timings = run(lambda cur: db.tune_search(cur, k, probes=value))
+                    recall = np.mean([len(exact & found) / max(1, len(exact)) for exact, found in zip(exact_ids, ids)])
+                    name = f'ef_search={value}' if method == 'hnsw' else f'probes={value}'
+                    report(f'  {method} {name}', timings)
+                    print(f'{"":<30} recall@{k} {recall:.3f}')
+    finally:
+        with db.session() as cur:
+            cur.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(table)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Receipt contextualizer benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parse = subparsers.add_parser('parse', help='per receipt parse time of the OCR response')
+    parse.add_argument('--lines', type=int, default=30, help='number of product lines')
+    parse.add_argument('--repeat', type=int, default=100)
+
+    lines = subparsers.add_parser('lines', help='compare the line engines on distorted receipts')
+    lines.add_argument('--receipts', type=int, default=50, help='number of synthetic receipts')
+    lines.add_argument('--lines', type=int, default=30, help='number of product lines')
+    lines.add_argument('--recorded', help='directory with recorded Vision responses, see vision_replay.py')
+
+    grammar = subparsers.add_parser('grammar', help='per receipt time of the price and tax-code extraction')
+    grammar.add_argument('--receipts', type=int, default=20, help='number of synthetic receipts')
+    grammar.add_argument('--lines', type=int, default=30, help='number of product lines')
+    grammar.add_argument('--repeat', type=int, default=10)
+    grammar.add_argument('--recorded', help='directory with recorded Vision responses, see vision_replay.py')
+
+    stages = subparsers.add_parser('stages', help='per stage timings across the recorded fixtures')
+    stages.add_argument('--fixtures', default=vision_replay.FIXTURE_DIR, help='directory with the recorded fixtures')
+    stages.add_argument('--repeat', type=int, default=5)
+
+    imports = subparsers.add_parser('imports', help='check the import time of the pages against their budget')
+    imports.add_argument('--repeat', type=int, default=3)
+
+    clients = subparsers.add_parser('clients', help='latency of a new Mistral client per request vs. the shared client')
+    clients.add_argument('--calls', type=int, default=20)
+    clients.add_argument('--endpoint', help='other Mistral API endpoint, e.g. a local stand-in server')
+
+    augment = subparsers.add_parser('augment', help='throughput of the LLM augmentation against a stub of the API')
+    augment.add_argument('--items', type=int, default=100, help='number of product lines')
+    augment.add_argument('--latency', type=float, default=0.5, help='mean latency of the stub in s')
+    augment.add_argument('--server-rps', type=float, default=10, help='rate limit of the stub in requests/s')
+    augment.add_argument('--client-rps', type=float, default=20, help='rate limit of the client in requests/s')
+    augment.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 15])
+    augment.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+
+    prompts = subparsers.add_parser('prompts', help='tokens per item of the prompting modes against a stub of the API')
+    prompts.add_argument('--items', type=int, default=30, help='number of product lines')
+    prompts.add_argument('--batch-size', type=int, default=15)
+
+    embeddings = subparsers.add_parser('embeddings', help='throughput of the embedding dispatcher against a stub of the API')
+    embeddings.add_argument('--texts', type=int, default=2000, help='number of texts to embed')
+    embeddings.add_argument('--latency', type=float, default=0.3, help='mean latency of the stub in s')
+    embeddings.add_argument('--server-rps', type=float, default=10, help='rate limit of the stub in requests/s')
+    embeddings.add_argument('--chunk-sizes', type=int, nargs='+', default=[128])
+    embeddings.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+
+    load = subparsers.add_parser('load', help='items/s, latency and errors of process_receipt against the local stand-in')
+    load.add_argument('--receipts', type=int, default=40)
+    load.add_argument('--lines', type=int, default=20, help='number of product lines per receipt')
+    load.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    load.add_argument('--client-rps', type=float, default=50, help='rate limit of the client in requests/s')
+    load.add_argument('--endpoint', help='running stand-in or other endpoint instead of a stand-in in a thread')
+    load.add_argument('--latency', type=float, default=0.3, help='mean latency of the stand-in in s')
+    load.add_argument('--latency-dist', choices=mistral_standin.LATENCY_DISTRIBUTIONS, default='lognormal')
+    load.add_argument('--rate-limit', type=float, help='requests/s above which the stand-in answers 429')
+    load.add_argument('--error-rate', type=float, default=0.0, help='fraction of 5xx answers of the stand-in')
+
+    quantized = subparsers.add_parser('quantized', help='recall and latency of the compact embedding search, needs the database')
+    quantized.add_argument('--tables', nargs='+', default=['rewe', 'receipts'])
+    quantized.add_argument('--storage', default=os.getenv('EMBEDDING_STORAGE', 'halfvec'), help='halfvec or binary')
+    quantized.add_argument('--queries', type=int, default=50)
+    quantized.add_argument('--k', type=int, default=10)
+    quantized.add_argument('--build-index', action='store_true',
+                           help='build the vector index on the full and on the compact embeddings, compare their sizes')
+
+    ann = subparsers.add_parser('ann', help='latency and recall of the vector indexes against the exact search, needs the database')
+    ann.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 100000], help='rows of the scratch table')
+    ann.add_argument('--methods', nargs='+', choices=['hnsw', 'ivfflat'], default=['hnsw', 'ivfflat'])
+    ann.add_argument('--ef-search', type=int, nargs='+', default=[10, 40, 100, 200])
+    ann.add_argument('--probes', type=int, nargs='+', default=[1, 5, 10, 20])
+    ann.add_argument('--queries', type=int, default=50)
+    ann.add_argument('--k', type=int, default=10)
+
+    args = parser.parse_args()
+    if args.benchmark == 'parse':
+        bench_parse(args.lines, args.repeat)
+    elif args.benchmark == 'lines':
+        bench_lines(args.receipts, args.lines, args.recorded)
+    elif args.benchmark == 'grammar':
+        bench_grammar(args.receipts, args.lines, args.repeat, args.recorded)
+    elif args.benchmark == 'stages':
+        bench_stages(args.fixtures, args.repeat)
+    elif args.benchmark == 'imports':
+        sys.exit(0 if check_import_budget(args.repeat) else 1)
+    elif args.benchmark == 'clients':
+        bench_clients(args.calls, args.endpoint)
+    elif args.benchmark == 'augment':
+        bench_augment(args.items, args.latency, args.server_rps, args.client_rps, args.batch_sizes, args.concurrency)
+    elif args.benchmark == 'prompts':
+        bench_prompts(args.items, args.batch_size)
+    elif args.benchmark == 'embeddings':
+        bench_embeddings(args.texts, args.latency, args.server_rps, args.chunk_sizes, args.concurrency)
+    elif args.benchmark == 'quantized':
+        bench_quantized(args.tables, args.storage, args.queries, args.k, args.build_index)
+    elif args.benchmark == 'ann':
+        bench_ann(args.sizes, args.methods, args.ef_search, args.probes, args.queries, args.k)
+    elif args.benchmark == 'load':
+        standin_config = dict(latency=args.latency, latency_dist=args.latency_dist, rate_limit=args.rate_limit,
+                              error_rate=args.error_rate)
+        bench_load(args.receipts, args.lines, args.concurrency, args.endpoint, args.client_rps, **standin_config)
+
+if __name__=='__main__':
+    main()
@@ -1,40 +1,195 @@
-from venv import create
-import psycopg2
-from psycopg2.extras import execute_values
-from pgvector.psycopg2 import register_vector
-from psycopg2 import sql
+# psycopg2 and pgvector are imported in the functions that connect to the database,
+# so that importing this module on every page stays fast
+import os
+import threading
+import time
+from contextlib import contextmanager
 
 import pandas as pd
 import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Compact form of the embeddings the vector index is built on, the best candidates are re-ranked
+# with the full vectors: 'full' (index on the full vectors), 'halfvec' (16 bit floats, pgvector >= 0.7)
+# or 'binary' (1 bit per dimension, hamming distance, pgvector >= 0.7). Only the full vectors are
+# stored in the table, the compact form only exists in the expression index.
+EMBEDDING_STORAGE = os.getenv('EMBEDDING_STORAGE', 'full')
+# Candidates of the compact search per requested result that are re-ranked
+RERANK_FACTOR = int(os.getenv('RERANK_FACTOR', 10))
+
+# Expression of the compact embedding from a full vector and its distance operator,
+# the search orders by the same expression as the index so that postgres uses the index
+COMPACT_STORAGE = {
+    'halfvec': ('({}::halfvec(1024))', '<=>'),
+    'binary': ('(binary_quantize({})::bit(1024))', '<~>'),
+}
+# Approximate nearest neighbour index of the searched embeddings: 'hnsw', 'ivfflat' or 'none'
+VECTOR_INDEX = os.getenv('VECTOR_INDEX', 'hnsw')
+# HNSW build parameters and the default size of the candidate list per query (pgvector default 40)
+HNSW_M = int(os.getenv('HNSW_M', 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv('HNSW_EF_CONSTRUCTION', 64))
+HNSW_EF_SEARCH = int(os.getenv('HNSW_EF_SEARCH', 40))
+# Largest hnsw.ef_search pgvector accepts
+HNSW_EF_SEARCH_MAX = 1000
+# IVFFlat lists (0: rows / 1000, at least 10) and the default number of lists searched per query
+IVFFLAT_LISTS = int(os.getenv('IVFFLAT_LISTS', 0))
+IVFFLAT_PROBES = int(os.getenv('IVFFLAT_PROBES', 10))
+
+# Operator classes of the cosine (hamming for binary) distance by embedding storage
+INDEX_OPS = {'full': 'vector_cosine_ops', 'halfvec': 'halfvec_cosine_ops', 'binary': 'bit_hamming_ops'}
+# Columns of the tables as returned by data() and search()
+RECEIPTS_COLUMNS = ['id', 'receipt_id', 'price', 'product_abbr', 'product_name', 'category_main',
+                    'category_sub', 'embedding', 'receipt_date']
+REWE_COLUMNS = ['id', 'name', 'price', 'category', 'embedding']
 
-# TODO: Get connection string from venv
 # Database connection
+# Settings in the .env-file:
+#     DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD - connection (default localhost, 5432, receipts, postgres, postgres)
+#     DB_POOL_MIN - connections opened with the pool (default 1)
+#     DB_POOL_MAX - maximum number of open connections (default 10)
+#     DB_POOL_TIMEOUT - seconds to wait for a free connection before giving up (default 30)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+
+def connection_settings():
+    '''Returns the keyword arguments of psycopg2.connect from the environment.'''
+    return dict(
+        host=os.getenv('DB_HOST', 'localhost'),
+        port=int(os.getenv('DB_PORT', 5432)),
+        database=os.getenv('DB_NAME', 'receipts'),
+        user=os.getenv('DB_USER', 'postgres'),
+        password=os.getenv('DB_PASSWORD', 'postgres'),
+    )
+
+
+class ConnectionPool:
+    '''Thread-safe pool of postgres connections with the vector type registered.
+
+    Wraps psycopg2's ThreadedConnectionPool, which fails at once when all connections are
+    in use, with a semaphore so that callers wait up to timeout seconds for a free connection.
+    The metrics count the checkouts, the connections in use and opened and the wait times.
+    '''
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT, **settings):
+        from psycopg2.pool import ThreadedConnectionPool
+
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **(settings or connection_settings()))
+        # psycopg2 closes returned connections beyond minconn, keep up to maxconn open instead
+        # of reconnecting under load, only minconn are opened up front
+        self._pool.minconn = maxconn
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        # ids of the connections the vector type is registered with
+        self._registered = set()
+        self.stats = {'checkouts': 0, 'in_use': 0, 'connections_opened': 0, 'discarded': 0,
+                      'wait_ms_total': 0.0, 'wait_ms_max': 0.0, 'timeouts': 0}
+
+    def getconn(self):
+        '''Returns a free connection, waits up to timeout seconds for one.'''
+        from psycopg2.pool import PoolError
+        from pgvector.psycopg2 import register_vector
+
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats['timeouts'] += 1
+            raise PoolError(f'No free database connection after {self.timeout} s')
+        waited = (time.perf_counter() - start) * 1000
+        try:
+            conn = self._pool.getconn()
+            if id(conn) not in self._registered:
+                # Register the vector type with psycopg2, once per connection
+                register_vector(conn)
+                self._registered.add(id(conn))
+                with self._lock:
+                    self.stats['connections_opened'] += 1
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.stats['checkouts'] += 1
+            self.stats['in_use'] += 1
+            self.stats['wait_ms_total'] += waited
+            self.stats['wait_ms_max'] = max(self.stats['wait_ms_max'], waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        '''Returns a connection to the pool, close=True discards it (e.g. after the server closed it).'''
+        discard = close or bool(conn.closed)
+        try:
+            self._pool.putconn(conn, close=discard)
+        finally:
+            with self._lock:
+                self.stats['in_use'] -= 1
+                if discard:
+                    self.stats['discarded'] += 1
+                    self._registered.discard(id(conn))
+            self._slots.release()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['max_connections'] = self.maxconn
+        stats['wait_ms_mean'] = stats['wait_ms_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+    def close(self):
+        self._pool.closeall()
+
 
-def connect_cursor():
-    '''Connects to postgres, returns (connection, cursor)'''
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def default_pool():
+    '''Returns the process-wide connection pool, shared by all threads and Streamlit reruns.'''
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+    return _default_pool
+
+def pool_metrics():
+    '''Returns the metrics of the process-wide pool, empty if it was not used yet.'''
+    return _default_pool.metrics() if _default_pool is not None else {}
+
+@contextmanager
+def session():
+    '''Yields a cursor on a pooled connection.
+
+    Commits when the block ends, rolls back if it raises and returns the connection to the pool
+    in any case. Connections the server closed are discarded.
+    '''
+    import psycopg2
+
+    pool = default_pool()
+    conn = pool.getconn()
+    broken = False
     try:
-        conn = psycopg2.connect(
-            host="localhost",
-            database="receipts",
-            user="postgres",
-            password='postgres'
-        )
-        cur = conn.cursor()
-        # Register the vector type with psycopg2
-        register_vector(conn)
-    except:
-        print('Error connecting to database')
-    return (conn, cur)
+        with conn.cursor() as cur:
+            yield cur
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
 
 # Setup
 def setup_vector():
+    import psycopg2
+
+    # Without the pool, the vector type can only be registered once the extension exists
     try:
-        conn = psycopg2.connect(
-            host="localhost",
-            database="receipts",
-            user="postgres",
-            password='postgres'
-        )
+        conn = psycopg2.connect(**connection_settings())
         cur = conn.cursor()
         
         # Install pgvector
@@ -47,8 +202,6 @@ def setup_vector():
 def create_table(table):
     '''Create either receipts or rewe database'''
 
-    conn, cur = connect_cursor()
-
     if table == 'receipts':
         table_create_command = """
             CREATE TABLE receipts (
@@ -63,12 +216,6 @@ def create_table(table):
                         embedding vector(1024)
                         );
                         """
-        cur.execute(table_create_command)
-        cur.close()
-        conn.commit()
-        conn.close()
-        
-        print(f'Created table {table}')
     elif table == 'rewe':
         table_create_command = """
             CREATE TABLE rewe (
@@ -79,30 +226,27 @@ def create_table(table):
                         embedding vector(1024)
                         );
                         """
-        cur.execute(table_create_command)
-        cur.close()
-        conn.commit()
-        conn.close()
-
-        print(f'Created table {table}')
     else:
         print(f'Table format not found: choose either receipts/rewe')
-        conn.close()
+        return
+
+    with session() as cur:
+        cur.execute(table_create_command)
+    print(f'Created table {table}')
 
 def setup_rewe_table():
     '''Fills rewe table with store products, embeddings'''
-    conn, cur = connect_cursor()
+    from psycopg2.extras import execute_values
 
     df_rewe = pd.read_csv('data/name_embeds_incl_special_items_no_context.csv', index_col=0)
     data_list = [(row['name'], row['price'], row['category'], row['embeddings']) for _, row in df_rewe.iterrows()]
-    execute_values(cur, "INSERT INTO rewe (name, price, category, embedding) VALUES %s", data_list)
-    conn.commit()
-    conn.close()
+    with session() as cur:
+        execute_values(cur, "INSERT INTO rewe (name, price, category, embedding) VALUES %s", data_list)
 
 # Write to database
 def insert_receipt_data(processed_receipt_data):
     '''Writes a receipt df into receipts database.'''
-    conn, cur = connect_cursor()
+    from psycopg2.extras import execute_values
 
     # Prepare data to insert to psql
     data_list = [(
@@ -116,48 +260,92 @@ def insert_receipt_data(processed_receipt_data):
         np.array(row['embedding'])
         ) for _, row in processed_receipt_data.iterrows()]
     
-    # SQL query
-    execute_values(cur, "INSERT INTO receipts (receipt_id, receipt_date, price, product_abbr, \
-                   product_name, category_main, category_sub, embedding) VALUES %s", data_list)
-    conn.commit()
-    conn.close()
+    # SQL query, committed as a whole or not at all
+    with session() as cur:
+        execute_values(cur, "INSERT INTO receipts (receipt_id, receipt_date, price, product_abbr, \
+                       product_name, category_main, category_sub, embedding) VALUES %s", data_list)
     print('Wrote in database.')
 
 # Retrieve from database
-def data():
-    '''Returns all receipt data in database as DataFrame.'''
-    conn, cur = connect_cursor()
+def data(with_embeddings=True):
+    '''Returns all receipt data in database as DataFrame.
 
-    # SQL query
-    cur.execute("SELECT * FROM receipts;")
-    records = cur.fetchall()
-    conn.close()
+    with_embeddings=False leaves out the embedding column, the largest part of the table.
+    '''
+    # SQL query, the columns are listed so that the embeddings can be left out
+    columns = [column for column in RECEIPTS_COLUMNS if with_embeddings or column != 'embedding']
+    with session() as cur:
+        cur.execute(f"SELECT {', '.join(columns)} FROM receipts;")
+        records = cur.fetchall()
 
     # Format table with column names
-    column_names = [x.strip() for x in 'id_pk, receipt_id, price, product_abbr, \
-                    product_name, category_main, category_sub, embedding, receipt_date'.split(',')]
-    df = pd.DataFrame(records, columns=column_names)
+    df = pd.DataFrame(records, columns=['id_pk' if column == 'id' else column for column in columns])
 
     return df
 
 # Query database
-def search(query_embedding, n_closest, table):
-    '''Performs semantic search on user query either in receipts or rewe table.'''
-    conn, cur = connect_cursor()
+def tune_search(cur, limit, ef_search=None, probes=None):
+    '''Sets the index search parameters for the current transaction.
 
+    ef_search (HNSW) and probes (IVFFlat) trade recall for speed, None uses HNSW_EF_SEARCH and
+    IVFFLAT_PROBES. ef_search is raised to limit, HNSW returns at most ef_search rows
+    (at most HNSW_EF_SEARCH_MAX).
+    '''
+    ef_search = min(HNSW_EF_SEARCH_MAX, max(limit, ef_search or HNSW_EF_SEARCH))
+    cur.execute('SET LOCAL hnsw.ef_search = %s', (ef_search,))
+    cur.execute('SET LOCAL ivfflat.probes = %s', (probes or IVFFLAT_PROBES,))
+
+def exact_search(cur):
+    '''Disables the index scans for the current transaction, the search is exact.'''
+    cur.execute('SET LOCAL enable_indexscan = off')
+    cur.execute('SET LOCAL enable_bitmapscan = off')
+
+def nearest_query(table, columns, storage=EMBEDDING_STORAGE):
+    '''Returns the SQL of the nearest rows by cosine distance, parameters (query embedding, limit).
+
+    With a compact storage the candidates are found on the compact embeddings and re-ranked
+    with the full vectors, the query then takes the parameters
+    (query embedding, number of candidates, query embedding, limit), see nearest_params.
+    '''
+    from psycopg2 import sql
+
+    select = sql.SQL(', ').join(sql.SQL(column) for column in columns)
+    if storage == 'full':
+        return sql.SQL("SELECT {} FROM {} ORDER BY embedding <=> %s LIMIT %s").format(select, sql.Identifier(table))
+    if storage not in COMPACT_STORAGE:
+        raise ValueError(f'Unknown embedding storage {storage}, choose from full, {", ".join(COMPACT_STORAGE)}')
+    expression, operator = COMPACT_STORAGE[storage]
+    return sql.SQL(
+        "SELECT {} FROM (SELECT * FROM {} ORDER BY " + expression.format('embedding') + " " + operator + " "
+        + expression.format('%s::vector') + " LIMIT %s) AS candidates ORDER BY embedding <=> %s LIMIT %s"
+    ).format(select, sql.Identifier(table))
+
+def nearest_params(query_embedding, n_closest, storage=EMBEDDING_STORAGE):
+    '''Returns the parameters of nearest_query.'''
+    if storage == 'full':
+        return (query_embedding, n_closest)
+    return (query_embedding, n_closest * RERANK_FACTOR, query_embedding, n_closest)
+
+def search(query_embedding, n_closest, table, storage=EMBEDDING_STORAGE, ef_search=None, probes=None):
+    '''Performs semantic search on user query either in receipts or rewe table.
+
+    With a compact embedding storage (EMBEDDING_STORAGE) the search runs on the compact
+    embeddings and the best n_closest * RERANK_FACTOR candidates are re-ranked with the full vectors.
+    ef_search and probes tune the vector index of the table for this query, see tune_search.
+    '''
     # Format embedding str as array
     # Embedding function returns a list, get the first element of list
     query_embedding_array = np.array(query_embedding[0])
 
-    # KNN nearest neighbors by L2 distance <-> operator
-    # Also supports inner product (<#>) and cosine distance (<=>)
-
-    cur.execute(
-        sql.SQL("SELECT * FROM {} ORDER BY embedding <=> %s LIMIT %s")\
-            .format(sql.Identifier(table)), 
-            (query_embedding_array, n_closest))
-    records = cur.fetchall()
-    conn.close()
+    # KNN nearest neighbors by cosine distance <=> operator
+    # Also supports inner product (<#>) and L2 distance (<->)
+    columns = RECEIPTS_COLUMNS[:-1] if table == 'receipts' else REWE_COLUMNS
+    params = nearest_params(query_embedding_array, n_closest, storage)
+    with session() as cur:
+        # the index scan delivers the candidates, the first limit of the query
+        tune_search(cur, params[1], ef_search, probes)
+        cur.execute(nearest_query(table, columns, storage), params)
+        records = cur.fetchall()
 
     # Format results with column names
     if table == 'receipts':
@@ -169,13 +357,86 @@ def search(query_embedding, n_closest, table):
 
     return df
 
+def nearest_products(query_embeddings, n_closest, storage=EMBEDDING_STORAGE, ef_search=None, probes=None):
+    '''Returns the n_closest rewe products for every query embedding.
+
+    Returns:
+        list: one DataFrame per query with columns name, category, distance (cosine distance)
+    '''
+    query = nearest_query('rewe', ['name', 'category', 'embedding <=> %s AS distance'], storage)
+    results = []
+    with session() as cur:
+        tune_search(cur, nearest_params(None, n_closest, storage)[1], ef_search, probes)
+        for query_embedding in query_embeddings:
+            query_embedding_array = np.array(query_embedding)
+            cur.execute(query, (query_embedding_array,) + nearest_params(query_embedding_array, n_closest, storage))
+            results.append(pd.DataFrame(cur.fetchall(), columns=['name', 'category', 'distance']))
+
+    return results
+
+def create_vector_index(table, method=VECTOR_INDEX, storage=EMBEDDING_STORAGE):
+    '''(Re)creates the cosine distance index of the embeddings the search orders by.
+
+    With a compact storage the index is built on the compact expression of the embedding column
+    (COMPACT_STORAGE), the table itself only keeps the full vectors.
+    HNSW can be created on an empty table and is kept up to date by the inserts. IVFFlat learns
+    its lists from the rows in the table, rebuild it after the table has grown (python database.py index).
+    method 'none' only drops the index.
+    '''
+    from psycopg2 import sql
+
+    column = 'embedding' if storage == 'full' else COMPACT_STORAGE[storage][0].format('embedding')
+    index_name = f'{table}_embedding_idx'
+    with session() as cur:
+        cur.execute(sql.SQL('DROP INDEX IF EXISTS {}').format(sql.Identifier(index_name)))
+        # generated column of the compact embeddings of earlier versions, replaced by the expression index
+        cur.execute(sql.SQL('ALTER TABLE {} DROP COLUMN IF EXISTS embedding_compact').format(sql.Identifier(table)))
+        if method == 'none':
+            return
+        if method == 'hnsw':
+            options = sql.SQL('WITH (m = {}, ef_construction = {})').format(
+                sql.Literal(HNSW_M), sql.Literal(HNSW_EF_CONSTRUCTION))
+        elif method == 'ivfflat':
+            cur.execute(sql.SQL('SELECT count(*) FROM {}').format(sql.Identifier(table)))
+            (n_rows,) = cur.fetchone()
+            lists = IVFFLAT_LISTS or max(10, n_rows // 1000)
+            options = sql.SQL('WITH (lists = {})').format(sql.Literal(lists))
+        else:
+            raise ValueError(f'Unknown vector index {method}, choose from hnsw, ivfflat, none')
+        start = time.perf_counter()
+        cur.execute(sql.SQL('CREATE INDEX {} ON {} USING ' + method + ' ({} ' + INDEX_OPS[storage] + ') {}').format(
+            sql.Identifier(index_name), sql.Identifier(table), sql.SQL(column), options))
+    print(f'Created {method} index on {table}.{column} in {time.perf_counter() - start:.1f} s')
+
+def vector_indexes():
+    '''Returns the vector indexes of the tables with their definition and size.'''
+    with session() as cur:
+        cur.execute("""
+            SELECT tablename, indexname, indexdef, pg_size_pretty(pg_relation_size(indexname::regclass))
+            FROM pg_indexes WHERE indexdef ~ '(hnsw|ivfflat)'""")
+        return pd.DataFrame(cur.fetchall(), columns=['table', 'index', 'definition', 'size'])
+
+def embedding_sizes(table):
+    '''Returns the average stored bytes per row of the embeddings, the size of the table (with TOAST)
+    and the size of its vector index in bytes.'''
+    from psycopg2 import sql
+
+    with session() as cur:
+        cur.execute(sql.SQL(
+            "SELECT avg(pg_column_size(embedding)), pg_table_size(%s), "
+            "coalesce(pg_relation_size(to_regclass(%s)), 0) FROM {}").format(sql.Identifier(table)),
+            (table, f'{table}_embedding_idx'))
+        embedding, table_bytes, index_bytes = cur.fetchone()
+    return {'embedding_bytes': float(embedding or 0), 'table_bytes': int(table_bytes), 'index_bytes': int(index_bytes)}
+
 def setup():
     '''Run setup
     
     Installs vector extension to postgres
     Sets up receipts table
     Sets up rewe table
-    Fill rewe table with products and embeddings'''
+    Fill rewe table with products and embeddings
+    Creates the vector indexes'''
 
     # Install pgvector
     setup_vector()
@@ -189,8 +450,27 @@ def setup():
     # Fill in rewe table
     setup_rewe_table()
 
+    # Vector indexes, after the rewe table is filled, on the compact embeddings of EMBEDDING_STORAGE
+    for table in ['receipts', 'rewe']:
+        create_vector_index(table)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Set up the database or rebuild its vector indexes')
+    parser.add_argument('command', nargs='?', choices=['setup', 'index'], default='setup',
+                        help='set up extension, tables and rewe products, or rebuild the vector indexes (VECTOR_INDEX)')
+    args = parser.parse_args()
+
+    if args.command == 'setup':
+        setup()
+    else:
+        for table in ['receipts', 'rewe']:
+            create_vector_index(table)
+        print(vector_indexes().to_string(index=False))
 
 if __name__=='__main__':    
-    setup()
+    main()
 
 
@@ -0,0 +1,96 @@
+'''
+Persistent cache of Mistral embeddings
+
+Stores the float32 embedding vector per (model, text) in a SQLite file, keyed by the hash of
+the text. Repeated product strings of the ingest and repeated search phrases are embedded
+only once. The least recently used vectors are evicted above EMBEDDING_CACHE_MAX_ENTRIES.
+'''
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', os.path.join('.cache', 'embeddings.sqlite'))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', 200000))
+
+
+def text_key(text, model):
+    '''Returns the cache key of text embedded with model.'''
+    return hashlib.sha256(f'{model}\0{text}'.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    '''SQLite store of float32 vectors by hash of (model, text) with LRU eviction.'''
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key text PRIMARY KEY,
+                model text,
+                vector blob,
+                used_at real
+            )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)')
+        self._conn.commit()
+
+    def get_many(self, texts, model):
+        '''Returns the cached vectors of texts as {text: float32 array}, texts without entry are left out.'''
+        keys = {text_key(text, model): text for text in texts}
+        found = {}
+        with self._lock:
+            # stay below the maximum number of SQL variables
+            key_list = list(keys)
+            for i in range(0, len(key_list), 500):
+                part = key_list[i : i + 500]
+                for key, vector in self._conn.execute(
+                        f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(part))})', part):
+                    found[keys[key]] = np.frombuffer(vector, dtype=np.float32)
+            self._conn.executemany('UPDATE embeddings SET used_at = ? WHERE key = ?',
+                                   [(time.time(), text_key(text, model)) for text in found])
+            self._conn.commit()
+        return found
+
+    def put_many(self, texts, vectors, model):
+        rows = [(text_key(text, model), model, np.asarray(vector, dtype=np.float32).tobytes(), time.time())
+                for text, vector in zip(texts, vectors)]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+            (n_entries,) = self._conn.execute('SELECT count(*) FROM embeddings').fetchone()
+            if n_entries > self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM embeddings WHERE key IN '
+                    '(SELECT key FROM embeddings ORDER BY used_at LIMIT ?)', (n_entries - self.max_entries,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM embeddings')
+            self._conn.commit()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def default_cache():
+    '''Returns the process-wide embedding cache, or None if it is disabled (EMBEDDING_CACHE_MAX_ENTRIES=0).'''
+    global _default_cache
+    if EMBEDDING_CACHE_MAX_ENTRIES <= 0:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+    return _default_cache
@@ -38,7 +38,7 @@ st.sidebar.page_link('pages/visualization.py', label='Explainer', icon='🤯')
 st.sidebar.divider()
 
 #Get receipts data from database
-df = db.data()
+df = db.data(with_embeddings=False)
 column_names = {
     'id_pk':'ID',
     'receipt_id':'Receipt',
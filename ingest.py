@@ -0,0 +1,234 @@
+'''
+Headless batch ingest of receipt images into the database
+
+Streams the receipts of a directory through the same steps as the upload page:
+OCR (read_receipt) -> LLM augmentation (process_llm) -> embeddings (process_llm) -> database.
+The stages run in their own worker threads and are connected by bounded queues.
+Every finished stage is written to a checkpoint file, an interrupted run continues
+where it stopped without repeating paid API calls.
+
+Run as script, e.g.:
+    python ingest.py receipts/ --checkpoint ingest_checkpoint.jsonl --ocr-workers 4 --llm-workers 2
+'''
+
+import argparse
+import io
+import json
+import os
+import queue
+import threading
+import time
+
+import pandas as pd
+
+import api_clients
+import database as db
+import process_llm as llm
+import read_receipt
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.pcx', '.tif')
+STAGES = ['ocr', 'llm', 'embed', 'db']
+# Columns added by the llm stage
+AUGMENTED_COLUMNS = ['productName', 'categoryMain', 'categorySub']
+# Marks the end of the stream in a queue
+STOP = None
+
+
+# Checkpoint
+class Checkpoint:
+    '''Append-only JSON lines file with the results of every finished stage per receipt.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self):
+        '''Returns the last finished stage and its data per receipt: {receipt: (stage, data)}.'''
+        progress = {}
+        if not os.path.exists(self.path):
+            return progress
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line can be incomplete if the run was killed while writing
+                    continue
+                if entry['stage'] in STAGES:
+                    progress[entry['receipt']] = (entry['stage'], entry.get('data'))
+        return progress
+
+    def write(self, receipt, stage, data=None, **extra):
+        entry = dict(receipt=receipt, stage=stage, data=data, time=time.time(), **extra)
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def df_to_records(df):
+    return json.loads(df.to_json(orient='records', date_format='iso'))
+
+def records_to_df(records):
+    df = pd.DataFrame(records)
+    if 'date' in df:
+        df['date'] = pd.to_datetime(df['date']).dt.date
+    return df
+
+
+# Stage functions, take and return the dataframe of one receipt
+def ocr_stage(job, categories):
+    with open(job['path'], 'rb') as f:
+        receipt_file = io.BytesIO(f.read())
+    receipt_file.name = job['receipt']
+    df_sorted, _ = read_receipt.process_receipt(receipt_file)
+    return df_sorted
+
+def llm_stage(job, categories):
+    df = job['df']
+    response_list = llm.process_abbr_items_list(df.product_abbr.to_list(), categories)
+    # Make sure the columns exist even if no item could be augmented
+    response_df = pd.DataFrame(response_list).reindex(columns=['product_abbr'] + AUGMENTED_COLUMNS)
+    df = df.join(response_df.drop('product_abbr', axis=1))
+    # like the upload page, do not save a receipt with unresolved items, a rerun requests them again
+    # (the answered items are in the abbreviation cache)
+    unresolved = df.productName.isna().sum()
+    if unresolved:
+        raise ValueError(f'{unresolved} item(s) could not be contextualized')
+    return df
+
+def embed_stage(job, categories):
+    return llm.embed_augmented_data(job['df'].copy())
+
+def db_stage(job, categories):
+    db.insert_receipt_data(job['df'])
+    return job['df']
+
+STAGE_FUNCTIONS = {
+    'ocr': ocr_stage,
+    'llm': llm_stage,
+    'embed': embed_stage,
+    'db': db_stage,
+}
+
+
+# Pipeline
+def stage_worker(stage, in_queue, out_queue, checkpoint, categories):
+    '''Processes the jobs of in_queue with the stage function and passes them on to out_queue.'''
+    while True:
+        job = in_queue.get()
+        if job is STOP:
+            # let the other workers of this stage stop as well
+            in_queue.put(STOP)
+            return
+        if job['done'] >= STAGES.index(stage) and job['df'] is not None or job['failed']:
+            # already processed in an earlier run, or failed in a stage before
+            out_queue.put(job)
+            continue
+
+        start = time.perf_counter()
+        try:
+            job['df'] = STAGE_FUNCTIONS[stage](job, categories)
+        except Exception as e:
+            print(f'[{stage}] {job["receipt"]} failed: {e}', flush=True)
+            checkpoint.write(job['receipt'], 'error', failed_stage=stage, error=str(e))
+            job['failed'] = True
+        else:
+            job['done'] = STAGES.index(stage)
+            data = None if stage == 'db' else df_to_records(job['df'])
+            checkpoint.write(job['receipt'], stage, data)
+            print(f'[{stage}] {job["receipt"]} done in {time.perf_counter() - start:.1f} s', flush=True)
+        out_queue.put(job)
+
+def run_stage(stage, workers, in_queue, out_queue, checkpoint, categories):
+    '''Starts the worker threads of a stage, out_queue is closed once all workers stopped.'''
+    threads = [threading.Thread(target=stage_worker, name=f'{stage}-{i}', daemon=True,
+                                args=(stage, in_queue, out_queue, checkpoint, categories))
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    def close():
+        for thread in threads:
+            thread.join()
+        out_queue.put(STOP)
+    closer = threading.Thread(target=close, name=f'{stage}-close', daemon=True)
+    closer.start()
+    return closer
+
+def ingest(image_dir, checkpoint_path, workers, queue_size=8):
+    '''Ingests all receipt images of image_dir, see module docstring.
+
+    workers - dict with the number of worker threads per stage
+    '''
+    checkpoint = Checkpoint(checkpoint_path)
+    progress = checkpoint.load()
+    categories = llm.get_rewe_categories()
+    summary = {'ingested': 0, 'skipped': 0, 'failed': 0}
+
+    # bounded queues between the stages, the last one collects the finished jobs
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(STAGES) + 1)]
+    closers = [run_stage(stage, workers[stage], queues[i], queues[i + 1], checkpoint, categories)
+               for i, stage in enumerate(STAGES)]
+
+    def produce():
+        for filename in sorted(os.listdir(image_dir)):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            stage, data = progress.get(filename, (None, None))
+            if stage == 'db':
+                summary['skipped'] += 1
+                continue
+            df = records_to_df(data) if data is not None else None
+            if stage in ('llm', 'embed') and df['productName'].isna().any():
+                # checkpointed with unresolved items by an earlier version, request them again
+                stage, df = 'ocr', df.drop(columns=AUGMENTED_COLUMNS + ['embedding'], errors='ignore')
+            queues[0].put({
+                'receipt': filename,
+                'path': os.path.join(image_dir, filename),
+                'done': STAGES.index(stage) if stage else -1,
+                'df': df,
+                'failed': False,
+            })
+        queues[0].put(STOP)
+    threading.Thread(target=produce, name='producer', daemon=True).start()
+
+    # collect the finished jobs, only this thread counts them (skipped is only counted by the producer)
+    while True:
+        job = queues[-1].get()
+        if job is STOP:
+            break
+        summary['failed' if job['failed'] else 'ingested'] += 1
+    for closer in closers:
+        closer.join()
+
+    print(f'Ingested {summary["ingested"]} receipt(s), skipped {summary["skipped"]} already ingested, '
+          f'{summary["failed"]} failed (rerun to retry).')
+    for name, metrics in api_clients.client_metrics().items():
+        print(f'{name} API: {metrics["requests"]} requests ({metrics["errors"]} errors) over '
+              f'{metrics["connections_opened"]} connection(s), mean {metrics["mean_ms"]:.0f} ms')
+    pool = db.pool_metrics()
+    if pool:
+        print(f'Database: {pool["checkouts"]} sessions over {pool["connections_opened"]} connection(s), '
+              f'mean wait {pool["wait_ms_mean"]:.1f} ms, max wait {pool["wait_ms_max"]:.0f} ms')
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest a directory of receipt images into the database')
+    parser.add_argument('image_dir', help='directory with receipt images')
+    parser.add_argument('--checkpoint', default='ingest_checkpoint.jsonl',
+                        help='checkpoint file to resume an interrupted run')
+    parser.add_argument('--queue-size', type=int, default=8, help='maximum number of receipts between two stages')
+    for stage, default in zip(STAGES, [4, 1, 1, 1]):
+        parser.add_argument(f'--{stage}-workers', type=int, default=default,
+                            help=f'number of concurrent workers of the {stage} stage (default {default})')
+    args = parser.parse_args()
+
+    workers = {stage: getattr(args, f'{stage}_workers') for stage in STAGES}
+    ingest(args.image_dir, args.checkpoint, workers, args.queue_size)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,130 @@
+'''
+Embedding based kNN classifier of receipt abbreviations on the rewe catalog
+
+Fast path before the LLM: the abbreviation is embedded and its k nearest products of the
+rewe table vote for the main category, weighted with their cosine similarity. If the vote
+is confident enough the item gets the name of the nearest product of that category and the
+subcategory whose name embedding is closest to the item. Only the other items go to the LLM.
+The rewe table stores the main category of the products only, therefore the subcategory is
+chosen by the embedding of the subcategory names.
+
+Settings in the .env-file:
+    KNN_K - number of neighbours (default 5)
+    KNN_MIN_CONFIDENCE - minimum share of the vote for the main category (default 0.8)
+    KNN_MAX_DISTANCE - maximum cosine distance of the nearest product (default 0.25)
+
+Run as script to compare the classifier with the LLM answers stored in the receipts table:
+    python knn_classifier.py --k 5 --thresholds 0.6 0.7 0.8 0.9
+'''
+
+import argparse
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+import database as db
+import process_llm as llm
+
+load_dotenv()
+
+KNN_K = int(os.getenv('KNN_K', 5))
+KNN_MIN_CONFIDENCE = float(os.getenv('KNN_MIN_CONFIDENCE', 0.8))
+KNN_MAX_DISTANCE = float(os.getenv('KNN_MAX_DISTANCE', 0.25))
+
+
+def neighbour_vote(neighbours):
+    '''Weighted vote of the neighbours (DataFrame name, category, distance sorted by distance).
+
+    Returns:
+        tuple: main category, share of the vote, name of the nearest product of the category,
+            distance of the nearest product
+    '''
+    weights = (1 - neighbours.distance).clip(lower=0)
+    votes = weights.groupby(neighbours.category).sum()
+    if votes.sum() <= 0:
+        return None, 0.0, None, 1.0
+    category_main = votes.idxmax()
+    name = neighbours[neighbours.category == category_main].name.iloc[0]
+    return category_main, votes.max() / votes.sum(), name, neighbours.distance.min()
+
+def subcategory_embeddings(categories):
+    '''Returns {main category: (list of subcategories, matrix of their normalized embeddings)}.'''
+    texts = [f'{main} {sub}' for main, subs in categories.items() for sub in subs]
+    # cached in the embedding cache, computed only once
+    vectors = np.asarray(llm.get_embeddings_by_chunks(texts, llm.EMBEDDING_MAX_BATCH_SIZE), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    result, start = {}, 0
+    for main, subs in categories.items():
+        result[main] = (subs, vectors[start : start + len(subs)])
+        start += len(subs)
+    return result
+
+def classify_embeddings(items, embeddings, neighbours, sub_embeddings,
+                        min_confidence=KNN_MIN_CONFIDENCE, max_distance=KNN_MAX_DISTANCE):
+    '''Classifies the items from their embeddings and the nearest rewe products.
+
+    Returns:
+        list: item json for the confidently classified items, None for the others
+    '''
+    results = []
+    for item, embedding, item_neighbours in zip(items, embeddings, neighbours):
+        category_main, confidence, name, distance = neighbour_vote(item_neighbours)
+        if confidence < min_confidence or distance > max_distance or category_main not in sub_embeddings:
+            results.append(None)
+            continue
+        subs, sub_vectors = sub_embeddings[category_main]
+        category_sub = subs[int(np.argmax(sub_vectors @ np.asarray(embedding, dtype=np.float32)))]
+        results.append({'productName': name, 'categoryMain': category_main, 'categorySub': category_sub,
+                        'product_abbr': item})
+    return results
+
+def classify(items, k=KNN_K, min_confidence=KNN_MIN_CONFIDENCE, max_distance=KNN_MAX_DISTANCE):
+    '''Classifies the items with the k nearest rewe products, see module docstring.
+
+    Returns:
+        list: item json for the confidently classified items, None for the others
+    '''
+    if not items:
+        return []
+    embeddings = llm.get_embeddings_by_chunks(items, llm.EMBEDDING_MAX_BATCH_SIZE)
+    neighbours = db.nearest_products(embeddings, k)
+    sub_embeddings = subcategory_embeddings(llm.load_rewe_categories())
+    results = classify_embeddings(items, embeddings, neighbours, sub_embeddings, min_confidence, max_distance)
+    print(f'kNN classifier resolved {sum(r is not None for r in results)} of {len(items)} items')
+    return results
+
+
+def evaluate(k, thresholds, max_distance=KNN_MAX_DISTANCE):
+    '''Compares the classifier with the LLM answers in the receipts table for several confidence thresholds.'''
+    labelled = db.data(with_embeddings=False).dropna(subset=['product_abbr', 'category_main', 'category_sub'])
+    labelled = labelled.drop_duplicates('product_abbr')
+    items = labelled.product_abbr.to_list()
+    print(f'{len(items)} labelled abbreviations, k={k}, maximum distance {max_distance}')
+
+    embeddings = llm.get_embeddings_by_chunks(items, llm.EMBEDDING_MAX_BATCH_SIZE)
+    neighbours = db.nearest_products(embeddings, k)
+    sub_embeddings = subcategory_embeddings(llm.load_rewe_categories())
+
+    print(f'{"threshold":>9} {"resolved":>9} {"main agrees":>12} {"sub agrees":>11}')
+    for threshold in thresholds:
+        results = classify_embeddings(items, embeddings, neighbours, sub_embeddings, threshold, max_distance)
+        resolved = [(result, label) for result, label in zip(results, labelled.itertuples()) if result is not None]
+        main_agrees = np.mean([r['categoryMain'] == l.category_main for r, l in resolved]) if resolved else np.nan
+        sub_agrees = np.mean([r['categorySub'] == l.category_sub for r, l in resolved]) if resolved else np.nan
+        print(f'{threshold:9.2f} {len(resolved) / len(items):9.1%} {main_agrees:12.1%} {sub_agrees:11.1%}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the kNN classifier with the LLM answers in the receipts table')
+    parser.add_argument('--k', type=int, default=KNN_K, help='number of neighbours')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.6, 0.7, 0.8, 0.9],
+                        help='minimum shares of the vote to compare')
+    parser.add_argument('--max-distance', type=float, default=KNN_MAX_DISTANCE,
+                        help='maximum cosine distance of the nearest product')
+    args = parser.parse_args()
+
+    evaluate(args.k, args.thresholds, args.max_distance)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,150 @@
+'''
+Groups the word bounding boxes of the Vision response into the lines of a receipt
+
+Engines:
+    sweep      - sorted sweep over the deskewed box y-intervals (default)
+    relextrema - the original heuristic based on scipy.signal.argrelmin/argrelmax
+'''
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def box_geometry(tokens):
+    '''Returns center x, center y, height and slope of every box in the token table.
+
+    The corners are stored in the order Vision returns the vertices (around the polygon),
+    so the first two corners span the reading direction of the word.
+    '''
+    x = np.stack([tokens[c] for c in ['x_bl', 'x_br', 'x_tr', 'x_tl']], axis=1).astype(np.float64)
+    y = np.stack([tokens[c] for c in ['y_bl', 'y_br', 'y_tr', 'y_tl']], axis=1).astype(np.float64)
+
+    x_center = x.mean(axis=1)
+    y_center = y.mean(axis=1)
+    # distance between the two edges along the reading direction
+    height = (np.abs(y[:, 3] - y[:, 0]) + np.abs(y[:, 2] - y[:, 1])) / 2
+    # slope of the edges along the reading direction
+    dx = (x[:, 1] - x[:, 0]) + (x[:, 2] - x[:, 3])
+    dy = (y[:, 1] - y[:, 0]) + (y[:, 2] - y[:, 3])
+    slope = np.divide(dy, dx, out=np.zeros_like(dy), where=dx != 0)
+
+    return x_center, y_center, height, slope
+
+def local_skew(y_center, slope, window=15):
+    '''Estimates the skew at every box as the median slope of its neighbours in y direction.
+
+    Tilted photos have one global skew, curled or photographed-in-perspective receipts
+    a skew that changes from top to bottom; the rolling median follows both and ignores
+    single boxes with a wrong angle.
+    '''
+    n_tokens = slope.shape[0]
+    window = min(window, n_tokens)
+    if window < 2:
+        return slope.copy()
+
+    order = np.argsort(y_center, kind='stable')
+    padded = np.pad(slope[order], (window // 2, window - 1 - window // 2), mode='edge')
+    smoothed = np.median(sliding_window_view(padded, window), axis=1)
+
+    skew = np.empty(n_tokens)
+    skew[order] = smoothed
+    return skew
+
+def cluster_lines(tokens, tolerance=0.5, window=15):
+    '''Groups the boxes of the token table into lines with a sorted sweep, O(n log n).
+
+    Every box is projected along the local skew to a common reference x position. The boxes
+    are then swept in order of their projected y position: a box joins the current line while
+    its projected y lies within tolerance * box height of the line, otherwise it starts a new line.
+
+    tokens - token table as built by read_receipt.build_token_table
+    tolerance - allowed distance to the line in multiples of the box height
+    window - number of neighbouring boxes for the local skew estimation
+
+    Returns an integer array with the line id of each token (in input order), line ids
+    increase from top to bottom.
+    '''
+    n_tokens = tokens.shape[0]
+    lines = np.zeros(n_tokens, dtype=np.int64)
+    if n_tokens == 0:
+        return lines
+
+    x_center, y_center, height, slope = box_geometry(tokens)
+    skew = local_skew(y_center, slope, window)
+
+    # deskew: project the box centers to the median x position of the receipt
+    x_ref = np.median(x_center)
+    y_proj = y_center - skew * (x_center - x_ref)
+
+    # sweep over the projected positions from top to bottom
+    order = np.argsort(y_proj, kind='stable')
+    line = 0
+    line_y = y_proj[order[0]]
+    line_height = height[order[0]]
+    line_size = 1
+    for ind in order[1:]:
+        if abs(y_proj[ind] - line_y) > tolerance * max(height[ind], line_height):
+            # start a new line
+            line += 1
+            line_y, line_height, line_size = y_proj[ind], height[ind], 1
+        else:
+            # update the running mean position and height of the current line
+            line_size += 1
+            line_y += (y_proj[ind] - line_y) / line_size
+            line_height += (height[ind] - line_height) / line_size
+        lines[ind] = line
+
+    return lines
+
+def label_lines_relextrema(tokens):
+    '''Labels the lines with the original heuristic based on local extrema of the mean y position.
+
+    tokens - token table sorted by mean_y in ascending order
+
+    Returns an integer array with the line id of each token.
+    '''
+    # scipy is only needed by this engine, import it here to keep the import of the module fast
+    from scipy.signal import argrelmin, argrelmax
+
+    mean_y = tokens['mean_y']
+    # for matching the bounding boxes to lines on the receipt we do the following:
+    # 1) the mean y position increases stepwise (resembling stairs when plotted)
+    #   - calculate the approximate slope using the min and may y position values
+    # 2) subtract this slope from the stepwise increasing mean y positions
+    #  - in this way you get a spiky signal (when plotted), where each maximum (index)
+    #    indicates the beginning of a line and the following minimum (index)
+    #    indicates the end of a line
+    n_tokens = mean_y.shape[0]
+    x = np.linspace(1, n_tokens, num=n_tokens)
+    slope = (mean_y.max()-mean_y.min())/n_tokens # 1)
+    y_flat = mean_y - slope*x - mean_y.min() # 2)
+
+    # for local maxima
+    max_ind = argrelmax(y_flat)[0]
+    max_ind = np.append(0, max_ind[:-1])
+    # for local minima
+    min_ind = argrelmin(y_flat)[0]
+
+    # label the tokens with the corresponding lines on the receipt
+    lines = np.zeros(n_tokens, dtype=np.int64)
+    n_lines = min(len(max_ind), len(min_ind))
+    for i in range(n_lines):
+        lines[max_ind[i]:min_ind[i]+1] = i
+    if n_lines:
+        lines[min_ind[n_lines-1]+1:] = n_lines # make sure the last line gets labeled as well
+
+    return lines
+
+
+LINE_ENGINES = {
+    'sweep': cluster_lines,
+    'relextrema': label_lines_relextrema,
+}
+
+def assign_lines(tokens, engine='sweep'):
+    '''Returns the line ids of the tokens using the selected line engine.'''
+    try:
+        line_engine = LINE_ENGINES[engine]
+    except KeyError:
+        raise ValueError(f'Line engine {engine} not found: choose one of {", ".join(LINE_ENGINES)}')
+    return line_engine(tokens)
@@ -0,0 +1,101 @@
+'''
+Parsing and repair of the JSON answers of the model
+
+The model does not always answer valid JSON: the answer is wrapped in code fences or text,
+has trailing commas, typographic quotes or Python literals, uses other keys (category_main
+instead of categoryMain) or imitates the "productName: …, categoryMain: …" style of the
+examples in the prompt. loads_repaired() tries these repairs locally before the answer has
+to be requested again.
+'''
+
+import ast
+import json
+import re
+
+# Keys of the answer by their lower case spelling without separators
+KEY_ALIASES = {
+    'productname': 'productName',
+    'name': 'productName',
+    'produktname': 'productName',
+    'fullname': 'productName',
+    'categorymain': 'categoryMain',
+    'maincategory': 'categoryMain',
+    'hauptkategorie': 'categoryMain',
+    'categorysub': 'categorySub',
+    'subcategory': 'categorySub',
+    'unterkategorie': 'categorySub',
+    'index': 'index',
+    'productabbr': 'product_abbr',
+}
+
+CODE_FENCE = re.compile(r'```(?:json)?\s*(.*?)```', re.DOTALL | re.IGNORECASE)
+TRAILING_COMMA = re.compile(r',\s*([\]}])')
+# "productName: Granatapfel, categoryMain: Obst & Gemüse, categorySub: Frisches Obst"
+KEY_VALUE = re.compile(r'(product_?name|category_?main|category_?sub)\s*:\s*(.+?)\s*(?=,\s*\w+\s*:|$|\n)',
+                       re.IGNORECASE)
+
+
+def canonical_key(key):
+    return KEY_ALIASES.get(re.sub(r'[\s_\-]', '', str(key)).lower(), key)
+
+def normalize_keys(answer):
+    '''Renames the keys of the answer (dict or list of dicts) to the expected spelling.'''
+    if isinstance(answer, list):
+        return [normalize_keys(entry) for entry in answer]
+    if isinstance(answer, dict):
+        return {canonical_key(key): value.strip() if isinstance(value, str) else value
+                for key, value in answer.items()}
+    return answer
+
+def extract_json(text):
+    '''Returns the outermost JSON array or object in text, the text itself if there is none.'''
+    starts = [i for i in (text.find('['), text.find('{')) if i != -1]
+    if not starts:
+        return text
+    start = min(starts)
+    end = text.rfind(']' if text[start] == '[' else '}')
+    return text[start:end + 1] if end > start else text
+
+def parse_key_values(text):
+    '''Parses answers in the "productName: …, categoryMain: …, categorySub: …" style, one per line.'''
+    answers = []
+    for line in text.splitlines():
+        fields = {canonical_key(key): value.strip(' "\'') for key, value in KEY_VALUE.findall(line)}
+        if fields:
+            answers.append(fields)
+    if not answers:
+        raise ValueError('No key-value pairs found')
+    return answers[0] if len(answers) == 1 else answers
+
+def candidates(message):
+    '''Yields repaired versions of the message, from the least to the most invasive repair.'''
+    yield message
+    fenced = CODE_FENCE.search(message)
+    text = fenced.group(1) if fenced else message
+    text = extract_json(text.strip())
+    yield text
+    text = text.replace('“', '"').replace('”', '"').replace('„', '"')
+    text = TRAILING_COMMA.sub(r'\1', text)
+    yield text
+
+def loads_repaired(message):
+    '''Parses the answer of the model, repairs it if necessary.
+
+    Returns:
+        dict or list: the answer with normalized keys
+    Raises:
+        ValueError: if no repair gives a valid answer
+    '''
+    for candidate in candidates(message):
+        try:
+            return normalize_keys(json.loads(candidate))
+        except (json.JSONDecodeError, TypeError):
+            pass
+    # Python literals with single quotes, True/None
+    try:
+        answer = ast.literal_eval(candidate)
+        if isinstance(answer, (dict, list)):
+            return normalize_keys(answer)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        pass
+    return parse_key_values(message)
@@ -0,0 +1,226 @@
+'''
+Local stand-in for the Mistral API
+
+Implements the endpoints MistralClient uses (chat completions, embeddings, models) over HTTP,
+so the augmentation can be load-tested and benchmarked without spending quota. The answers are
+deterministic fakes built from the request: the abbreviations of the prompt come back title-cased
+in the JSON format the prompt asks for, the embedding of a text is a random vector seeded with
+the text. Latency, rate limit (429 with Retry-After) and server errors are configurable.
+
+Point the app at the stand-in with MISTRAL_ENDPOINT in the .env-file (see api_clients.py).
+
+Run as script, e.g.:
+    python mistral_standin.py --port 8011 --latency 0.5 --latency-dist lognormal --rate-limit 10 --error-rate 0.02
+'''
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+import zlib
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import rate_limit
+
+LATENCY_DISTRIBUTIONS = ['fixed', 'uniform', 'exponential', 'lognormal']
+# Limit of the estimated tokens of one embedding request
+MAX_BATCH_TOKENS = 16384
+EMBEDDING_DIMENSION = 1024
+
+
+# Fake answers
+def chat_answer(prompt):
+    '''Returns the answer to a prompt of process_llm as JSON string, the same answer for the same prompt.'''
+    # the items are in the last <<< >>> block of the prompt
+    block = prompt.split('<<<')[-1].split('>>>')[0].strip().splitlines()
+    listed = prompt.split('sind:\n\n')[-1].split('\n\nDu wirst')[0].splitlines()
+    if block and block[0].startswith('Produkte'):
+        # second stage of the two-stage flow, the first of the listed subcategories
+        answer = [{'index': i, 'categorySub': listed[0]} for i in range(len(block) - 1)]
+    elif block and block[0].startswith('Verkürzte Produktnamen'):
+        items = [line.split(': ', 1)[1] for line in block[1:]]
+        if 'Hauptkategorien sind' in prompt:
+            # first stage of the two-stage flow, spread the items over the listed main categories
+            answer = [{'index': i, 'productName': item.title(), 'categoryMain': listed[i % len(listed)]}
+                      for i, item in enumerate(items)]
+        else:
+            answer = [{'index': i, 'productName': item.title(), 'categoryMain': 'Sonstige Positionen',
+                       'categorySub': 'Kategorie nicht erkannt'} for i, item in enumerate(items)]
+    else:
+        item = block[0].split(': ', 1)[-1] if block else ''
+        answer = {'productName': item.title(), 'categoryMain': 'Sonstige Positionen',
+                  'categorySub': 'Kategorie nicht erkannt'}
+    return json.dumps(answer, ensure_ascii=False)
+
+def embedding_vector(text, dimension=EMBEDDING_DIMENSION):
+    '''Returns a normalized random vector seeded with the text.'''
+    vector = np.random.default_rng(zlib.crc32(text.encode('utf-8'))).standard_normal(dimension)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class StandInConfig:
+    '''Latency, rate limit and error injection of the stand-in, thread-safe.'''
+
+    def __init__(self, latency=0.5, latency_dist='uniform', sigma=0.5, rate_limit=None, error_rate=0.0,
+                 error_statuses=(500, 502, 503), seed=42):
+        if latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f'Unknown latency distribution {latency_dist}, choose from {LATENCY_DISTRIBUTIONS}')
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.sigma = sigma
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.error_statuses = list(error_statuses)
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent = []
+        self.stats = {'requests': 0, 'rate_limited': 0, 'errors': 0}
+
+    def sample_latency(self):
+        '''Returns a latency in s with mean self.latency.'''
+        if self.latency_dist == 'fixed':
+            return self.latency
+        if self.latency_dist == 'uniform':
+            return self.latency * self.rng.uniform(0.5, 1.5)
+        if self.latency_dist == 'exponential':
+            return self.rng.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+        # lognormal with a long tail, mu chosen for the mean
+        if self.latency <= 0:
+            return 0.0
+        return self.rng.lognormvariate(math.log(self.latency) - self.sigma ** 2 / 2, self.sigma)
+
+    def admit(self):
+        '''Returns (status, latency) of the next request, status 200 if it is answered normally.'''
+        with self._lock:
+            self.stats['requests'] += 1
+            now = time.monotonic()
+            if self.rate_limit is not None:
+                self._recent = [t for t in self._recent if now - t < 1.0]
+                if len(self._recent) >= self.rate_limit:
+                    self.stats['rate_limited'] += 1
+                    return 429, 0.0
+                self._recent.append(now)
+            latency = self.sample_latency()
+            if self.rng.random() < self.error_rate:
+                self.stats['errors'] += 1
+                return self.rng.choice(self.error_statuses), latency
+            return 200, latency
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # set by make_server
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, payload, headers=()):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        lines = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}', 'Content-Type: application/json',
+                 f'Content-Length: {len(body)}', *(f'{key}: {value}' for key, value in headers)]
+        # headers and body in one write, a separate small write stalls on delayed ACKs
+        self.wfile.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        self.wfile.flush()
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        self.read_json()
+        if self.path.rstrip('/') != '/v1/models':
+            return self.reply(404, {'message': f'Not found: {self.path}'})
+        created = int(time.time())
+        self.reply(200, {'object': 'list', 'data': [
+            {'id': model, 'object': 'model', 'created': created, 'owned_by': 'standin'}
+            for model in ('mistral-medium-latest', 'mistral-embed')]})
+
+    def do_POST(self):
+        request = self.read_json()
+        handlers = {'/v1/chat/completions': self.chat, '/v1/embeddings': self.embeddings}
+        handler = handlers.get(self.path.rstrip('/'))
+        if handler is None:
+            return self.reply(404, {'message': f'Not found: {self.path}'})
+        status, latency = self.config.admit()
+        if status == 429:
+            return self.reply(429, {'message': 'Requests rate limit exceeded'}, headers=[('Retry-After', '1')])
+        time.sleep(latency)
+        if status != 200:
+            return self.reply(status, {'message': 'Injected server error'})
+        handler(request)
+
+    def chat(self, request):
+        prompt = request['messages'][-1]['content']
+        content = chat_answer(prompt)
+        prompt_tokens, completion_tokens = rate_limit.estimate_tokens(prompt), rate_limit.estimate_tokens(content)
+        self.reply(200, {
+            'id': uuid.uuid4().hex, 'object': 'chat.completion', 'created': int(time.time()),
+            'model': request.get('model', ''),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens}})
+
+    def embeddings(self, request):
+        texts = request['input'] if isinstance(request['input'], list) else [request['input']]
+        tokens = sum(rate_limit.estimate_tokens(text) for text in texts)
+        if tokens > MAX_BATCH_TOKENS:
+            return self.reply(400, {'message': f'Too many tokens in batch: {tokens} > {MAX_BATCH_TOKENS}'})
+        self.reply(200, {
+            'id': uuid.uuid4().hex, 'object': 'list', 'model': request.get('model', ''),
+            'data': [{'object': 'embedding', 'embedding': embedding_vector(text), 'index': i}
+                     for i, text in enumerate(texts)],
+            'usage': {'prompt_tokens': tokens, 'completion_tokens': 0, 'total_tokens': tokens}})
+
+
+def make_server(host='127.0.0.1', port=8011, **config):
+    '''Returns the HTTP server of the stand-in, config are the arguments of StandInConfig.'''
+    handler = type('ConfiguredStandInHandler', (StandInHandler,), {'config': StandInConfig(**config)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def start_in_thread(host='127.0.0.1', port=0, **config):
+    '''Starts the stand-in in a daemon thread, port 0 picks a free port.
+
+    Returns:
+        tuple: server, endpoint url
+    '''
+    server = make_server(host, port, **config)
+    threading.Thread(target=server.serve_forever, name='mistral-standin', daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Mistral chat and embeddings API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8011)
+    parser.add_argument('--latency', type=float, default=0.5, help='mean latency in s')
+    parser.add_argument('--latency-dist', choices=LATENCY_DISTRIBUTIONS, default='uniform')
+    parser.add_argument('--sigma', type=float, default=0.5, help='sigma of the lognormal latency')
+    parser.add_argument('--rate-limit', type=float, help='requests per second above which 429 is answered')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 5xx')
+    parser.add_argument('--error-statuses', type=int, nargs='+', default=[500, 502, 503])
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, latency=args.latency, latency_dist=args.latency_dist,
+                         sigma=args.sigma, rate_limit=args.rate_limit, error_rate=args.error_rate,
+                         error_statuses=args.error_statuses, seed=args.seed)
+    print(f'Mistral stand-in on http://{args.host}:{args.port}, set MISTRAL_ENDPOINT to use it')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f'Served {server.RequestHandlerClass.config.stats}')
+
+if __name__=='__main__':
+    main()
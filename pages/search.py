@@ -44,7 +44,7 @@ st.sidebar.page_link('pages/upload.py', label='Upload', icon='🧾')
 st.sidebar.page_link('pages/data.py', label='Data', icon='🗄️')
 st.sidebar.page_link('pages/visualization.py', label='Explainer', icon='🤯')
 
-df = db.data()
+df = db.data(with_embeddings=False)
 
 
 col1, col2 = st.columns(2)
@@ -5,10 +5,15 @@ returns a dataframe with the product name, prices and filenames of the receipts
 '''
 
 
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import streamlit as st
 import pandas as pd
-import numpy as np
-from PIL import Image, ImageDraw
 
 
 import read_receipt 
@@ -49,71 +54,183 @@ st.sidebar.page_link('pages/visualization.py', label='Explainer', icon='🤯')
 
 ### Cached Functions
 
-# Cache the read_receipt function because it takes a long time to run
-@st.cache_data
-# This function takes the uploaded image-object and returns recognized text in a df and the boxed-receipt
+# Maximum number of receipts that are sent to the OCR at the same time
+OCR_MAX_WORKERS = int(os.getenv('OCR_MAX_WORKERS', 8))
+
+# Maximum number of OCR results and saved receipts kept in memory for all sessions together
+OCR_RESULT_MAX_ENTRIES = int(os.getenv('OCR_RESULT_MAX_ENTRIES', 200))
+SAVED_RECEIPT_MAX_ENTRIES = int(os.getenv('SAVED_RECEIPT_MAX_ENTRIES', 1000))
+
+class BoundedStore:
+    '''Dictionary that keeps only the max_entries least recently used entries.
+
+    The stores below are shared by all sessions of the app, the lock guards
+    the order of the entries against concurrent reruns.
+    '''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __getitem__(self, key):
+        with self._lock:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+# OCR results by content hash of the image-file, shared across reruns
+# so that only new or changed files have to be processed
+@st.cache_resource
+def ocr_result_store():
+    return BoundedStore(OCR_RESULT_MAX_ENTRIES)
+
+def file_key(uploaded_file):
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+def ocr_receipt(file_bytes, file_name):
+    # Pass a separate file-object to each thread, the uploaded file itself is read by the page
+    receipt_file = io.BytesIO(file_bytes)
+    receipt_file.name = file_name
+    return read_receipt.process_receipt(receipt_file)
+
+# This function takes the uploaded image-objects and returns recognized text in a df and the box-coordinates
 def create_receipt_value_dict(uploaded_files):
-    # Dictionary to store the receipt-text-df and the boxed-image
+    ocr_results = ocr_result_store()
+    file_keys = {uploaded_file.name: file_key(uploaded_file) for uploaded_file in uploaded_files}
+
+    # OCR the new files in a thread pool, so that the requests to the Vision API overlap
+    new_files, new_results = {}, {}
+    for uploaded_file in uploaded_files:
+        if file_keys[uploaded_file.name] not in ocr_results:
+            new_files.setdefault(file_keys[uploaded_file.name], uploaded_file)
+    if new_files:
+        with st.spinner(f'Reading {len(new_files)} receipt(s)…'):
+            with ThreadPoolExecutor(max_workers=min(OCR_MAX_WORKERS, len(new_files))) as executor:
+                futures = {
+                    executor.submit(ocr_receipt, uploaded_file.getvalue(), uploaded_file.name): key
+                    for key, uploaded_file in new_files.items()}
+                for future in as_completed(futures):
+                    try:
+                        new_results[futures[future]] = ocr_results[futures[future]] = future.result()
+                    except Exception as e:
+                        st.error(f'Could not read receipt {new_files[futures[future]].name}: {e}')
+        print(f'OCR was running for {len(new_files)} file(s)')
+
+    # Dictionary to store the receipt-text-df and the box-coordinates
     receipt_value_dict = {}
-    # Process all uploaded files
-    for uploaded_file in uploaded_files: 
-                # Pass the image-object to the function to OCR
-                df_sorted, image_boxed = read_receipt.process_receipt(uploaded_file)
-                # Write the receipt-text-df, the boxed-image into the dictionary and the label to take this receipt into account
-                receipt_value_dict[uploaded_file.name] = [df_sorted, image_boxed, True]
+    for uploaded_file in uploaded_files:
+        # The store can have evicted an entry in the meantime, the results of this run are kept anyway
+        ocr_result = new_results.get(file_keys[uploaded_file.name]) or ocr_results.get(file_keys[uploaded_file.name])
+        if ocr_result is None:
+            continue
+        df_sorted, polygons = ocr_result
+        # The same content could have been uploaded under another name before
+        df_sorted = df_sorted.assign(receipt_id=uploaded_file.name)
+        # Write the receipt-text-df, the box-coordinates into the dictionary and the label to take this receipt into account
+        receipt_value_dict[uploaded_file.name] = [df_sorted, polygons, True]
     # Return the dictionary 
-    print('function create_receipt_value_dict was running')           
     return receipt_value_dict
 
-# Store the dataframe resulting the 'include' selection after OCR
-@st.cache_data
-def write_receipt_value_dict_to_df(_receipt_value_dict): # underscore prohibits streamlit from hashing
-    # Structure of dict: receipt_value_dict[uploaded_file.name] = [df_sorted, image_boxed, True]
-
-    liste_df = []
-    for uploaded_file_name in _receipt_value_dict: # type: ignore
-        # if the receipt was included
-        if _receipt_value_dict[uploaded_file_name][2]:
-            # Extract the dataframe in the dictionary 
-            df = _receipt_value_dict[uploaded_file_name][0] 
-            # Write the dataframe of this receipt into the list of receipts
-            liste_df.append(df)
-    if len(liste_df) > 1:
-        # combine all dataframe in the list into a combined dataframe
-        combined_df = pd.concat(liste_df, ignore_index=True)
-    else:
-        # In case there's only one receipt TODO: check if necessary step
-        combined_df = liste_df[0]
-    return combined_df
-
-# Prompt the llm to augment data, return df with complete information
-@st.cache_data
-def prompt_llm_for_responses(combined_df):
-
-    categories_rewe = llm.get_rewe_categories()
-    product_list = combined_df.product_abbr.to_list()
-
-    response_list = []
-    for i, item in enumerate(product_list):
-        n = len(product_list)
-        st.write(f'Processing {i + 1} of {n}: {item}')
-        response_js = llm.process_abbr_item(item, categories_rewe)
-        st.write(response_js)
-        response_list.append(response_js)
-
-    # Make df from augmented data jsons
-    response_df = pd.DataFrame(response_list)
-    
-    # Join with information in combined_df (date, receipt_ID)
-    augmented_df = combined_df.join(response_df.drop('product_abbr', axis=1))
-
-    return augmented_df
-
-# Process the augmented data with mistral to get embeddings
-@st.cache_data
-def embed_data(df):
-    embedded_df = llm.embed_augmented_data(df)
-    return embedded_df
+# Render the boxed preview on a small thumbnail, only the last viewed previews are kept
+@st.cache_data(max_entries=8, show_spinner=False)
+def boxed_preview(file_name, polygons, _uploaded_file): # polygons change with the file content
+    return read_receipt.render_preview(_uploaded_file, polygons)
+
+# Columns of the augmentation of an item
+AUGMENTED_COLUMNS = ['productName', 'categoryMain', 'categorySub']
+
+# Receipts that were contextualized and written to the database, by content hash of the image-file.
+# Shared across sessions and reruns: after a rerun or a reconnect of the browser they are shown
+# again without requesting or writing them a second time
+@st.cache_resource
+def saved_receipt_store():
+    return BoundedStore(SAVED_RECEIPT_MAX_ENTRIES)
+
+def join_answers(receipt_df, answers):
+    """Joins the answers known so far ({abbreviation: item json}) to the items of the receipt."""
+    response_df = pd.DataFrame([answers.get(item, {}) for item in receipt_df.product_abbr],
+                               index=receipt_df.index).reindex(columns=AUGMENTED_COLUMNS)
+    return receipt_df.join(response_df)
+
+# Augment the items of all receipts, save every receipt to the database as soon as it is complete
+def contextualize_receipts(receipts, show_receipt):
+    """Augments the items of all receipts together and saves every receipt as soon as all its items are answered.
+
+    The items of all receipts are requested concurrently (process_llm.process_abbr_items_list), each
+    finished receipt is embedded and written to the database right away, an error or a disconnect
+    later on does not lose it. Receipts with items the model could not answer are not saved,
+    their answered items are in the abbreviation cache for the next try.
+
+    Args:
+        receipts (dict): {receipt name: (content key, OCR dataframe)}
+        show_receipt (function): show_receipt(name, df, status, message) is called whenever the
+            answers of a receipt change, status is one of 'partial', 'saved', 'incomplete', 'error'
+    """
+    store = saved_receipt_store()
+    answers = {}
+    pending = dict(receipts)
+
+    def finish(name):
+        key, receipt_df = pending.pop(name)
+        augmented_df = join_answers(receipt_df, answers)
+        if augmented_df.empty:
+            show_receipt(name, augmented_df, 'incomplete', 'No products recognized on the receipt, not saved')
+            return
+        if augmented_df.productName.isna().any():
+            show_receipt(name, augmented_df, 'incomplete',
+                         f'{augmented_df.productName.isna().sum()} item(s) could not be contextualized, not saved')
+            return
+        try:
+            database_df = llm.embed_augmented_data(augmented_df.copy())
+            db.insert_receipt_data(database_df)
+        except Exception as e:
+            show_receipt(name, augmented_df, 'error', f'Could not save the receipt: {e}')
+            return
+        store[key] = augmented_df
+        show_receipt(name, augmented_df, 'saved', 'Saved to the database')
+
+    def show_batch(results):
+        batch_items = set()
+        for result in results:
+            answers[result['product_abbr']] = result
+            batch_items.add(result['product_abbr'])
+        for name, (key, receipt_df) in list(pending.items()):
+            items = set(receipt_df.product_abbr)
+            if not items & batch_items:
+                continue
+            if items <= answers.keys():
+                finish(name)
+            else:
+                show_receipt(name, join_answers(receipt_df, answers), 'partial',
+                             f'{receipt_df.product_abbr.isin(answers.keys()).sum()} of {len(receipt_df)} items')
+
+    product_list = [item for _, receipt_df in receipts.values() for item in receipt_df.product_abbr]
+    llm.process_abbr_items_list(product_list, llm.get_rewe_categories(), on_batch_done=show_batch)
+    # Receipts without items
+    for name in list(pending):
+        finish(name)
 
 
 ### Session state to save buttons' states
@@ -124,8 +241,9 @@ def set_state(i):
     
     Stage 0: Initialization
     Stage 1: Files are uploaded and automatically OCR'd
-    Stage 2: User has selected which receipts to include for augmentation, button "Contextualize" is clicked
-    Stage 3: User clicked button "Submit", writing to database
+    Stage 2: User has selected which receipts to include for augmentation, button "Contextualize" is clicked,
+        the receipts are contextualized and saved one by one
+    Stage 3: Receipts are contextualized, reruns show the results without processing them again
     """
     st.session_state.stage = i
 
@@ -178,8 +296,7 @@ with col_img:
                 col_a, col_b, cl_c= st.columns([1, 8 ,1])
                 with col_b:
                     # Show the image
-                    image = Image.open(uploaded_file)
-                    st.image(image, caption=uploaded_file.name, use_column_width=True)
+                    st.image(uploaded_file, caption=uploaded_file.name, use_column_width=True)
     else: # If there is nothing to show, because no files are uploaded, show this message
         st.markdown('<p style="color:red;">Upload image-files on tab "Input" first before receipt output could be shown!</p>', unsafe_allow_html=True)
 
@@ -189,8 +306,9 @@ with col_img:
 
 with tab_Output:
     if uploaded_files:
-    # Perform OCR and create boxed-images of all uploaded receipts, function is cached
+    # Perform OCR and find the box-coordinates of all uploaded receipts, only new files are processed
         receipt_value_dict = create_receipt_value_dict(uploaded_files)
+        files_by_name = {uploaded_file.name: uploaded_file for uploaded_file in uploaded_files}
     #st.write(receipt_value_dict)
 
     # Predefine the file selection list to avoid an error
@@ -252,53 +370,75 @@ with tab_Output:
                     # On column "ocr_image" = "preview of the boxed products on the receipt:"
                     with col_ocr_image:
                         st.subheader("preview of the products on the receipt:")
-                        # set the size of the image relativ to column width
-                        col_a, col_b, cl_c= st.columns([1, 8 ,1])
-                        with col_b:
-                            # find the selected image-file-NAMES
-                            #for file_ocr in selected_files_output:
-                            st.image(receipt_value_dict[uploaded_file_name][1], caption=uploaded_file_name, use_column_width=True)
+                        # Render the preview only for the receipts that are viewed
+                        show_preview = st.toggle('Show preview', key=f'preview_{uploaded_file_name}')
+                        if show_preview:
+                            # set the size of the image relativ to column width
+                            col_a, col_b, cl_c= st.columns([1, 8 ,1])
+                            with col_b:
+                                preview = boxed_preview(uploaded_file_name, receipt_value_dict[uploaded_file_name][1],
+                                                        files_by_name[uploaded_file_name])
+                                st.image(preview, caption=uploaded_file_name, use_column_width=True)
         
 
     # submit button at the bottom
     button_bottom = st.button('Contextualize', type='primary', key='bottom', on_click=set_state, args=[2])
 
     if st.session_state.stage >= 2:
-        st.write('Start contextualising :nerd_face: This might take a while…')  
-        with st.status('Generating names and categories…'):
-
-            # Combine the dataframes of the included receipts
-            combined_df = write_receipt_value_dict_to_df(receipt_value_dict)
-
-            # Use cached function to connect to LLM
-            augmented_df = prompt_llm_for_responses(combined_df)
-            
-            # Use cached function to generate df for database
-            database_df = embed_data(augmented_df)
-    
-            st.write(augmented_df)
-            has_llm_response = True
-
-            
+        st.info('The receipts are shown on tab "Contextualized" as soon as their products are contextualized, '
+                'every finished receipt is saved to the database right away.')
 
 
 with tab_Context:
     st.subheader("Contextualized Receipts")
     if st.session_state.stage >= 2:
-        # Show result of data augmentation
-        st.dataframe(augmented_df)
-
-        # User action to write augmented data to database
-        button_store = st.button('Submit', type='primary', on_click=set_state, args=[3])
-
-        if st.session_state.stage >= 3:
-            with st.spinner('Writing to database'):
-                
-                # Write to database
-                db.insert_receipt_data(database_df)
-                st.success('Receipts saved. You can return to the app.')
+        store = saved_receipt_store()
+        # Results of the last contextualization in this session: {receipt name: (df, status, message)}
+        if 'context_results' not in st.session_state or st.session_state.stage == 2:
+            st.session_state.context_results = {}
+        context_results = st.session_state.context_results
+
+        # One area per included receipt, filled while its products are contextualized
+        receipts = {name: (file_key(files_by_name[name]), values[0])
+                    for name, values in receipt_value_dict.items() if values[2]}
+        placeholders = {}
+        for name in receipts:
+            st.write(f'**{name}**')
+            placeholders[name] = st.empty()
+
+        def show_receipt(name, df, status, message):
+            context_results[name] = (df, status, message)
+            with placeholders[name].container():
+                if status == 'saved':
+                    st.success(message)
+                elif status == 'partial':
+                    st.caption(f'Contextualizing… {message}')
+                else:
+                    st.warning(message)
+                st.dataframe(df, hide_index=True)
+
+        # Receipts saved before, in this or another session, are not requested and written again
+        # Looked up once, a receipt shown as saved is not written again if another session evicts it meanwhile
+        saved_receipts = set()
+        for name, (key, receipt_df) in receipts.items():
+            saved_df = store.get(key)
+            if saved_df is not None:
+                saved_receipts.add(name)
+                show_receipt(name, saved_df.assign(receipt_id=name), 'saved', 'Saved to the database')
+            elif name in context_results:
+                show_receipt(name, *context_results[name])
+
+        if st.session_state.stage == 2:
+            new_receipts = {name: receipt for name, receipt in receipts.items() if name not in saved_receipts}
+            if new_receipts:
+                with st.spinner(f'Contextualizing {len(new_receipts)} receipt(s)… This might take a while :nerd_face:'):
+                    contextualize_receipts(new_receipts, show_receipt)
+            # Reruns only show the results, "Contextualize" requests the receipts that were not saved again
+            set_state(3)
+        n_saved = sum(status == 'saved' for _, status, _ in context_results.values())
+        st.write(f'{n_saved} of {len(receipts)} receipt(s) saved.')
 
     else:
 
         # if no files were uploaded prompt the user to do that
-        st.markdown('<p style="color:red;">Upload image-files on tab "Input" first before contextualized receipt output could be shown!</p>', unsafe_allow_html=True)
\ No newline at end of file
+        st.markdown('<p style="color:red;">Upload image-files on tab "Input" first before contextualized receipt output could be shown!</p>', unsafe_allow_html=True)
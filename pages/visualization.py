@@ -42,13 +42,22 @@ st.sidebar.divider()
 presentation = st.sidebar.toggle('Presentation mode', value=True)
 
 
+# Read the product data and the categories only once, not on every rerun
+@st.cache_data
+def load_rewe_products():
+    return pd.read_csv('data/prod_bav_cleaned.csv', index_col=0)
+
+@st.cache_data
+def load_rewe_categories():
+    return llm.get_rewe_categories()
+
 # read product data and prepare for visualisation
-rewe_products = pd.read_csv('data/prod_bav_cleaned.csv', index_col=0)
+rewe_products = load_rewe_products()
 plot_products = rewe_products.copy()
 plot_products.drop(['price','image','x_embeds_tsne','y_embeds_tsne'],axis=1,inplace=True)
 
 # Load categories string for prompt in the interactive widget
-categories = llm.get_rewe_categories()
+categories = load_rewe_categories()
 
 
 prompting, embeddings = st.tabs(['LLM as classifier model', 'LLM text embeddings'])
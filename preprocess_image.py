@@ -0,0 +1,111 @@
+'''
+Preprocessing of receipt images before they are sent to the Google Vision API
+
+Phone photos of receipts are often 8-12 MB, the OCR works as well on a much smaller image.
+The stage fixes the EXIF orientation, optionally crops the paper region, converts to
+grayscale, downscales to a target long edge and encodes with a tuned JPEG quality.
+The returned transform maps the bounding boxes of the response back to the original image.
+'''
+
+import io
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+# PIL is imported in the functions that need it, to keep the import of the pages fast
+
+load_dotenv()
+
+OCR_MAX_LONG_EDGE = int(os.getenv('OCR_MAX_LONG_EDGE', 2400))
+OCR_GRAYSCALE = os.getenv('OCR_GRAYSCALE', '1') == '1'
+OCR_JPEG_QUALITY = int(os.getenv('OCR_JPEG_QUALITY', 85))
+OCR_AUTO_CROP = os.getenv('OCR_AUTO_CROP', '0') == '1'
+
+
+def fix_orientation(image):
+    '''Rotates the image according to its EXIF orientation tag.'''
+    from PIL import ImageOps
+
+    return ImageOps.exif_transpose(image)
+
+def find_paper_region(image, margin=0.02, min_area=0.2):
+    '''Finds the bounding box of the bright paper region in the image.
+
+    The image is thresholded on a small thumbnail with Otsu's method. Returns the box as
+    (left, upper, right, lower) in image coordinates, or None if no clear region was found.
+    '''
+    thumbnail = image.convert('L')
+    thumbnail.thumbnail((256, 256))
+    pixels = np.asarray(thumbnail)
+
+    # Otsu threshold: maximize the variance between dark background and bright paper
+    histogram = np.bincount(pixels.ravel(), minlength=256).astype(np.float64)
+    weight_dark = np.cumsum(histogram)
+    weight_bright = weight_dark[-1] - weight_dark
+    sum_dark = np.cumsum(histogram * np.arange(256))
+    mean_dark = np.divide(sum_dark, weight_dark, out=np.zeros(256), where=weight_dark > 0)
+    mean_bright = np.divide(sum_dark[-1] - sum_dark, weight_bright, out=np.zeros(256), where=weight_bright > 0)
+    threshold = np.argmax(weight_dark * weight_bright * (mean_dark - mean_bright) ** 2)
+
+    rows = np.flatnonzero((pixels > threshold).mean(axis=1) > 0.1)
+    cols = np.flatnonzero((pixels > threshold).mean(axis=0) > 0.1)
+    if not rows.size or not cols.size:
+        return None
+
+    # scale the region back to the image and add a small margin
+    scale_x, scale_y = image.width / pixels.shape[1], image.height / pixels.shape[0]
+    pad_x, pad_y = margin * image.width, margin * image.height
+    left = max(0, int(cols[0] * scale_x - pad_x))
+    upper = max(0, int(rows[0] * scale_y - pad_y))
+    right = min(image.width, int((cols[-1] + 1) * scale_x + pad_x))
+    lower = min(image.height, int((rows[-1] + 1) * scale_y + pad_y))
+
+    if (right - left) * (lower - upper) < min_area * image.width * image.height:
+        return None
+    return (left, upper, right, lower)
+
+def prepare_upload(image, max_long_edge=OCR_MAX_LONG_EDGE, grayscale=OCR_GRAYSCALE,
+                   jpeg_quality=OCR_JPEG_QUALITY, auto_crop=OCR_AUTO_CROP):
+    '''Preprocesses the image and encodes it as JPEG for the upload.
+
+    Returns:
+        content (bytes): the encoded image
+        transform (tuple): (scale, offset_x, offset_y) to map coordinates of the
+            processed image back to the orientation-fixed original image
+    '''
+    from PIL import Image
+
+    image = fix_orientation(image)
+    offset_x, offset_y = 0, 0
+
+    if auto_crop:
+        region = find_paper_region(image)
+        if region is not None:
+            image = image.crop(region)
+            offset_x, offset_y = region[0], region[1]
+
+    image = image.convert('L') if grayscale else image.convert('RGB')
+
+    scale = 1.0
+    if max_long_edge and max(image.size) > max_long_edge:
+        scale = max_long_edge / max(image.size)
+        image = image.resize((round(image.width * scale), round(image.height * scale)),
+                             Image.Resampling.LANCZOS)
+
+    byte_arr = io.BytesIO()
+    image.save(byte_arr, format='JPEG', quality=jpeg_quality, optimize=True)
+
+    return byte_arr.getvalue(), (scale, offset_x, offset_y)
+
+def map_to_original(response, transform):
+    '''Maps the bounding boxes of the text_annotations back to the original image (in place).'''
+    scale, offset_x, offset_y = transform
+    if scale == 1.0 and offset_x == 0 and offset_y == 0:
+        return response
+
+    # work on the raw protobuf message, the proto-plus wrappers are slow for many small updates
+    for text in type(response).pb(response).text_annotations:
+        for vertex in text.bounding_poly.vertices:
+            vertex.x = round(vertex.x / scale) + offset_x
+            vertex.y = round(vertex.y / scale) + offset_y
+    return response
@@ -2,34 +2,134 @@
 If run as script, process the input list of abbreviated items
 '''
 
-from mistralai.client import MistralClient
-from mistralai.models.chat_completion import ChatMessage
 #from ast import literal_eval
+# mistralai is imported in the functions that call the API to keep the import of this module fast,
+# the clients are shared across calls, see api_clients.py
 
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
 import json
-import time
 
 from dotenv import load_dotenv
 import os
 
+import abbr_cache
+import abbr_canonical
+import api_clients
+import embedding_cache
+import llm_json
+import rate_limit
+
 load_dotenv(override=True)
 
 MISTRAL_API_KEY = os.getenv('MISTRAL_API_KEY')
+# Chat model for the augmentation, part of the key of the abbreviation cache
+LLM_MODEL = "mistral-medium-latest"
+# Embedding model, part of the key of the embedding cache
+EMBEDDING_MODEL = "mistral-embed"
+# Number of abbreviations sent to the model in one request, 1 sends every item on its own
+LLM_BATCH_SIZE = int(os.getenv('LLM_BATCH_SIZE', 15))
+# Maximum number of requests in flight at the same time, the rate is limited by rate_limit.py
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 8))
+# Classify items with the kNN classifier on the rewe catalog before asking the LLM
+KNN_CLASSIFIER = os.getenv('KNN_CLASSIFIER', '0') == '1'
+# Request the main category and the subcategory in two smaller prompts
+LLM_TWO_STAGE = os.getenv('LLM_TWO_STAGE', '0') == '1'
+# Maximum number of texts of one embedding request
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv('EMBEDDING_MAX_BATCH_SIZE', 128))
+# Maximum estimated tokens of one embedding request, below the limit of the embedding model
+EMBEDDING_MAX_BATCH_TOKENS = int(os.getenv('EMBEDDING_MAX_BATCH_TOKENS', 16000))
+# Maximum number of embedding requests in flight at the same time
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv('EMBEDDING_MAX_CONCURRENCY', 4))
+# Requests of a single item again if its answer cannot be parsed, with another seed
+LLM_PARSE_RETRIES = int(os.getenv('LLM_PARSE_RETRIES', 1))
+
+# Token counts reported by the API for all chat requests of the process
+token_usage = {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+_token_usage_lock = threading.Lock()
 
 
 # LLM functions
-def get_embeddings_by_chunks(data, chunk_size):
+def token_batches(texts, max_items, max_tokens=EMBEDDING_MAX_BATCH_TOKENS):
+    '''Splits texts into consecutive batches of at most max_items texts and max_tokens estimated tokens.
+
+    A text above max_tokens gets a batch of its own, the API truncates or rejects it.
     '''
-    Returns embeddings for data as a list of arrays.
+    batches, batch, batch_tokens = [], [], 0
+    for text in texts:
+        tokens = rate_limit.estimate_tokens(text)
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def embed_batch(batch, on_embedded=None):
+    '''Returns the embeddings of one batch of texts, within the shared rate limit.
+
+    If the batch fails after the retries of the rate limiter its texts are embedded one by one,
+    a single failing text raises. on_embedded(texts, embeddings) is called with every answer.
     '''
-    client = MistralClient(MISTRAL_API_KEY)
+    client = api_clients.mistral_client(MISTRAL_API_KEY)
+    try:
+        response = rate_limit.default_limiter().call(
+            lambda: client.embeddings(model=EMBEDDING_MODEL, input=batch),
+            tokens=sum(rate_limit.estimate_tokens(text) for text in batch))
+    except rate_limit.CircuitOpenError:
+        raise
+    except Exception as e:
+        if len(batch) == 1:
+            raise
+        print(f'Embedding a batch of {len(batch)} texts failed ({e}), embedding them one by one')
+        return [vector for text in batch for vector in embed_batch([text], on_embedded)]
+    # the answer lists the embeddings by index
+    vectors = [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+    if on_embedded is not None:
+        on_embedded(batch, vectors)
+    return vectors
+
+def get_embeddings_by_chunks(data, chunk_size, use_cache=True, max_tokens=EMBEDDING_MAX_BATCH_TOKENS,
+                             max_concurrency=EMBEDDING_MAX_CONCURRENCY):
+    '''
+    Returns embeddings for data as a list of arrays.
 
-    chunks = [data[x : x + chunk_size] for x in range(0, len(data), chunk_size)]
-    embeddings_response = [
-        client.embeddings(model="mistral-embed", input=c) for c in chunks
-    ]
-    return [d.embedding for e in embeddings_response for d in e.data]
+    Texts found in the embedding cache (embedding_cache.py) are not sent to the API,
+    the same text occurring several times in data is embedded once.
+    The other texts are sent in batches of at most chunk_size texts and max_tokens estimated
+    tokens, up to max_concurrency batches at a time. Every batch is stored in the cache as
+    soon as it is answered, an interrupted run continues where it stopped.
+    '''
+    cache = embedding_cache.default_cache() if use_cache else None
+    embeddings = cache.get_many(data, EMBEDDING_MODEL) if cache is not None else {}
+    # unique texts that have to be embedded, in the order of data
+    missing = list(dict.fromkeys(text for text in data if text not in embeddings))
+    if cache is not None:
+        print(f'Found {sum(text in embeddings for text in data)} of {len(data)} texts in the embedding cache')
+
+    if missing:
+        def store(texts, vectors):
+            if cache is not None:
+                cache.put_many(texts, vectors, EMBEDDING_MODEL)
+
+        batches = token_batches(missing, chunk_size, max_tokens)
+        if len(batches) > 1:
+            print(f'Embedding {len(missing)} texts in {len(batches)} batches, up to {max_concurrency} at a time')
+        # map keeps the order of the batches, the pool bounds the requests in flight
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(batches)))) as executor:
+            batch_vectors = list(executor.map(lambda batch: embed_batch(batch, store), batches))
+        new_embeddings = [vector for vectors in batch_vectors for vector in vectors]
+        # same float32 precision as the cached vectors
+        embeddings.update(zip(missing, np.asarray(new_embeddings, dtype=np.float32)))
+
+    return [list(map(float, embeddings[text])) for text in data]
 
 def embed_augmented_data(df):
     # Get embeddings for augmented data
@@ -39,43 +139,69 @@ def embed_augmented_data(df):
     else:
         # if there is only one row
         data_strings = [' '.join(df[['product_abbr', 'productName', 'categoryMain', 'categorySub']].astype(str).values)]
-    embeddings = get_embeddings_by_chunks(data_strings, 50)
+    embeddings = get_embeddings_by_chunks(data_strings, EMBEDDING_MAX_BATCH_SIZE)
     df['embedding'] = embeddings
     return df
 
-def run_mistral(user_message, model="mistral-medium-latest"):
+def run_mistral(user_message, model=LLM_MODEL, random_seed=42, usage=None):
     """Gets a chat completion response from Mistral API for user_message prompt.
 
     Args:
         user_message (str): Prompt
         model (str, optional): Model to use. Check Mistral https://docs.mistral.ai/guides/model-selection/ for model names
+        random_seed (int, optional): Seed of the sampling, another seed gives another answer to the same prompt
+        usage (dict, optional): Token counts of the caller, see record_token_usage
     Returns:
         str: message as generated by Mistral.
     """
-    client = MistralClient(MISTRAL_API_KEY)
+    from mistralai.models.chat_completion import ChatMessage
+
+    client = api_clients.mistral_client(MISTRAL_API_KEY)
     messages = [
         ChatMessage(role="user", content=user_message)
     ]
-    chat_response = client.chat(
-        model=model,
-        messages=messages,
-        temperature=0.5, # default 0.7, lower is more deterministic
-        random_seed=42
-    )
+    # wait for the rate limiter, retries after 429 and 5xx answers
+    chat_response = rate_limit.default_limiter().call(
+        lambda: client.chat(
+            model=model,
+            messages=messages,
+            temperature=0.5, # default 0.7, lower is more deterministic
+            random_seed=random_seed
+        ),
+        tokens=rate_limit.estimate_tokens(user_message))
+    record_token_usage(chat_response, usage)
     return chat_response.choices[0].message.content
 
-def get_rewe_categories():
-    """Format the main and subcategories found on the Rewe website for the prompt.
-    Each product can be classified with one category. To avoid overlaps, some labels like vegan are excluded.
-    Returns:
-        str: Formatted categories
+def record_token_usage(chat_response, usage=None):
+    """Adds the token counts of a chat response to token_usage and to usage, if given.
+
+    usage - dict with the keys of token_usage that counts only the requests of one caller,
+        the process-wide totals include the requests of other threads
     """
-    
-    # Import product categories as dict w/ key: main category, value: list of subcategories
+    counts = getattr(chat_response, 'usage', None)
+    with _token_usage_lock:
+        for totals in (token_usage,) if usage is None else (token_usage, usage):
+            totals['requests'] += 1
+            if counts is not None:
+                totals['prompt_tokens'] += counts.prompt_tokens
+                totals['completion_tokens'] += counts.completion_tokens
+
+@functools.lru_cache(maxsize=1)
+def read_rewe_categories_file():
+    """Reads data/categories_rewe.json once per process."""
     path = os.path.dirname(__file__)
     path = os.path.join(path,'data','categories_rewe.json')
     with open(path) as f:
-        categories_rewe = json.load(f)
+        return json.load(f)
+
+def load_rewe_categories():
+    """Loads the main and subcategories found on the Rewe website.
+    Each product can be classified with one category. To avoid overlaps, some labels like vegan are excluded.
+    Returns:
+        dict: key main category, value list of subcategories
+    """
+    # Import product categories as dict w/ key: main category, value: list of subcategories
+    categories_rewe = {main: list(subs) for main, subs in read_rewe_categories_file().items()}
 
     # Remove certain categories because they are actually labels
     exclude_categories = ['Vegane Vielfalt', 'International', 'Regional']
@@ -86,6 +212,16 @@ def get_rewe_categories():
     # Include new categories needed for items that are not products
     categories_rewe['Sonstige Positionen'] = ['Pfand & Leergut', 'Rabatt & Ermäßigung', 'Kategorie nicht erkannt']
 
+    return categories_rewe
+
+@functools.lru_cache(maxsize=1)
+def get_rewe_categories():
+    """Format the main and subcategories found on the Rewe website for the prompt, memoized.
+    Returns:
+        str: Formatted categories
+    """
+    categories_rewe = load_rewe_categories()
+
     # String categories together in a formatted string to insert in the prompt
     categories_string = list()
     for main_category in categories_rewe:
@@ -131,11 +267,12 @@ Verkürzter Produktname: {item}
     )
     return prompt
 
-def process_abbr_item(item, categories):
+def process_abbr_item(item, categories, usage=None):
     """Completes the shortened item to full product name and categorizes it in a main and sub-category
 
     Args:
         item (str): The product name as it is on the receipt.
+        usage (dict, optional): Token counts of the caller, see record_token_usage
 
     Returns:
         json: Full product name, main category, subcategory, input item string
@@ -143,54 +280,408 @@ def process_abbr_item(item, categories):
     
     # String with prompt and the item for the message to the model
     prompt = get_prompt(item, categories)
-    # Initiate variable to skip JSON parsing if API request fails
-    message = None
+    item_json = {'product_abbr': item}
 
-    # Request response from Mixtral
-    try:
-        print(f'Requesting Mixtral for {item}…')
-        message = run_mistral(prompt)
-        print('Received response')
-    except Exception as e:
-        # If request has failed, return only item to process
-        print('\n\n!!!\n\nError requesting response from Mixtral!\n\nAPI response:')
-        print(e)
-        item_json = {'product_abbr': item}
-    
-    
-    if message is not None:
-        # Parse message string to json
+    # Request the answer again with another seed if it cannot be parsed or repaired
+    for attempt in range(LLM_PARSE_RETRIES + 1):
+        # Request response from Mixtral
         try:
-            item_json = json.loads(message)
-            item_json['product_abbr'] = item
-            print(f"Parses response successfully, {item_json['productName']}")
+            print(f'Requesting Mixtral for {item}…')
+            message = run_mistral(prompt, random_seed=42 + attempt, usage=usage)
+            print('Received response')
+        except rate_limit.CircuitOpenError as e:
+            # The API is down, do not wait for it, return only item to process
+            print(e)
+            return item_json
         except Exception as e:
-            # If the model has answered in invalid json, return only item to process
-            print('\n\n!!!\n\nError parsing Mixtral message, not formatted correctly as JSON!\n\Error:')
+            # If request has failed, return only item to process
+            print('\n\n!!!\n\nError requesting response from Mixtral!\n\nAPI response:')
+            print(e)
+            return item_json
+
+        # Parse message string to json, repair it if necessary
+        try:
+            answer = llm_json.loads_repaired(message)
+            if isinstance(answer, list) and len(answer) == 1:
+                answer = answer[0]
+            if not isinstance(answer, dict) or not answer.get('productName'):
+                raise ValueError('productName missing in the answer')
+            if not all(isinstance(answer[key], str) for key in ANSWER_FIELDS if key in answer):
+                raise ValueError('Fields of the answer are not strings')
+            answer['product_abbr'] = item
+            print(f"Parses response successfully, {answer['productName']}")
+            return answer
+        except Exception as e:
+            # If the model has answered in invalid json, try again or return only item to process
+            print('\n\n!!!\n\nError parsing Mixtral message, not formatted correctly as JSON!\nError:')
             print(e)
-            print(type(message))
             print(message)
-            item_json = {'product_abbr': item}
 
-        
     return item_json
 
-def process_abbr_items_list(item_list, categories):
+def get_batch_prompt(items, categories):
+    numbered_items = '\n'.join(f'{i}: {item}' for i, item in enumerate(items))
+    prompt = (
+        f"""
+Du bist ein Experte für das Erkennen und Kategorisieren von verkürzten Produktnamen auf Supermarkt-Kassenbons.
 
-    list_processed_items = []
-    for item in item_list:
-        processed_item = process_abbr_item(item, categories)
-        list_processed_items.append(processed_item)
-        print('Sleeping for 5 seconds')
-        time.sleep(5)
-    
-    return list_processed_items
+Deine Aufgabe ist die folgende:
+1. Löse jeden der nummerierten verkürzten Produktnamen in den Klammern <<< >>> zum vollständigen Produktnamen auf.
+2. Ordne jedes Produkt der Hauptkategorie und der dazugehörigen Unterkategorie zu, die das Produkt am besten klassifiziert.
+
+Die möglichen Kategorien sind:
+
+{categories}
+
+Du wirst IN JEDEM FALL nur jeweils die eine passendste der vordefinierten Hauptkategorien und eine der vordefinierten Unterkategorien wählen.
+Deine Antwort enthält keine Erklärungen, Anmerkungen oder Übersetzungen. Die Antwort muss ein valides JSON-Array sein,
+mit genau einem Objekt pro Produktname in derselben Reihenfolge. Jedes Objekt enthält die Nummer des Produktnamens als index.
+
+###
+Hier ist ein Beispiel:
+
+Verkürzte Produktnamen:
+0: HAUCHSCHN CURRY
+1: GRANATAPEL
+2: KASTEN LEER
+Antwort: [{{"index": 0, "productName": "Rügenwalder Mühle Veganer Hauchschnitt Typ Hähnchen", "categoryMain": "Fleisch & Fisch", "categorySub": "Fleischalternativen"}}, {{"index": 1, "productName": "Granatapfel", "categoryMain": "Obst & Gemüse", "categorySub": "Frisches Obst"}}, {{"index": 2, "productName": "Leergut Kasten", "categoryMain": "Sonstige Positionen", "categorySub": "Pfand & Leergut"}}]
+###
+
+<<<
+Verkürzte Produktnamen:
+{numbered_items}
+>>>
+"""
+    )
+    return prompt
 
-def process_receipt(receipt_scan_data):
+@functools.lru_cache(maxsize=1)
+def get_main_categories():
+    """Formats only the main categories for the first prompt of the two-stage flow, memoized."""
+    return '\n'.join(load_rewe_categories())
+
+@functools.lru_cache(maxsize=None)
+def get_subcategories(main_category):
+    """Formats the subcategories of one main category for the second prompt of the two-stage flow, memoized."""
+    return '\n'.join(load_rewe_categories()[main_category])
+
+def get_main_category_prompt(items, main_categories):
+    numbered_items = '\n'.join(f'{i}: {item}' for i, item in enumerate(items))
+    prompt = (
+        f"""
+Du bist ein Experte für das Erkennen und Kategorisieren von verkürzten Produktnamen auf Supermarkt-Kassenbons.
+
+Deine Aufgabe ist die folgende:
+1. Löse jeden der nummerierten verkürzten Produktnamen in den Klammern <<< >>> zum vollständigen Produktnamen auf.
+2. Ordne jedes Produkt der Hauptkategorie zu, die das Produkt am besten klassifiziert.
+
+Die möglichen Hauptkategorien sind:
+
+{main_categories}
+
+Du wirst IN JEDEM FALL nur jeweils die eine passendste der vordefinierten Hauptkategorien wählen.
+Deine Antwort enthält keine Erklärungen, Anmerkungen oder Übersetzungen. Die Antwort muss ein valides JSON-Array sein,
+mit genau einem Objekt pro Produktname in derselben Reihenfolge. Jedes Objekt enthält die Nummer des Produktnamens als index.
+
+###
+Hier ist ein Beispiel:
+
+Verkürzte Produktnamen:
+0: GRANATAPEL
+1: KASTEN LEER
+Antwort: [{{"index": 0, "productName": "Granatapfel", "categoryMain": "Obst & Gemüse"}}, {{"index": 1, "productName": "Leergut Kasten", "categoryMain": "Sonstige Positionen"}}]
+###
+
+<<<
+Verkürzte Produktnamen:
+{numbered_items}
+>>>
+"""
+    )
+    return prompt
+
+def get_subcategory_prompt(products, main_category, subcategories):
+    numbered_items = '\n'.join(f'{i}: {product}' for i, product in enumerate(products))
+    prompt = (
+        f"""
+Du bist ein Experte für das Kategorisieren von Supermarkt-Produkten.
+
+Deine Aufgabe ist die folgende:
+Ordne jedes der nummerierten Produkte der Hauptkategorie {main_category} in den Klammern <<< >>> der Unterkategorie zu,
+die das Produkt am besten klassifiziert.
+
+Die möglichen Unterkategorien sind:
+
+{subcategories}
+
+Du wirst IN JEDEM FALL nur jeweils die eine passendste der vordefinierten Unterkategorien wählen.
+Deine Antwort enthält keine Erklärungen, Anmerkungen oder Übersetzungen. Die Antwort muss ein valides JSON-Array sein,
+mit genau einem Objekt pro Produkt in derselben Reihenfolge, z.B. [{{"index": 0, "categorySub": "..."}}].
+
+<<<
+Produkte:
+{numbered_items}
+>>>
+"""
+    )
+    return prompt
+
+# Fields of the answer of the model for an item
+ANSWER_FIELDS = ['productName', 'categoryMain', 'categorySub']
+
+def parse_batch_response(message, items, required=('productName',)):
+    """Parses the JSON array answered to a batch prompt.
+
+    required - keys an answer must contain to be used, with a non-empty string value.
+        Answers with other fields that are not strings (e.g. null) are not used either.
+
+    Returns:
+        list: the item json for every item in items, None for items without a valid answer
+    """
+    # Ignore text or code fences around the array, repair the JSON and the keys if necessary
+    answers = llm_json.loads_repaired(message)
+    if isinstance(answers, dict):
+        answers = [answers]
+
+    results = [None] * len(items)
+    for position, answer in enumerate(answers):
+        if not isinstance(answer, dict) or not all(isinstance(answer.get(key), str) and answer[key].strip()
+                                                   for key in required):
+            continue
+        if not all(isinstance(answer[key], str) for key in ANSWER_FIELDS if key in answer):
+            # e.g. "categoryMain": null, the item is requested again
+            continue
+        # Align by the index in the answer, by position only if the model left it out
+        index = answer.pop('index', None)
+        if index is None:
+            index = position if len(answers) == len(items) else None
+        elif isinstance(index, str) and index.strip().isdecimal():
+            index = int(index)
+        elif not isinstance(index, int) or isinstance(index, bool):
+            # an invalid index leaves the item unaligned, it is requested again
+            index = None
+        if index is not None and 0 <= index < len(items) and results[index] is None:
+            answer['product_abbr'] = items[index]
+            results[index] = answer
+    return results
+
+def process_abbr_batch(items, categories, usage=None):
+    """Completes and categorizes several items with one request.
+
+    Items the answer is missing or invalid for are requested again in smaller batches,
+    single items fall back to process_abbr_item. usage counts the tokens, see record_token_usage.
+
+    Returns:
+        list: Full product name, main category, subcategory, input item string for every item
+    """
+    if len(items) == 1:
+        return [process_abbr_item(items[0], categories, usage)]
+
+    try:
+        print(f'Requesting Mixtral for {len(items)} items…')
+        message = run_mistral(get_batch_prompt(items, categories), usage=usage)
+        results = parse_batch_response(message, items)
+        print(f'Received response, parsed {sum(r is not None for r in results)} of {len(items)} items')
+    except rate_limit.CircuitOpenError as e:
+        # The API is down, do not split the batch into more requests that fail as well
+        print(e)
+        return [{'product_abbr': item} for item in items]
+    except Exception as e:
+        print('\n\n!!!\n\nError requesting or parsing the batch response from Mixtral!\n\nError:')
+        print(e)
+        results = [None] * len(items)
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if len(missing) == len(items):
+        # Nothing could be used, split the batch in halves
+        half = len(items) // 2
+        return (process_abbr_batch(items[:half], categories, usage)
+                + process_abbr_batch(items[half:], categories, usage))
+    if missing:
+        # Request only the missing items again
+        retried = process_abbr_batch([items[i] for i in missing], categories, usage)
+        for i, result in zip(missing, retried):
+            results[i] = result
+    return results
+
+def process_abbr_batch_two_stage(items, categories, usage=None):
+    """Completes and categorizes several items with the two-stage flow.
+
+    The first request asks for the full names and main categories with only the main categories
+    in the prompt, then one request per main category asks for the subcategories with only the
+    subcategories of this main category. Items the two-stage answers fail for go through
+    process_abbr_batch with the full categories. usage counts the tokens, see record_token_usage.
+
+    Returns:
+        list: Full product name, main category, subcategory, input item string for every item
+    """
+    categories_dict = load_rewe_categories()
+    try:
+        print(f'Requesting main categories for {len(items)} items…')
+        message = run_mistral(get_main_category_prompt(items, get_main_categories()), usage=usage)
+        results = parse_batch_response(message, items, required=('productName', 'categoryMain'))
+    except Exception as e:
+        print(f'Error requesting the main categories: {e}')
+        results = [None] * len(items)
+    results = [r if r is not None and r['categoryMain'] in categories_dict else None for r in results]
+
+    # Second stage, one request per main category
+    by_main = {}
+    for i, result in enumerate(results):
+        if result is not None:
+            by_main.setdefault(result['categoryMain'], []).append(i)
+    for main_category, indices in by_main.items():
+        products = [results[i]['productName'] for i in indices]
+        try:
+            message = run_mistral(get_subcategory_prompt(products, main_category, get_subcategories(main_category)),
+                                  usage=usage)
+            subs = parse_batch_response(message, products, required=('categorySub',))
+        except Exception as e:
+            print(f'Error requesting the subcategories of {main_category}: {e}')
+            subs = [None] * len(indices)
+        for i, sub in zip(indices, subs):
+            if sub is not None and sub['categorySub'] in categories_dict[main_category]:
+                results[i]['categorySub'] = sub['categorySub']
+            else:
+                results[i] = None
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        categories_string = get_rewe_categories()
+        for i, result in zip(missing, process_abbr_batch([items[i] for i in missing], categories_string, usage)):
+            results[i] = result
+    return results
+
+async def process_abbr_items_async(item_list, categories, batch_size=LLM_BATCH_SIZE,
+                                   max_concurrency=LLM_MAX_CONCURRENCY, on_batch_done=None, two_stage=False,
+                                   usage=None):
+    """Processes the batches of item_list concurrently, up to max_concurrency requests at a time.
+
+    The requests run in worker threads and wait for the shared rate limiter (rate_limit.py).
+    on_batch_done(results) is called in the calling thread whenever a batch is finished.
+    two_stage - use process_abbr_batch_two_stage, the categories are then read from
+        load_rewe_categories() instead of the categories string
+    usage - dict the token counts of these requests are added to, see record_token_usage
+
+    Returns:
+        list: the item json for every item, in the order of item_list
+    """
+    loop = asyncio.get_running_loop()
+    starts = range(0, len(item_list), batch_size)
+
+    def process_batch(batch):
+        if two_stage:
+            return process_abbr_batch_two_stage(batch, categories, usage)
+        if len(batch) == 1:
+            return [process_abbr_item(batch[0], categories, usage)]
+        return process_abbr_batch(batch, categories, usage)
+
+    async def run_batch(start):
+        results = await loop.run_in_executor(executor, process_batch, item_list[start : start + batch_size])
+        if on_batch_done is not None:
+            on_batch_done(results)
+        return results
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        batch_results = await asyncio.gather(*(run_batch(start) for start in starts))
+    return [result for results in batch_results for result in results]
+
+def current_prompt_version(categories, two_stage=False):
+    """Returns the version of the prompts with these categories, the key of the abbreviation cache."""
+    prompts = [get_prompt('', categories), get_batch_prompt([], categories)]
+    if two_stage:
+        prompts += [get_main_category_prompt([], get_main_categories())]
+        prompts += [get_subcategory_prompt([], main, get_subcategories(main)) for main in load_rewe_categories()]
+    return abbr_cache.prompt_version(*prompts)
+
+def process_abbr_items_list(item_list, categories, batch_size=LLM_BATCH_SIZE,
+                            max_concurrency=LLM_MAX_CONCURRENCY, on_batch_done=None, use_cache=True,
+                            use_knn=KNN_CLASSIFIER, two_stage=LLM_TWO_STAGE, usage=None):
+    """Processes the items in batches of batch_size items per request, batch_size=1 requests every item on its own.
+
+    The items are grouped by canonical form and near-duplicates (abbr_canonical.py), every group
+    is sent once and its answer is used for all items of the group.
+    Items found in the abbreviation cache (abbr_cache.py) are not sent to the model,
+    the new answers are stored in the cache as soon as their batch is finished.
+    With use_knn the items the kNN classifier (knn_classifier.py) resolves confidently
+    on the rewe catalog are not sent to the model either.
+    With two_stage the main category and the subcategory are requested one after the other,
+    see process_abbr_batch_two_stage. The prompt tokens per item are printed, with a usage dict
+    the token counts of the requests of this call are also added to it (see record_token_usage).
+    Synchronous entry point of process_abbr_items_async, see there.
+
+    Returns:
+        list: the item json for every item, in the order of item_list
+    """
+    if not item_list:
+        return []
+
+    cache = abbr_cache.default_cache() if use_cache else None
+    version = current_prompt_version(categories, two_stage)
+
+    # Group the items by canonical form and near-duplicates, every group is requested once,
+    # with the known abbreviations of the cache in the index a variant of a cached item is a hit
+    index = abbr_canonical.default_index(version, LLM_MODEL) if use_cache else abbr_canonical.AbbreviationIndex()
+    groups = abbr_canonical.group_items(item_list, index)
+    representatives = list(groups)
+    if len(representatives) < len(item_list):
+        print(f'{len(item_list)} items grouped into {len(representatives)} distinct abbreviations')
+
+    def fan_out(results):
+        # the answer of a group for every item of the group
+        return [dict(result, product_abbr=item) for result in results for item in groups[result['product_abbr']]]
+
+    cached = {}
+    if cache is not None:
+        cached = cache.get_many(representatives, version, LLM_MODEL)
+        print(f'Found {len(cached)} of {len(representatives)} abbreviations in the abbreviation cache')
+        if cached and on_batch_done is not None:
+            on_batch_done(fan_out(cached.values()))
+
+    def batch_done(results):
+        if cache is not None:
+            cache.put_many(results, version, LLM_MODEL)
+        if on_batch_done is not None:
+            on_batch_done(fan_out(results))
+
+    missing = [abbr for abbr in representatives if abbr not in cached]
+
+    if use_knn and missing:
+        # resolve the items the rewe catalog agrees on without the LLM
+        import knn_classifier
+        classified = {abbr: result for abbr, result in zip(missing, knn_classifier.classify(missing))
+                      if result is not None}
+        if classified:
+            if cache is not None:
+                cache.put_many(classified.values(), version, LLM_MODEL, source='knn')
+            if on_batch_done is not None:
+                on_batch_done(fan_out(classified.values()))
+            cached.update(classified)
+            missing = [abbr for abbr in missing if abbr not in classified]
+
+    if missing:
+        # only the requests of this call, other threads may use the API at the same time
+        call_usage = {key: 0 for key in token_usage}
+        processed = asyncio.run(process_abbr_items_async(missing, categories, batch_size, max_concurrency,
+                                                         batch_done, two_stage, call_usage))
+        cached.update(zip(missing, processed))
+        print(f'{call_usage["prompt_tokens"] / len(missing):.0f} prompt tokens '
+              f'and {call_usage["completion_tokens"] / len(missing):.0f} '
+              f'completion tokens per item, {call_usage["requests"]} requests')
+        if usage is not None:
+            with _token_usage_lock:
+                for key, count in call_usage.items():
+                    usage[key] = usage.get(key, 0) + count
+    # copy the answer of the group for every item, in the order of item_list
+    answers = {item: cached[abbr] for abbr, items in groups.items() for item in items}
+    return [dict(answers[item], product_abbr=item) for item in item_list]
+
+def process_receipt(receipt_scan_data, use_cache=True):
     '''Takes the abbreviated names, queries Mistral for completion for full name, categories, creates embeddings
     
     Args:
         receipt_scan_data (df): DataFrame with columns receipt_id, price, product_abbr
+        use_cache (bool): use the abbreviation and embedding caches, off for load tests
     Returns:
         df: DataFrame with input data, Mistral-inferred data and embeddings
     '''
@@ -201,16 +692,18 @@ def process_receipt(receipt_scan_data):
     categories = get_rewe_categories()
 
     # Prompt Mistral to augment abbreviated items from receipt
-    items_processed = process_abbr_items_list(items_to_process, categories)
+    items_processed = process_abbr_items_list(items_to_process, categories, use_cache=use_cache)
 
     # Save Mistral JSONs in a df for concating with embeddings
     items_processed_df = pd.DataFrame(items_processed)
 
-    # Put augmented data for each receipt item in a list for embedding
-    product_strings = [" ".join(item.values()) for item in items_processed]
+    # Put augmented data for each receipt item in a list for embedding,
+    # fields the model did not answer for an item are left out
+    product_strings = [" ".join(str(item[key]) for key in ANSWER_FIELDS + ['product_abbr'] if item.get(key))
+                       for item in items_processed]
 
     # Get the embeddings of augmented receipt items
-    product_embeddings = get_embeddings_by_chunks(product_strings, 50)
+    product_embeddings = get_embeddings_by_chunks(product_strings, EMBEDDING_MAX_BATCH_SIZE, use_cache=use_cache)
 
     # Concat embeddings to the processed items df
     items_processed_df['embedding'] = product_embeddings
@@ -0,0 +1,278 @@
+'''
+Rate limiting of the requests to the Mistral API
+
+All requests of the process share one limiter with two token buckets: requests per second
+and (estimated) tokens per minute. A request waits until both buckets can serve it.
+When the API answers 429 the limiter halves its rate and pauses for the Retry-After time,
+every successful request raises the rate again step by step up to the configured rate.
+
+Failed requests (5xx answers, connection errors) are retried with exponential backoff and
+jitter. A circuit breaker stops sending requests after LLM_CIRCUIT_FAILURES failures in a row
+and lets a single trial request through after LLM_CIRCUIT_RESET_SECONDS, the calls in between
+fail at once with CircuitOpenError instead of waiting for timeouts.
+
+Settings in the .env-file:
+    LLM_REQUESTS_PER_SECOND - maximum request rate (default 1)
+    LLM_TOKENS_PER_MINUTE - maximum estimated tokens per minute (default 500000)
+    LLM_MAX_RETRIES - retries of a request after a 429, 5xx answer or connection error (default 5)
+    LLM_BACKOFF_MAX_SECONDS - maximum backoff between two retries (default 30)
+    LLM_CIRCUIT_FAILURES - failures in a row that open the circuit (default 5)
+    LLM_CIRCUIT_RESET_SECONDS - time until a trial request is let through (default 30)
+'''
+
+import os
+import random
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LLM_REQUESTS_PER_SECOND = float(os.getenv('LLM_REQUESTS_PER_SECOND', 1))
+LLM_TOKENS_PER_MINUTE = float(os.getenv('LLM_TOKENS_PER_MINUTE', 500000))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 5))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv('LLM_BACKOFF_MAX_SECONDS', 30))
+LLM_CIRCUIT_FAILURES = int(os.getenv('LLM_CIRCUIT_FAILURES', 5))
+LLM_CIRCUIT_RESET_SECONDS = float(os.getenv('LLM_CIRCUIT_RESET_SECONDS', 30))
+
+# Status codes of answers that are worth another try
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    '''Raised instead of sending a request while the circuit breaker is open.'''
+
+
+def is_retryable(exception):
+    '''Returns True for 429 and 5xx answers and connection errors.
+
+    mistralai wraps httpx timeouts and network errors other than a failed connect in a plain
+    MistralException, these are recognized by the httpx exception they were raised from.
+    '''
+    import httpx
+    from mistralai.exceptions import MistralConnectionException
+
+    status = getattr(exception, 'http_status', None)
+    return (status in RETRY_STATUS_CODES
+            or isinstance(exception, (MistralConnectionException, ConnectionError, TimeoutError))
+            or isinstance(exception.__cause__, (httpx.TimeoutException, httpx.NetworkError,
+                                                httpx.RemoteProtocolError)))
+
+def backoff_seconds(attempt, base=1.0, maximum=LLM_BACKOFF_MAX_SECONDS):
+    '''Exponential backoff with full jitter: a random time up to base * 2**attempt, at most maximum.'''
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def estimate_tokens(text):
+    '''Rough token count of a text, about 4 characters per token.'''
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    '''Bucket that refills with rate units per second up to capacity.
+
+    Not thread-safe on its own, the RateLimiter holds the lock.
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, rate_factor=1.0, not_before=0.0):
+        '''Takes amount units and returns the seconds until they are available.
+
+        The level can become negative, the following reservations wait correspondingly longer.
+        not_before - monotonic time before which nothing is served (a pause after 429)
+        '''
+        now = time.monotonic()
+        start = max(now, not_before)
+        rate = self.rate * rate_factor
+        if start > self.updated:
+            self.level = min(self.capacity, self.level + (start - self.updated) * rate)
+            self.updated = start
+        self.level -= amount
+        return max(0.0, self.updated - now) + max(0.0, -self.level / rate)
+
+    def refund(self, amount):
+        '''Gives back a reservation that is not used.'''
+        self.level = min(self.capacity, self.level + amount)
+
+
+class CircuitBreaker:
+    '''Thread-safe circuit breaker: closed -> open after failures in a row -> half open after reset_seconds.'''
+
+    def __init__(self, failures=LLM_CIRCUIT_FAILURES, reset_seconds=LLM_CIRCUIT_RESET_SECONDS):
+        self._lock = threading.Lock()
+        self.failure_threshold = failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        # a trial request is in flight while half open
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half open' if time.monotonic() - self.opened_at >= self.reset_seconds else 'open'
+
+    def allow(self):
+        '''Raises CircuitOpenError unless a request may be sent.'''
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half open' and not self.trial:
+                self.trial = True
+                return
+            raise CircuitOpenError(f'Mistral API unavailable after {self.failures} failures in a row, '
+                                   f'next try in {self.reset_seconds - (time.monotonic() - self.opened_at):.0f} s')
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def released(self):
+        '''Ends a trial request that neither proved nor disproved that the API is available.'''
+        with self._lock:
+            self.trial = False
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial:
+                    print(f'Circuit opened after {self.failures} failures in a row')
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+class RateLimiter:
+    '''Thread-safe limiter for requests per second and tokens per minute, with adaptive backoff on 429.'''
+
+    def __init__(self, requests_per_second=LLM_REQUESTS_PER_SECOND, tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+                 min_rate_factor=0.05, recovery_step=0.05, breaker=None):
+        self._lock = threading.Lock()
+        self.requests = TokenBucket(requests_per_second, max(1.0, requests_per_second))
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        # fraction of the configured rate that is currently used, lowered on 429
+        self.rate_factor = 1.0
+        self.min_rate_factor = min_rate_factor
+        self.recovery_step = recovery_step
+        # no request is sent before this time (after a 429 with Retry-After)
+        self.paused_until = 0.0
+        # number of pauses so far, waiting requests reserve again after a new pause
+        self.pauses = 0
+        self.stats = {'requests': 0, 'rate_limited': 0, 'retries': 0, 'waited_s': 0.0}
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+    def acquire(self, tokens=1):
+        '''Blocks until a request with the estimated number of tokens may be sent.'''
+        with self._lock:
+            self.stats['requests'] += 1
+        while True:
+            with self._lock:
+                wait = max(self.requests.reserve(1, self.rate_factor, self.paused_until),
+                           self.tokens.reserve(tokens, self.rate_factor, self.paused_until))
+                pauses = self.pauses
+                self.stats['waited_s'] += wait
+            if wait > 0:
+                time.sleep(wait)
+            with self._lock:
+                if self.pauses == pauses:
+                    return
+                # a 429 came in while waiting, give the reservation back and reserve again at the lowered rate
+                self.requests.refund(1)
+                self.tokens.refund(tokens)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate_factor = min(1.0, self.rate_factor + self.recovery_step)
+
+    def rate_limited(self, retry_after=None):
+        '''Halves the rate and pauses all requests after a 429 answer.'''
+        with self._lock:
+            self.stats['rate_limited'] += 1
+            now = time.monotonic()
+            # the requests in flight while the limit was hit answer 429 as well, lower the rate only once
+            if now >= self.paused_until:
+                self.rate_factor = max(self.min_rate_factor, self.rate_factor / 2)
+                # no burst after the pause, start again from an empty bucket; the reservations of the
+                # waiting requests are kept, they give them back before they reserve again
+                self.requests.level = min(self.requests.level, 0.0)
+                self.pauses += 1
+            pause = retry_after if retry_after is not None else 1 / (self.requests.rate * self.rate_factor)
+            self.paused_until = max(self.paused_until, now + pause)
+
+    def call(self, func, tokens=1, max_retries=LLM_MAX_RETRIES):
+        '''Calls func within the rate limit and retries it after 429, 5xx answers and connection errors.
+
+        The status code is read from the http_status attribute of the raised exception
+        (mistralai.exceptions.MistralAPIException).
+        Raises CircuitOpenError without calling func while the circuit breaker is open.
+        '''
+        for attempt in range(max_retries + 1):
+            self.breaker.allow()
+            try:
+                self.acquire(tokens)
+                result = func()
+            except Exception as e:
+                status = getattr(e, 'http_status', None)
+                if status == 429:
+                    # the API is up, only the rate is too high
+                    self.breaker.succeeded()
+                elif is_retryable(e):
+                    self.breaker.failed()
+                else:
+                    # e.g. a 4xx answer, the next request may be the trial of a half open circuit
+                    self.breaker.released()
+                if not is_retryable(e) or attempt == max_retries:
+                    raise
+                with self._lock:
+                    self.stats['retries'] += 1
+                if status == 429:
+                    self.rate_limited(retry_after_seconds(e))
+                else:
+                    # server or connection error, wait before the next try
+                    time.sleep(backoff_seconds(attempt))
+                continue
+            except BaseException:
+                # e.g. KeyboardInterrupt, do not keep a half open circuit blocked
+                self.breaker.released()
+                raise
+            self.breaker.succeeded()
+            self.succeeded()
+            return result
+
+
+def retry_after_seconds(exception):
+    '''Returns the Retry-After header of the answer in seconds, None if it is missing.'''
+    headers = {key.lower(): value for key, value in (getattr(exception, 'headers', None) or {}).items()}
+    try:
+        return float(headers['retry-after'])
+    except (KeyError, ValueError):
+        return None
+
+
+_default_limiter = None
+_default_limiter_lock = threading.Lock()
+
+def default_limiter():
+    '''Returns the process-wide limiter of the Mistral requests.'''
+    global _default_limiter
+    with _default_limiter_lock:
+        if _default_limiter is None:
+            _default_limiter = RateLimiter()
+    return _default_limiter
+
+def configure_default_limiter(**kwargs):
+    '''Replaces the process-wide limiter by RateLimiter(**kwargs), e.g. for benchmarks.'''
+    global _default_limiter
+    with _default_limiter_lock:
+        _default_limiter = RateLimiter(**kwargs)
+    return _default_limiter
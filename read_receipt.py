@@ -5,33 +5,60 @@ from dotenv import load_dotenv
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from scipy.signal import argrelmin, argrelmax
 import re
-from PIL import Image, ImageDraw
 import io
 
+import api_clients
+import line_clustering
+import preprocess_image
+import vision_cache
+
 # set path of the skript as currrent path
 #os.chdir(os.path.dirname(os.path.abspath(__file__)))
-# path .env file if skript is in subfolder
-load_dotenv()
 
-# get path to SA_key from .env-file
-sa_key_path = os.getenv("GOOGLE_SA_KEY")
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = sa_key_path
+# The Google client library and PIL are imported in the functions that use them,
+# so that importing this module (e.g. on every page of the app) stays fast.
+
+def set_credentials():
+    """Points the Google client library to the service account key from the .env-file."""
+    # path .env file if skript is in subfolder
+    load_dotenv()
+
+    # get path to SA_key from .env-file
+    sa_key_path = os.getenv("GOOGLE_SA_KEY")
+    if sa_key_path:
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = sa_key_path
 
 
 # Googles OCR function
-def detect_text(image):
-    """Detects text in the file."""
+def detect_text(image, use_cache=True, original_bytes=None, client=None):
+    """Detects text in the file.
+
+    The image is preprocessed (see preprocess_image.py) before the upload, the bounding
+    boxes in the returned response refer to the orientation-fixed original image.
+    Responses are looked up in the on-disk Vision cache (see vision_cache.py) first,
+    set use_cache=False to always request the API.
+    original_bytes - size of the original image file, to report the bytes saved by the preprocessing
+    client - client with a text_detection method, defaults to the shared Vision client
+        of api_clients.py (e.g. vision_replay.ReplayClient to run on recorded responses)
+    """
     from google.cloud import vision
 
-    client = vision.ImageAnnotatorClient()
+    # downscale and compress the image before the upload
+    content, transform = preprocess_image.prepare_upload(image)
+    if original_bytes:
+        print(f'Vision upload {len(content)/1024:.0f} kB, original {original_bytes/1024:.0f} kB, '
+              f'saved {(original_bytes - len(content))/1024:.0f} kB')
+
+    cache = vision_cache.default_cache() if use_cache else None
+    if cache is not None:
+        response = cache.get(content)
+        if response is not None:
+            return preprocess_image.map_to_original(response, transform)
 
-   # with open(image_or_path, "rb") as image_file:
-    #    content = image_file.read()
-    byte_arr = io.BytesIO()
-    image.save(byte_arr, format='JPEG') #TODO: test if it works with *.png
-    content = byte_arr.getvalue()
+    if client is None:
+        set_credentials()
+        client = api_clients.vision_client()
 
     image = vision.Image(content=content)
 
@@ -42,190 +69,277 @@ def detect_text(image):
             "{}\nFor more info on error messages, check: "
             "https://cloud.google.com/apis/design/errors".format(response.error.message)
             )
-    return response
+
+    # the cache stores the response to the uploaded image, so map the boxes afterwards
+    if cache is not None:
+        cache.put(content, response)
+    return preprocess_image.map_to_original(response, transform)
 
 # function that draws the bounding boxes on the passed receipt
-def draw_boxes(image, bounds, color):
+def draw_boxes(image, polygons, color, scale=1.0):
     """Draws a border around the image using the hints in the vector list.
 
     Args:
         image: the input image object.
-        bounds: list of coordinates for the boxes.
+        polygons: integer array of shape (boxes, 4, 2) with the corner coordinates of the boxes.
         color: the color of the box.
+        scale: factor from the coordinates of the polygons to the image, e.g. for thumbnails.
 
     Returns:
         An image with colored bounds added.
     """
+    from PIL import ImageDraw
+
     draw = ImageDraw.Draw(image)
+    width = max(1, round(3 * scale))
 
-    for bound in bounds:
-        draw.polygon(
-            [
-                bound.vertices[0].x,
-                bound.vertices[0].y,
-                bound.vertices[1].x,
-                bound.vertices[1].y,
-                bound.vertices[2].x,
-                bound.vertices[2].y,
-                bound.vertices[3].x,
-                bound.vertices[3].y,
-            ],
-            None,
-            color, width=3
-        )
+    for polygon in np.rint(polygons * scale).astype(np.int32):
+        draw.polygon(polygon.ravel().tolist(), None, color, width=width)
     return image
 
+# function that renders a downscaled preview of the receipt with its bounding boxes
+def render_preview(uploaded_file, polygons, max_long_edge=800, color='blue'):
+    """Draws the bounding boxes on a thumbnail of the receipt.
+
+    Args:
+        uploaded_file: file-like object of the receipt image.
+        polygons: corner coordinates of the boxes in the original image, see box_polygons().
+        max_long_edge: size of the thumbnail in px.
+
+    Returns:
+        The thumbnail with colored bounds added.
+    """
+    from PIL import Image
+
+    image = Image.open(uploaded_file)
+    full_long_edge = max(image.size)
+    # let the JPEG decoder skip the full resolution
+    image.draft('RGB', (max_long_edge, max_long_edge))
+    image = preprocess_image.fix_orientation(image).convert('RGB')
+    image.thumbnail((max_long_edge, max_long_edge))
+
+    return draw_boxes(image, polygons, color, scale=max(image.size) / full_long_edge)
+
+
+# dtype of the token table, where bl: bottom_left, br: bottom_right, tr: top_right, tl: top_left
+# denote the corners of the BBs
+TOKEN_DTYPE = np.dtype([
+    ('String', object),
+    ('x_bl', np.int32), ('y_bl', np.int32),
+    ('x_br', np.int32), ('y_br', np.int32),
+    ('x_tr', np.int32), ('y_tr', np.int32),
+    ('x_tl', np.int32), ('y_tl', np.int32),
+    ('mean_y', np.float64),
+    ])
+CORNER_COLUMNS = ['x_bl', 'y_bl', 'x_br', 'y_br', 'x_tr', 'y_tr', 'x_tl', 'y_tl']
+
+
+def box_polygons(texts):
+    '''Returns the corner coordinates of the bounding boxes as integer array of shape (boxes, 4, 2).
+
+    texts - text_annotations of the Vision response without the first (full text) entry
+    '''
+    # read all corner coordinates into one flat array in a single pass
+    return np.fromiter(
+        (coord for text in texts
+            for vertex in text.bounding_poly.vertices[:4]
+            for coord in (vertex.x, vertex.y)),
+        dtype=np.int32, count=8*len(texts)).reshape(len(texts), 4, 2)
+
+
+def build_token_table(texts):
+    '''Builds the token table of the recognized words in a single pass.
+
+    texts - text_annotations of the Vision response without the first (full text) entry
+
+    Returns a NumPy structured array (dtype TOKEN_DTYPE) with one row per bounding box.
+    '''
+    n_tokens = len(texts)
+    tokens = np.empty(n_tokens, dtype=TOKEN_DTYPE)
+    tokens['String'] = [text.description for text in texts]
+
+    coords = box_polygons(texts).reshape(n_tokens, 8)
+    for j, column in enumerate(CORNER_COLUMNS):
+        tokens[column] = coords[:, j]
+
+    # calulate mean BB y positions
+    tokens['mean_y'] = coords[:, 1::2].mean(axis=1)
+
+    return tokens
+
+
+# define helper function to search for the date string in the recognized text on the receipt
+def find_date(input_string):
+    # define the date pattern in the format 'TT.MM.YYYY' and include possible whitespaces
+    date_pattern = r'\b\d{2}\.\s?\d{2}\.\s?\d{4}\b'
+    # search for pattern in input_string
+    found = re.search(date_pattern, input_string)
+    # Check if date was found
+    if found:
+        return found.group(0)
+    else:
+        return "Date not found"
+
 
 # Main function that uses the detect_text() function and recreates the rows
 # on the receipt from the individual bounding boxes (detect_text() finds single
 # words and the corresponding bounding boxes, but is unable to recognize the lines/rows
 #of a receipt)
-def process_receipt(uploaded_file):
+def process_receipt(uploaded_file, line_engine='sweep', client=None):
     '''
     This function takes an image as input and creates a dataframe that contains
     information about the product names and the amount of money that was spent
-    on the products. 
+    on the products. Returns the dataframe and the corner coordinates of the
+    bounding boxes (see box_polygons) to render the preview.
 
-    path - directory where the receipt is located
-    filename - filename of the receipt
+    uploaded_file - file-like object of the receipt image (e.g. streamlit UploadedFile)
+    line_engine - engine to group the words into lines, see line_clustering.LINE_ENGINES
+    client - Vision client, see detect_text()
     '''
-    # create image instance
-    image = Image.open(uploaded_file)
+    from PIL import Image
+
+    # size of the original file to report the savings of the preprocessing
+    uploaded_file.seek(0, io.SEEK_END)
+    original_bytes = uploaded_file.tell()
+    uploaded_file.seek(0)
+    # create image instance, rotated like it is shown on the phone
+    image = preprocess_image.fix_orientation(Image.open(uploaded_file))
     # Apply function to an receipt
-    response = detect_text(image)
-   
+    response = detect_text(image, original_bytes=original_bytes, client=client)
 
     # The text_annotations contain the recognized text and the corresponding bounding boxes
     # the first entry contains the whole text from the receipt and the consecutive entries
     # contain the text/coordinates from the individual bounding boxes
     texts = response.text_annotations
 
-    # define helper function to search for the date string in the recognized text on the receipt
-    def find_date(input_string):
-        # define the date pattern in the format 'TT.MM.YYYY' and include possible whitespaces
-        date_pattern = r'\b\d{2}\.\s?\d{2}\.\s?\d{4}\b'
-        # search for pattern in input_string
-        found = re.search(date_pattern, input_string)
-        # Check if date was found
-        if found:
-            return found.group(0)
-        else:
-            return "Date not found"
+    df_sorted = parse_text_annotations(texts, line_engine)
+
+    # add filename to the df (in front of the date column)
+    df_sorted.insert(df_sorted.columns.get_loc('date'), 'receipt_id', uploaded_file.name)
+
+    # keep only the BB coords, the boxed preview is rendered on demand with render_preview()
+    polygons = box_polygons(texts[1:])
+
+    return df_sorted, polygons
+
+
+# Misread amounts in front of the price ('dirty fixes'), removed in this order
+# and kept with the product name. Add new rules for new receipt layouts here.
+PRICE_PREFIX_RULES = ['14 ', '2.0 ', 'W. ', '102 ']
+
+def compile_line_grammar(price_prefix_rules=PRICE_PREFIX_RULES):
+    '''Compiles the grammar of a product line on the receipt: <name> <price> <tax code>.'''
+    # a prefix is only removed if a numeric price follows it, e.g. not in 'PFAND 14 B'
+    price_prefixes = ''.join(rf'(?:{re.escape(prefix)}(?=.*\d))?' for prefix in price_prefix_rules)
+    return re.compile(rf'''
+        ^(?=.*\ [AB])                      # only lines with a tax remark A or B contain a price
+        (?P<product_abbr>
+            (?:.*[A-Za-z%]\ (?!\*$))?     # name up to the last word that ends with a letter or %
+            {price_prefixes})              # misread amounts in front of the price
+        [.B]*
+        (?P<price>.*?\d.*?)                # the price contains at least one digit
+        (?:\ (?P<tax_code>[AB])(?:(?<=A)\ \*)?)?$   # tax remark at the end of the line
+        ''', re.VERBOSE)
+
+LINE_GRAMMAR = compile_line_grammar()
+# decimal comma to point, remove whitespaces within the price
+PRICE_TRANSLATION = str.maketrans({',': '.', ' ': None})
+
+def parse_product_lines(line_strings, line_grammar=LINE_GRAMMAR):
+    '''Parses the receipt lines into product name, price and tax code in a single pass.
+
+    Lines that do not contain any price information are sorted out.
+
+    Returns a dataframe with the columns product_abbr, price and tax_code.
+    '''
+    df_lines = pd.Series(line_strings, dtype=object).str.extract(line_grammar)
+    df_lines = df_lines.dropna(subset=['price']).reset_index(drop=True)
+
+    # a misread price must not fail the whole receipt, such lines are sorted out
+    df_lines['price'] = pd.to_numeric(df_lines['price'].str.translate(PRICE_TRANSLATION), errors='coerce')
+    df_lines = df_lines.dropna(subset=['price']).reset_index(drop=True)
+
+    return df_lines
+
+
+def find_product_block(strings):
+    '''Returns the indices of the 'EUR' header and the 'SUMME' (or 'SUM') token that enclose the products.'''
+    product_list_start_ind = int(np.flatnonzero(strings == 'EUR')[0])
+    product_list_end_ind = np.flatnonzero(strings == 'SUMME')
+    if not product_list_end_ind.size:
+        product_list_end_ind = np.flatnonzero(strings == 'SUM')
+    return product_list_start_ind, int(product_list_end_ind[0])
 
+
+def receipt_date(full_text):
+    '''Returns the date printed on the receipt as datetime.date.'''
     # store date as string and datetime variable   
-    date = find_date(texts[0].description).replace(' ','')
-    date_dt = datetime.strptime(date,'%d.%m.%Y').date()
-
-    # Build dataframe, where bl: bottom_left, br: bottom_right, tr: top_right, tl: top_left
-    # denote the corners of the BBs
-    columns = ["String", "x_bl", "y_bl", "x_br", "y_br","x_tr","y_tr","x_tl","y_tl"] 
-    df = pd.DataFrame(columns=columns)
-    bounds = []
-
-    for i, text in enumerate(texts[1:]):
-        df.loc[i, "String"] = text.description
-        bounds.append(text.bounding_poly) # extract all BB coords and write them in list
-        for j in range(4):
-            df.iloc[i,2*j+1] = text.bounding_poly.vertices[j].x  
-            df.iloc[i,2*j+2] = text.bounding_poly.vertices[j].y  
-
-    # convert the coords to integers for calculation of the mean BB positions
-    df[['y_bl','y_br','y_tr','y_tl']] = df[['y_bl','y_br','y_tr','y_tl']].astype('int')
-    # calulate mean BB y positions
-    df['mean_y'] = df.eval('(y_bl+y_br+y_tr+y_tl)/4')
-
-    # sort DF by mean y position to match text that appears in the same line
-    df = df.sort_values(by=['mean_y']).reset_index(drop=True)
-
-    # select only the block of the receipt where the products are listed
-    product_list_start_ind = int(df[df.String== 'EUR'].index.values[0])+1
-    try:
-        product_list_end_ind = int(df[df.String=='SUMME'].index.values)
-    except:
-        product_list_end_ind = int(df[df.String=='SUM'].index.values)
-
-    df_products = df[product_list_start_ind:product_list_end_ind]
-    df_products.reset_index(drop=True,inplace=True)
-
-    # for matching the bounding boxes to lines on the receipt we do the following:
-    # 1) the mean y position increases stepwise (resembling stairs when plotted)
-    #   - calculate the approximate slope using the min and may y position values
-    # 2) subtract this slope from the stepwise increasing mean y positions
-    #  - in this way you get a spiky signal (when plotted), where each maximum (index) 
-    #    indicates the beginning of a line and the following minimum (index) 
-    #    indicates the end of a line
-
-    x = np.linspace(1,df_products.shape[0],num=df_products.shape[0])
-    slope = (max(df_products.mean_y)-min(df_products.mean_y))/df_products.shape[0] # 1)
-    y_flat = df_products.mean_y - slope*x-min(df_products.mean_y) # 2)
-
-    # for local maxima
-    max_ind = argrelmax(y_flat.to_numpy())[0]
-    max_ind = np.append(0,max_ind[:-1])
-    # for local minima
-    min_ind = argrelmin(y_flat.to_numpy())[0]
-
-    # label the rows of the dataframe with the corresponding lines on the receipt
-    df_products['line']=''
-    for i in range(len(max_ind)):
-        df_products['line'].iloc[max_ind[i]:min_ind[i]+1] = i
-    df_products['line'].iloc[min_ind[i]+1:df_products.shape[0]] = i+1 # make sure the last line gets labeled as well
-
-    # sort by x-coodinates of the bounding boxes to get the text in correct order
-    df_products = df_products.sort_values(by=['line','x_bl']).reset_index(drop=True)
-    
-    # create new dataframe containing the concatenated strings that belong to the same line on the receipt
-    df_sorted = df_products.groupby('line')['String'].apply(lambda x: ' '.join(x)).reset_index()
-
-    # sort out lines that do not contain any price information
-    df_sorted = df_sorted[df_sorted['String'].str.contains(' B',case=True)|df_sorted['String'].str.contains(' A *',case=True)].reset_index(drop=True)
-
-    # remove the tax remarks at the end of the strings
-    df_sorted['String'] = df_sorted['String'].str.replace(r' B$','',regex=True)
-    df_sorted['String'] = df_sorted['String'].str.replace(r' A \*$','',regex=True)
-    df_sorted['String'] = df_sorted['String'].str.replace(r' A$','',regex=True)
-
-    def extract_price(input_str):
-        # Search for pattern: [whitespace][letter or percentage symbol]
-        match = re.search(r' [A-Za-z%]', input_str[::-1])
-        if match:
-            # position of the matching pattern
-            position = match.start()
-            # residual string starting from the position of the matched pattern
-            res_str = input_str[-position:]
-        else:
-            res_str = input_str
-
-        return res_str
-
-    # extract the prices from the strings using extract_price function defined above
-    df_sorted['price'] = df_sorted['String'].apply(extract_price)
-    # dirty-fix section
-    df_sorted['price'] = df_sorted['price'].apply(lambda x: re.sub(f'^{re.escape("14 ")}', '',x))
-    df_sorted['price'] = df_sorted['price'].apply(lambda x: re.sub(f'^{re.escape("2.0 ")}', '',x))
-    df_sorted['price'] = df_sorted['price'].apply(lambda x: re.sub(f'^{re.escape("W. ")}', '',x))
-    df_sorted['price'] = df_sorted['price'].apply(lambda x: re.sub(f'^{re.escape("102 ")}', '',x))
-
-    # remove the price from the string
-    def replace_str(row):
-        return row['String'].replace(row['price'],'')
-
-    df_sorted['String'] = df_sorted.apply(replace_str,axis=1)
-
-    # formatting of the df
-    df_sorted['price'] = df_sorted['price'].str.lstrip('.B')
-    df_sorted['price'] = df_sorted['price'].str.replace(',','.')
-    df_sorted['price'] = df_sorted['price'].str.replace(' ','')
-    df_sorted['price'] = df_sorted['price'].astype('float')
-
-    df_sorted.drop('line',axis=1,inplace=True)
-    df_sorted.rename(columns={'String':'product_abbr'},inplace=True)
-
-    # add filename and date to the df
-    df_sorted['receipt_id'] = uploaded_file.name
-    df_sorted['date'] = date_dt
+    date = find_date(full_text).replace(' ','')
+    return datetime.strptime(date,'%d.%m.%Y').date()
+
+
+def group_product_lines(tokens, line_engine='sweep'):
+    '''
+    Groups the tokens of the token table into the lines of the product block.
+
+    line_engine - 'sweep' or 'relextrema', see line_clustering.LINE_ENGINES
 
-    image_boxed = draw_boxes(image,bounds,'blue')
+    Returns the text of every product line as list of strings.
+    '''
+    # sort the token table by mean y position to match text that appears in the same line
+    tokens = tokens[np.argsort(tokens['mean_y'], kind='stable')]
+
+    if line_engine == 'relextrema':
+        # select only the block of the receipt where the products are listed
+        product_list_start_ind, product_list_end_ind = find_product_block(tokens['String'])
+        products = tokens[product_list_start_ind+1:product_list_end_ind]
+
+        # label the rows with the corresponding lines on the receipt
+        lines = line_clustering.assign_lines(products, line_engine)
+
+        # sort by x-coodinates of the bounding boxes to get the text in correct order
+        order = np.lexsort((products['x_bl'], lines))
+        lines = lines[order]
+        strings = products['String'][order]
+    else:
+        # label all rows with the corresponding lines on the receipt, on tilted photos
+        # the product block can only be told apart after the lines are known
+        lines = line_clustering.assign_lines(tokens, line_engine)
+
+        # sort by x-coodinates of the bounding boxes to get the text in correct order
+        order = np.lexsort((tokens['x_bl'], lines))
+        lines = lines[order]
+        strings = tokens['String'][order]
+
+        # select only the lines between the 'EUR' header and the sum where the products are listed
+        product_list_start_ind, product_list_end_ind = find_product_block(strings)
+        in_block = (lines > lines[product_list_start_ind]) & (lines < lines[product_list_end_ind])
+        lines = lines[in_block]
+        strings = strings[in_block]
+
+    # concatenate the strings that belong to the same line on the receipt
+    _, line_starts = np.unique(lines, return_index=True)
+    return [' '.join(words) for words in np.split(strings, line_starts[1:])]
+
+
+def parse_text_annotations(texts, line_engine='sweep'):
+    '''
+    Recreates the product lines of a receipt from the text_annotations of the Vision response.
+
+    line_engine - 'sweep' or 'relextrema', see line_clustering.LINE_ENGINES
+
+    Returns a dataframe with the columns product_abbr, price, tax_code and date.
+    '''
+    date_dt = receipt_date(texts[0].description)
+
+    # Build the token table and recreate the lines of the product block
+    tokens = build_token_table(texts[1:])
+    line_strings = group_product_lines(tokens, line_engine)
 
+    # split the lines into product name, price and tax code
+    df_sorted = parse_product_lines(line_strings)
+
+    # add date to the df
+    df_sorted['date'] = date_dt
 
-    return df_sorted, image_boxed
\ No newline at end of file
+    return df_sorted
@@ -0,0 +1,39 @@
+import abbr_cache
+
+
+def item_json(abbr, name, main='Obst & Gemüse', sub='Frisches Obst'):
+    return {'product_abbr': abbr, 'productName': name, 'categoryMain': main, 'categorySub': sub}
+
+
+def test_put_and_get_by_canonical_abbreviation(tmp_path):
+    cache = abbr_cache.AbbreviationCache(str(tmp_path / 'abbreviations.sqlite'))
+
+    assert cache.put_many([item_json('BANANE', 'Banane')], 'v1', 'model') == 1
+    assert cache.get_many(['2 x banane', 'MILCH'], 'v1', 'model') == {
+        '2 x banane': item_json('2 x banane', 'Banane')}
+    assert cache.get_many(['BANANE'], 'v2', 'model') == {}
+
+def test_incomplete_and_fallback_answers_are_not_cached(tmp_path):
+    cache = abbr_cache.AbbreviationCache(str(tmp_path / 'abbreviations.sqlite'))
+    answers = [{'product_abbr': 'MILCH', 'productName': 'Milch'},
+               item_json('XYZ', 'Xyz', 'Sonstige Positionen', abbr_cache.UNRECOGNIZED_CATEGORY)]
+
+    assert cache.put_many(answers, 'v1', 'model') == 0
+    assert cache.get_many(['MILCH', 'XYZ'], 'v1', 'model') == {}
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = abbr_cache.AbbreviationCache(str(tmp_path / 'abbreviations.sqlite'), max_entries=2)
+    cache.put_many([item_json('BANANE', 'Banane'), item_json('MILCH', 'Milch')], 'v1', 'model')
+    cache.get_many(['BANANE'], 'v1', 'model')
+    cache.put_many([item_json('KASTEN LEER', 'Leergut Kasten')], 'v1', 'model')
+
+    assert sorted(cache.abbreviations('v1', 'model')) == ['BANANE', 'KASTEN LEER']
+
+def test_invalidate_other_prompt_versions(tmp_path):
+    cache = abbr_cache.AbbreviationCache(str(tmp_path / 'abbreviations.sqlite'))
+    cache.put_many([item_json('BANANE', 'Banane')], 'v1', 'model')
+    cache.put_many([item_json('BANANE', 'Banane')], 'v2', 'model')
+
+    assert cache.invalidate('v2') == 1
+    assert cache.abbreviations('v1', 'model') == []
+    assert cache.abbreviations('v2', 'model') == ['BANANE']
@@ -0,0 +1,50 @@
+import pytest
+
+import abbr_canonical
+
+
+@pytest.mark.parametrize('item, canonical', [
+    ('  banane  natur ', 'BANANE NATUR'),
+    ('2 x BANANE', 'BANANE'),
+    ('BANANE 2 X', 'BANANE'),
+    ('MILCH 1,5%', 'MILCH 1,5%'),
+    ('KAS7EN LEER', 'KAS7EN LEER'),
+    ('B0HNEN', 'BOHNEN'),
+    ('M1LCH 1O0G', 'MILCH 100G'),
+])
+def test_canonical_abbr(item, canonical):
+    assert abbr_canonical.canonical_abbr(item) == canonical
+
+@pytest.mark.parametrize('a, b, distance', [('BANANE', 'BANANE', 0), ('BANANE', 'BANANEN', 1),
+                                            ('BANANE', 'BANAME', 1), ('BANANE', 'ANANAS', 2)])
+def test_edit_distance(a, b, distance):
+    assert abbr_canonical.edit_distance(a, b, maximum=1) == min(distance, 2)
+
+def test_index_groups_near_duplicates_with_the_first_abbreviation():
+    index = abbr_canonical.AbbreviationIndex(max_edits=1, min_length=6)
+
+    assert index.representative('BANANEN') == 'BANANEN'
+    assert index.representative('BANANE') == 'BANANEN'
+    assert index.representative('KASTEN LEER') == 'KASTEN LEER'
+    assert len(index) == 2
+
+def test_index_never_groups_different_numbers():
+    index = abbr_canonical.AbbreviationIndex(['MILCH 1,5%'], max_edits=1, min_length=6)
+
+    assert index.representative('MILCH 3,5%') == 'MILCH 3,5%'
+
+def test_index_does_not_group_short_abbreviations():
+    index = abbr_canonical.AbbreviationIndex(['EIER'], max_edits=1, min_length=6)
+
+    assert index.representative('EIEE') == 'EIEE'
+
+def test_index_grouping_disabled():
+    index = abbr_canonical.AbbreviationIndex(['BANANEN'], max_edits=0)
+
+    assert index.representative('BANANE') == 'BANANE'
+
+def test_group_items():
+    groups = abbr_canonical.group_items(['BANANE', '2 x banane', 'MILCH', 'BANANEN'],
+                                        abbr_canonical.AbbreviationIndex(max_edits=1, min_length=6))
+
+    assert groups == {'BANANE': ['BANANE', '2 x banane', 'BANANEN'], 'MILCH': ['MILCH']}
@@ -0,0 +1,22 @@
+import pytest
+
+import api_clients
+
+
+def test_create_mistral_client_rejects_client_without_httpx_client(monkeypatch):
+    from mistralai import client as mistral_module
+
+    class NewerMistralClient:
+        def __init__(self, *args, **kwargs):
+            pass
+
+    monkeypatch.setattr(mistral_module, 'MistralClient', NewerMistralClient)
+    with pytest.raises(RuntimeError, match='requirements.txt'):
+        api_clients.create_mistral_client('key')
+
+def test_create_mistral_client_replaces_the_httpx_client():
+    import httpx
+
+    client = api_clients.create_mistral_client('key')
+    assert isinstance(client._client, httpx.Client)
+    assert client._client._transport.__class__.__name__ == 'MeteredTransport'
@@ -0,0 +1,11 @@
+'''The pages must not import the heavy dependencies at startup, see benchmark.py imports.'''
+
+import pytest
+
+import benchmark
+
+
+@pytest.mark.parametrize('page', benchmark.PAGES)
+def test_page_imports_no_heavy_module_eagerly(page):
+    loaded = benchmark.measure_page_imports(page)['loaded']
+    assert loaded == [], f'{page} imports {", ".join(loaded)} at startup'
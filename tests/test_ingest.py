@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+
+import ingest
+
+
+def test_checkpoint_keeps_the_last_finished_stage(tmp_path):
+    checkpoint = ingest.Checkpoint(str(tmp_path / 'checkpoint.jsonl'))
+    checkpoint.write('a.jpg', 'ocr', [{'product_abbr': 'BANANE'}])
+    checkpoint.write('a.jpg', 'llm', [{'product_abbr': 'BANANE', 'productName': 'Banane'}])
+    checkpoint.write('b.jpg', 'ocr', [{'product_abbr': 'MILCH'}])
+    # a failed stage does not replace the last finished one
+    checkpoint.write('b.jpg', 'error', failed_stage='llm', error='1 item(s) could not be contextualized')
+
+    assert checkpoint.load() == {'a.jpg': ('llm', [{'product_abbr': 'BANANE', 'productName': 'Banane'}]),
+                                 'b.jpg': ('ocr', [{'product_abbr': 'MILCH'}])}
+
+def test_checkpoint_ignores_incomplete_last_line(tmp_path):
+    path = tmp_path / 'checkpoint.jsonl'
+    checkpoint = ingest.Checkpoint(str(path))
+    checkpoint.write('a.jpg', 'db')
+    with open(path, 'a') as f:
+        f.write('{"receipt": "b.jpg", "sta')
+
+    assert checkpoint.load() == {'a.jpg': ('db', None)}
+
+def test_checkpoint_missing_file(tmp_path):
+    assert ingest.Checkpoint(str(tmp_path / 'missing.jsonl')).load() == {}
+
+def test_llm_stage_fails_receipt_with_unresolved_items(monkeypatch):
+    answers = {'BANANE': {'productName': 'Banane', 'categoryMain': 'Obst & Gemüse', 'categorySub': 'Frisches Obst'}}
+    monkeypatch.setattr(ingest.llm, 'process_abbr_items_list',
+                        lambda items, categories: [dict(answers.get(item, {}), product_abbr=item) for item in items])
+    job = {'df': pd.DataFrame({'product_abbr': ['BANANE', 'XYZ'], 'price': [1.99, 0.5]})}
+
+    with pytest.raises(ValueError, match=r'1 item\(s\)'):
+        ingest.llm_stage(job, 'categories')
+
+    job['df'] = job['df'].iloc[:1]
+    assert ingest.llm_stage(job, 'categories').productName.to_list() == ['Banane']
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+import benchmark
+import line_clustering
+import read_receipt
+
+
+def token_table(words):
+    '''Token table of (word, x, y) boxes of 20 px height.'''
+    texts = [benchmark.make_annotation(word, x, y, 18 * len(word), 20) for word, x, y in words]
+    return read_receipt.build_token_table(texts)
+
+def test_cluster_lines_groups_boxes_by_line_from_top_to_bottom():
+    tokens = token_table([('B', 300, 140), ('MILCH', 40, 100), ('1,19', 200, 102),
+                          ('BANANE', 40, 140), ('A', 300, 98), ('0,99', 200, 141)])
+    lines = line_clustering.cluster_lines(tokens)
+
+    assert lines.tolist() == [1, 0, 0, 1, 0, 1]
+
+def test_cluster_lines_empty():
+    assert line_clustering.cluster_lines(token_table([])).shape == (0,)
+
+@pytest.mark.parametrize('skew, curl', [(0.0, 0.0), (0.03, 0.0), (0.0, 10.0), (0.02, 8.0)])
+def test_sweep_engine_on_distorted_receipts(skew, curl):
+    texts, products = benchmark.make_synthetic_receipt(n_lines=25, skew=skew, curl=curl, seed=3)
+
+    assert benchmark.parse_with_engine(texts, 'sweep') == products
+
+def test_assign_lines_unknown_engine():
+    with pytest.raises(ValueError):
+        line_clustering.assign_lines(token_table([('MILCH', 40, 100)]), 'unknown')
+
+def test_local_skew_ignores_single_outlier():
+    y_center = np.arange(10, dtype=np.float64)
+    slope = np.full(10, 0.02)
+    slope[5] = 1.0
+
+    assert np.allclose(line_clustering.local_skew(y_center, slope, window=5), 0.02)
@@ -0,0 +1,30 @@
+import pytest
+
+import llm_json
+
+
+@pytest.mark.parametrize('message', [
+    '{"productName": "Banane", "categoryMain": "Obst & Gemüse"}',
+    'Hier ist die Antwort:\n```json\n{"productName": "Banane", "categoryMain": "Obst & Gemüse"}\n```',
+    '{"productName": "Banane", "categoryMain": "Obst & Gemüse",}',
+    '{“productName”: “Banane”, “categoryMain”: “Obst & Gemüse”}',
+    "{'product_name': 'Banane', 'category_main': 'Obst & Gemüse'}",
+    'productName: Banane, categoryMain: Obst & Gemüse',
+])
+def test_loads_repaired(message):
+    assert llm_json.loads_repaired(message) == {'productName': 'Banane', 'categoryMain': 'Obst & Gemüse'}
+
+def test_loads_repaired_array_in_text():
+    message = 'Antwort: [{"index": 0, "Hauptkategorie": "Getränke "}, {"index": 1, "name": "Milch"}] Ende'
+
+    assert llm_json.loads_repaired(message) == [{'index': 0, 'categoryMain': 'Getränke'},
+                                                {'index': 1, 'productName': 'Milch'}]
+
+def test_loads_repaired_invalid():
+    with pytest.raises(ValueError):
+        llm_json.loads_repaired('Das kann ich nicht beantworten.')
+
+def test_candidates_from_least_to_most_invasive_repair():
+    message = '```json\n[{"a": 1},]\n```'
+
+    assert list(llm_json.candidates(message)) == [message, '[{"a": 1},]', '[{"a": 1}]']
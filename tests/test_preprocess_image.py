@@ -0,0 +1,22 @@
+import io
+
+from PIL import Image
+
+import preprocess_image
+
+
+def test_prepare_upload_downscales_large_photo():
+    photo = Image.new('RGB', (3000, 4000), 'white')
+    content, (scale, offset_x, offset_y) = preprocess_image.prepare_upload(photo, max_long_edge=2400)
+
+    upload = Image.open(io.BytesIO(content))
+    assert max(upload.size) == 2400
+    assert scale == 2400 / 4000
+    assert (offset_x, offset_y) == (0, 0)
+
+def test_prepare_upload_keeps_small_image():
+    image = Image.new('RGB', (800, 1200), 'white')
+    content, (scale, _, _) = preprocess_image.prepare_upload(image, max_long_edge=2400)
+
+    assert Image.open(io.BytesIO(content)).size == (800, 1200)
+    assert scale == 1.0
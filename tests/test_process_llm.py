@@ -0,0 +1,119 @@
+import json
+
+import pytest
+
+import process_llm
+
+ITEMS = ['BANANE', 'KASTEN LEER', 'MILCH']
+
+
+def answer(index, name, main='Obst & Gemüse', sub='Frisches Obst'):
+    entry = {'productName': name, 'categoryMain': main, 'categorySub': sub}
+    if index is not None:
+        entry['index'] = index
+    return entry
+
+def names(results):
+    return [result and result['productName'] for result in results]
+
+
+def test_parse_batch_response_aligns_by_index():
+    message = json.dumps([answer(2, 'Milch'), answer(0, 'Banane'), answer(1, 'Leergut Kasten')])
+    results = process_llm.parse_batch_response(message, ITEMS)
+
+    assert names(results) == ['Banane', 'Leergut Kasten', 'Milch']
+    assert [result['product_abbr'] for result in results] == ITEMS
+
+def test_parse_batch_response_converts_numeric_string_index():
+    message = json.dumps([answer('1', 'Leergut Kasten'), answer('2', 'Milch'), answer('0', 'Banane')])
+
+    assert names(process_llm.parse_batch_response(message, ITEMS)) == ['Banane', 'Leergut Kasten', 'Milch']
+
+def test_parse_batch_response_by_position_without_index():
+    message = json.dumps([answer(None, 'Banane'), answer(None, 'Leergut Kasten'), answer(None, 'Milch')])
+
+    assert names(process_llm.parse_batch_response(message, ITEMS)) == ['Banane', 'Leergut Kasten', 'Milch']
+
+@pytest.mark.parametrize('index', ['eins', 1.5, True, [0], -1, 3])
+def test_parse_batch_response_invalid_index_leaves_item_unaligned(index):
+    message = json.dumps([answer(index, 'Leergut Kasten'), answer(0, 'Banane'), answer(2, 'Milch')])
+
+    assert names(process_llm.parse_batch_response(message, ITEMS)) == ['Banane', None, 'Milch']
+
+def test_parse_batch_response_rejects_non_string_fields():
+    message = json.dumps([answer(0, 'Banane', main=None), answer(1, ''), answer(2, 'Milch', sub=3)])
+
+    assert process_llm.parse_batch_response(message, ITEMS) == [None, None, None]
+
+def test_parse_batch_response_first_answer_per_item_wins():
+    message = json.dumps([answer(0, 'Banane'), answer(0, 'Bananen')])
+
+    assert names(process_llm.parse_batch_response(message, ITEMS)) == ['Banane', None, None]
+
+def test_parse_batch_response_single_object():
+    message = json.dumps(answer(0, 'Banane'))
+
+    assert names(process_llm.parse_batch_response(message, ITEMS[:1])) == ['Banane']
+
+def test_parse_batch_response_required_keys():
+    message = json.dumps([{'index': 0, 'categorySub': 'Frisches Obst'}, {'index': 1}])
+    results = process_llm.parse_batch_response(message, ITEMS[:2], required=('categorySub',))
+
+    assert results == [{'categorySub': 'Frisches Obst', 'product_abbr': 'BANANE'}, None]
+
+def test_process_abbr_batch_requests_unanswered_items_again(monkeypatch):
+    prompts = []
+
+    def run_mistral(prompt, usage=None, **kwargs):
+        prompts.append(prompt)
+        if len(prompts) == 1:
+            # categoryMain null for KASTEN LEER, no answer for MILCH
+            return json.dumps([answer(0, 'Banane'), answer(1, 'Leergut Kasten', main=None)])
+        return json.dumps([answer(0, 'Leergut Kasten', 'Sonstige Positionen', 'Pfand & Leergut'),
+                           answer(1, 'Milch', 'Milchprodukte', 'Milch')])
+
+    monkeypatch.setattr(process_llm, 'run_mistral', run_mistral)
+    results = process_llm.process_abbr_batch(ITEMS, 'categories')
+
+    assert names(results) == ['Banane', 'Leergut Kasten', 'Milch']
+    assert len(prompts) == 2
+    assert '0: KASTEN LEER\n1: MILCH' in prompts[1]
+
+
+def test_token_batches_by_item_count():
+    assert process_llm.token_batches(['a', 'b', 'c', 'd', 'e'], max_items=2) == [['a', 'b'], ['c', 'd'], ['e']]
+
+def test_token_batches_by_estimated_tokens():
+    texts = ['x' * 39, 'x' * 39, 'x' * 39]  # 10 estimated tokens each
+
+    assert process_llm.token_batches(texts, max_items=10, max_tokens=25) == [texts[:2], texts[2:]]
+
+def test_token_batches_long_text_gets_own_batch():
+    texts = ['short', 'x' * 400, 'short']
+
+    assert process_llm.token_batches(texts, max_items=10, max_tokens=50) == [['short'], ['x' * 400], ['short']]
+
+def test_token_batches_empty():
+    assert process_llm.token_batches([], max_items=10) == []
+
+
+def test_get_embeddings_by_chunks_embeds_each_new_text_once(monkeypatch, tmp_path):
+    import embedding_cache
+
+    cache = embedding_cache.EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+    cache.put_many(['cached'], [[1.0, 0.0]], process_llm.EMBEDDING_MODEL)
+    monkeypatch.setattr(embedding_cache, 'default_cache', lambda: cache)
+    requested = []
+
+    def embed_batch(batch, on_embedded=None):
+        requested.extend(batch)
+        vectors = [[float(len(text)), 1.0] for text in batch]
+        on_embedded(batch, vectors)
+        return vectors
+
+    monkeypatch.setattr(process_llm, 'embed_batch', embed_batch)
+    embeddings = process_llm.get_embeddings_by_chunks(['new', 'cached', 'new', 'other'], chunk_size=2)
+
+    assert requested == ['new', 'other']
+    assert embeddings == [[3.0, 1.0], [1.0, 0.0], [3.0, 1.0], [5.0, 1.0]]
+    assert cache.get_many(['other'], process_llm.EMBEDDING_MODEL).keys() == {'other'}
@@ -0,0 +1,160 @@
+import httpx
+import pytest
+from mistralai.exceptions import MistralAPIException, MistralConnectionException, MistralException
+
+import rate_limit
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'backoff_seconds', lambda attempt: 0)
+
+def wrapped_timeout():
+    '''Raises a timeout the way mistralai 0.0.12 wraps it.'''
+    try:
+        raise httpx.ReadTimeout('read timed out')
+    except httpx.ReadTimeout as e:
+        raise MistralException(f'Unexpected exception ({e.__class__.__name__}): {e}') from e
+
+def raise_(exception):
+    def func():
+        raise exception
+    return func
+
+def limiter(failures=2, reset_seconds=60):
+    return rate_limit.RateLimiter(requests_per_second=1000, tokens_per_minute=10**9,
+                                  breaker=rate_limit.CircuitBreaker(failures, reset_seconds))
+
+
+@pytest.mark.parametrize('exception, retryable', [
+    (MistralAPIException('rate limited', http_status=429), True),
+    (MistralAPIException('bad gateway', http_status=502), True),
+    (MistralAPIException('bad request', http_status=400), False),
+    (MistralConnectionException('refused'), True),
+    (TimeoutError(), True),
+    (MistralException('no response'), False),
+    (ValueError('invalid json'), False),
+])
+def test_is_retryable(exception, retryable):
+    assert rate_limit.is_retryable(exception) == retryable
+
+def test_is_retryable_wrapped_httpx_timeout():
+    with pytest.raises(MistralException) as info:
+        wrapped_timeout()
+    assert rate_limit.is_retryable(info.value)
+
+def test_call_retries_server_errors():
+    answers = iter([MistralAPIException('unavailable', http_status=503), 'ok'])
+
+    def func():
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    rate = limiter()
+    assert rate.call(func) == 'ok'
+    assert rate.stats['retries'] == 1
+    assert rate.breaker.state == 'closed'
+
+def test_call_does_not_retry_client_errors():
+    calls = []
+
+    def func():
+        calls.append(1)
+        raise MistralAPIException('bad request', http_status=400)
+
+    with pytest.raises(MistralAPIException):
+        limiter().call(func)
+    assert len(calls) == 1
+
+def test_circuit_opens_after_failures_in_a_row():
+    rate = limiter(failures=2)
+    with pytest.raises(MistralException):
+        rate.call(wrapped_timeout, max_retries=1)
+    assert rate.breaker.state == 'open'
+
+    with pytest.raises(rate_limit.CircuitOpenError):
+        rate.call(lambda: 'ok')
+
+def test_half_open_trial_closes_the_circuit():
+    rate = limiter(failures=1, reset_seconds=0)
+    with pytest.raises(MistralException):
+        rate.call(wrapped_timeout, max_retries=0)
+
+    assert rate.breaker.state == 'half open'
+    assert rate.call(lambda: 'ok') == 'ok'
+    assert rate.breaker.state == 'closed'
+
+def test_half_open_trial_failure_opens_again():
+    breaker = rate_limit.CircuitBreaker(failures=1, reset_seconds=0)
+    breaker.failed()
+    breaker.allow()
+    # only one trial request at a time
+    with pytest.raises(rate_limit.CircuitOpenError):
+        breaker.allow()
+    breaker.failed()
+    assert breaker.opened_at is not None and not breaker.trial
+
+def test_non_retryable_trial_does_not_block_the_circuit():
+    rate = limiter(failures=1, reset_seconds=0)
+    with pytest.raises(MistralException):
+        rate.call(wrapped_timeout, max_retries=0)
+
+    with pytest.raises(MistralAPIException):
+        rate.call(raise_(MistralAPIException('bad request', http_status=400)))
+    assert not rate.breaker.trial
+    assert rate.call(lambda: 'ok') == 'ok'
+
+def test_rate_limited_answer_does_not_open_the_circuit():
+    rate = limiter(failures=1)
+    answers = iter([MistralAPIException('slow down', http_status=429, headers={'Retry-After': '0'}), 'ok'])
+
+    def func():
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert rate.call(func) == 'ok'
+    assert rate.breaker.state == 'closed'
+    assert rate.stats['rate_limited'] == 1
+    assert rate.rate_factor < 1.0
+
+def test_retry_after_seconds():
+    assert rate_limit.retry_after_seconds(MistralAPIException(headers={'Retry-After': '2.5'})) == 2.5
+    assert rate_limit.retry_after_seconds(MistralAPIException(headers={'retry-after': 'soon'})) is None
+    assert rate_limit.retry_after_seconds(ValueError()) is None
+
+def test_token_bucket_reserve_and_refund(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(rate_limit.time, 'monotonic', lambda: now[0])
+    bucket = rate_limit.TokenBucket(rate=2, capacity=2)
+
+    assert bucket.reserve(2) == 0
+    assert bucket.reserve(1) == 0.5
+    now[0] += 0.5
+    assert bucket.reserve(1) == 0.5
+    bucket.refund(1)
+    assert bucket.level == 0
+    bucket.refund(5)
+    assert bucket.level == bucket.capacity
+
+def test_acquire_reserves_once_after_a_pause(monkeypatch):
+    rate = rate_limit.RateLimiter(requests_per_second=1, tokens_per_minute=600)
+    rate.acquire(tokens=600)
+    sleeps = []
+
+    def sleep(seconds):
+        # a 429 answer of another request comes in while this one waits
+        if not sleeps:
+            rate.rate_limited(retry_after=0)
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(rate_limit.time, 'sleep', sleep)
+    rate.acquire(tokens=10)
+
+    assert len(sleeps) == 2
+    # one request and 10 tokens reserved, not two of each
+    assert rate.requests.level == pytest.approx(-1, abs=0.01)
+    assert rate.tokens.level == pytest.approx(-10, abs=0.01)
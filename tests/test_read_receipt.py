@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+
+import benchmark
+import read_receipt
+
+
+@pytest.mark.parametrize('line, product_abbr, price, tax_code', [
+    ('MILCH 1,19 A', 'MILCH ', 1.19, 'A'),
+    ('BIO BANANE 1,99 B', 'BIO BANANE ', 1.99, 'B'),
+    ('SALAT 14 1,99 A *', 'SALAT 14 ', 1.99, 'A'),
+    ('KAESE 102 2,49 A', 'KAESE 102 ', 2.49, 'A'),
+    ('W. 3,49 B', 'W. ', 3.49, 'B'),
+    # the misread amounts are the price itself
+    ('PFAND 14 B', 'PFAND ', 14.0, 'B'),
+    ('BANANE 2.0 B', 'BANANE ', 2.0, 'B'),
+])
+def test_parse_product_lines(line, product_abbr, price, tax_code):
+    parsed = read_receipt.parse_product_lines([line])
+
+    assert parsed.to_dict('records') == [{'product_abbr': product_abbr, 'price': price, 'tax_code': tax_code}]
+
+def test_parse_product_lines_sorts_out_lines_without_price():
+    parsed = read_receipt.parse_product_lines(['REWE Markt GmbH', 'NOPRICE B', 'EIER A *', 'MILCH 1,19 A'])
+
+    assert parsed.product_abbr.to_list() == ['MILCH ']
+
+def test_parse_product_lines_matches_former_pandas_chain():
+    lines = benchmark.GRAMMAR_EDGE_LINES
+    legacy = benchmark.legacy_parse_product_lines(lines)
+    parsed = read_receipt.parse_product_lines(lines)
+
+    pd.testing.assert_frame_equal(legacy[['product_abbr', 'price']], parsed[['product_abbr', 'price']])
+
+def test_parse_text_annotations_synthetic_receipt():
+    texts, products = benchmark.make_synthetic_receipt(n_lines=20)
+    parsed = read_receipt.parse_text_annotations(texts)
+
+    assert [name.strip() for name in parsed.product_abbr] == products
+    assert parsed.price.notna().all()
@@ -0,0 +1,21 @@
+import os
+
+import vision_cache
+
+
+def test_evict_skips_entries_removed_meanwhile(monkeypatch, tmp_path):
+    cache = vision_cache.VisionCache(str(tmp_path), max_bytes=16)
+    for name, mtime in [('old', 1), ('gone', 2), ('new', 3)]:
+        path = tmp_path / (name + cache.suffix)
+        path.write_bytes(b'x' * 8)
+        os.utime(path, (mtime, mtime))
+    cache._size = 24
+
+    # another process removes an entry between the listing and the stat
+    entries = cache._entries()
+    os.remove(tmp_path / ('gone' + cache.suffix))
+    monkeypatch.setattr(cache, '_entries', lambda: entries)
+
+    cache._evict()
+    assert sorted(os.listdir(tmp_path)) == ['new' + cache.suffix]
+    assert cache._size == 16
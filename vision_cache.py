@@ -0,0 +1,123 @@
+'''
+Persistent cache for Google Vision responses
+
+The responses are stored on disk by content hash of the image bytes that were sent to
+the API, so re-imports and reprocessing of a receipt don't need another Vision call.
+The cache is bounded in size, the least recently used responses are evicted first.
+'''
+
+import hashlib
+import os
+import tempfile
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+VISION_CACHE_DIR = os.getenv('VISION_CACHE_DIR', os.path.join('.cache', 'vision'))
+VISION_CACHE_MAX_MB = float(os.getenv('VISION_CACHE_MAX_MB', 500))
+
+
+class VisionCache:
+    '''Content-addressed on-disk store of AnnotateImageResponse messages with LRU eviction.'''
+
+    suffix = '.pb'
+
+    def __init__(self, directory=VISION_CACHE_DIR, max_bytes=int(VISION_CACHE_MAX_MB * 1024**2)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._stat_entries())
+
+    @staticmethod
+    def key(content):
+        '''Returns the cache key of the image bytes.'''
+        return hashlib.sha256(content).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _entries(self):
+        return [entry.path for entry in os.scandir(self.directory)
+                if entry.is_file() and entry.name.endswith(self.suffix)]
+
+    def _stat_entries(self):
+        # (mtime, size, path) of the entries, other processes can remove or replace an entry meanwhile
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get(self, content):
+        '''Returns the cached response for the image bytes or None.'''
+        from google.cloud import vision
+
+        path = self._path(self.key(content))
+        try:
+            with open(path, 'rb') as f:
+                serialized = f.read()
+            # mark as recently used for the eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return vision.AnnotateImageResponse.deserialize(serialized)
+
+    def put(self, content, response):
+        '''Stores the response for the image bytes and evicts old entries if the cache is full.'''
+        serialized = type(response).serialize(response)
+        path = self._path(self.key(content))
+
+        # write to a temporary file first, so that readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(serialized)
+        with self._lock:
+            try:
+                self._size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+            self._size += len(serialized)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # remove the least recently used entries until the cache fits into max_bytes
+        for _, size, path in sorted(self._stat_entries()):
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
+
+    def clear(self):
+        '''Removes all cached responses.'''
+        with self._lock:
+            for path in self._entries():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._size = 0
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def default_cache():
+    '''Returns the process-wide Vision cache, or None if it is disabled (VISION_CACHE_MAX_MB=0).'''
+    global _default_cache
+    if VISION_CACHE_MAX_MB <= 0:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = VisionCache()
+    return _default_cache
@@ -0,0 +1,156 @@
+'''
+Record and replay of Google Vision responses
+
+The recorder saves the Vision responses for real receipts as JSON fixtures, the replay
+client answers read_receipt.detect_text from these fixtures instead of the Vision API:
+
+    response = read_receipt.detect_text(image, use_cache=False, client=ReplayClient())
+
+Run as script to record the responses for a directory of receipt images:
+    python vision_replay.py <image_dir> --fixtures data/vision_responses
+'''
+
+import argparse
+import hashlib
+import json
+import os
+
+import api_clients
+import preprocess_image
+import read_receipt
+
+FIXTURE_DIR = os.path.join('data', 'vision_responses')
+INDEX_FILENAME = 'index.json'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.pcx', '.tif')
+
+
+def content_key(content):
+    '''Returns the key of the uploaded image bytes.'''
+    return hashlib.sha256(content).hexdigest()
+
+def load_index(fixture_dir=FIXTURE_DIR):
+    '''Returns the index of the fixtures: content key -> {'fixture': filename, 'image': path or None,
+    'transform': transform of the preprocessing (see preprocess_image.prepare_upload) or None}.'''
+    try:
+        with open(os.path.join(fixture_dir, INDEX_FILENAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def load_fixtures(fixture_dir=FIXTURE_DIR):
+    '''Loads all recorded responses.
+
+    The fixtures hold the responses to the preprocessed uploads, the bounding boxes are mapped back
+    to the original image like detect_text does.
+
+    Returns a list of (fixture name, response, path of the receipt image or None).
+    '''
+    from google.cloud import vision
+
+    fixtures = []
+    for entry in sorted(load_index(fixture_dir).values(), key=lambda entry: entry['fixture']):
+        with open(os.path.join(fixture_dir, entry['fixture'])) as f:
+            response = vision.AnnotateImageResponse.from_json(f.read())
+        image_path = entry.get('image')
+        if image_path is not None:
+            image_path = os.path.normpath(os.path.join(fixture_dir, image_path))
+        transform = entry.get('transform')
+        if transform is None and image_path is not None and os.path.exists(image_path):
+            # recorded without the transform, preprocess the image again
+            transform = upload_transform(image_path)
+        if transform is not None:
+            response = preprocess_image.map_to_original(response, transform)
+        fixtures.append((entry['fixture'], response, image_path))
+    return fixtures
+
+def upload_transform(image_path):
+    '''Returns the transform of the preprocessing of the receipt image, see preprocess_image.prepare_upload.'''
+    from PIL import Image
+
+    _, transform = preprocess_image.prepare_upload(Image.open(image_path))
+    return transform
+
+
+class RecordingClient:
+    '''Vision client that passes the requests to the API and saves every response as fixture.'''
+
+    def __init__(self, fixture_dir=FIXTURE_DIR, client=None):
+        self.fixture_dir = fixture_dir
+        self.client = client
+        self.index = load_index(fixture_dir)
+        # path of the receipt image of the next request, to name the fixture and find the image again
+        self.image_path = None
+        # transform of the preprocessing of the next request, to map the boxes of the fixture back
+        self.transform = None
+        os.makedirs(fixture_dir, exist_ok=True)
+
+    def text_detection(self, image, **kwargs):
+        if self.client is None:
+            read_receipt.set_credentials()
+            self.client = api_clients.vision_client()
+        response = self.client.text_detection(image=image, **kwargs)
+
+        key = content_key(image.content)
+        if self.image_path is not None:
+            fixture = os.path.splitext(os.path.basename(self.image_path))[0] + '.json'
+            image_path = os.path.relpath(self.image_path, self.fixture_dir)
+        else:
+            fixture, image_path = key[:16] + '.json', None
+
+        with open(os.path.join(self.fixture_dir, fixture), 'w') as f:
+            f.write(type(response).to_json(response))
+        self.index[key] = {'fixture': fixture, 'image': image_path,
+                           'transform': list(self.transform) if self.transform is not None else None}
+        with open(os.path.join(self.fixture_dir, INDEX_FILENAME), 'w') as f:
+            json.dump(self.index, f, indent=2)
+
+        return response
+
+
+class ReplayClient:
+    '''Vision client that answers text_detection requests from the recorded fixtures.'''
+
+    def __init__(self, fixture_dir=FIXTURE_DIR):
+        self.fixture_dir = fixture_dir
+        self.index = load_index(fixture_dir)
+
+    def text_detection(self, image, **kwargs):
+        from google.cloud import vision
+
+        key = content_key(image.content)
+        if key not in self.index:
+            raise KeyError(f'No recorded response for this image in {self.fixture_dir}, '
+                           'record it with vision_replay.py (the preprocessing settings must match)')
+        # load a new message for every request, detect_text maps the boxes in place
+        with open(os.path.join(self.fixture_dir, self.index[key]['fixture'])) as f:
+            return vision.AnnotateImageResponse.from_json(f.read())
+
+
+def record_receipts(image_dir, fixture_dir=FIXTURE_DIR):
+    '''Records the Vision responses for all receipt images in image_dir.'''
+    from PIL import Image
+
+    recorder = RecordingClient(fixture_dir)
+    for filename in sorted(os.listdir(image_dir)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        recorder.image_path = os.path.join(image_dir, filename)
+        try:
+            # detect_text does not return the transform, preprocessing again is cheap next to the request
+            recorder.transform = upload_transform(recorder.image_path)
+            read_receipt.detect_text(Image.open(recorder.image_path), use_cache=False, client=recorder)
+            print(f'Recorded {filename}')
+        except Exception as e:
+            print(f'Error recording {filename}: {e}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record Vision responses of receipt images as fixtures')
+    parser.add_argument('image_dir', help='directory with receipt images')
+    parser.add_argument('--fixtures', default=FIXTURE_DIR, help='directory to save the fixtures in')
+    args = parser.parse_args()
+
+    record_receipts(args.image_dir, args.fixtures)
+
+if __name__=='__main__':
+    main()